@@ -0,0 +1,149 @@
+# Benchmarks for the interpolation, gridding and dfsu I/O hot paths
+#
+# Times get_interpolants, interp_grid, dfsuToTif (both backends) and extractDirectionFromDfsu
+# on synthetic meshes of several sizes and saves the results as json. Compared against a saved
+# baseline, any benchmark slower than the baseline by more than --tolerance is flagged and the
+# script exits with 1. Only needs mikeio, numpy and GDAL, no network or MIKE license.
+#
+# Example usage:
+#   python benchmarks/run_benchmarks.py --save-baseline
+#   python benchmarks/run_benchmarks.py --sizes 1000 10000 --tolerance 1.3
+#
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+from mikeio import Dfsu
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import busybeaver.interpolation as bbinterp
+import busybeaver.meshcache as bbmesh
+import busybeaver.processes as proc
+from synthetic import makeDfsu
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Returns the best time in seconds of repeat calls of func
+def timeit(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+# Returns dict of benchmark name to best time for one mesh
+def runMesh(folder, n_elements, triangles, grid_sizes, repeat, max_gdal_elements):
+
+    max_dfsu, animated_dfsu = makeDfsu(folder, n_elements, triangles=triangles)
+    mesh = "{}_{}".format("tri" if triangles else "quad", n_elements)
+    out = os.path.join(folder, "out")
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    dfs = Dfsu(max_dfsu)
+    coords = dfs.element_coordinates
+    data = dfs.read(["Maximum water depth"]).data[0][0]
+
+    # a benchmark which runs out of memory is reported and left out of the results, so the
+    # others still run on big meshes
+    results = {}
+    def bench(name, func):
+        key = "{}[{}]".format(name, mesh)
+        try:
+            results[key] = timeit(func, repeat)
+        except MemoryError:
+            print("{:<55} {:>12}".format(key, "out of memory"))
+            return
+        print("{:<55} {:>10.4f} s".format(key, results[key]))
+
+    # single point lookups, including building the index once
+    points = coords[np.linspace(0, len(coords) - 1, 100).astype(int), :2] + 0.1
+    def interpolants():
+        index = bbinterp.QuadrantIndex(coords)
+        for pnt in points:
+            bbinterp.get_interpolants(pnt, coords, data, index)
+    bench("get_interpolants x100", interpolants)
+
+    for dxdy in grid_sizes:
+        grid = dfs.get_overset_grid(dxdy=dxdy)
+        bench("interp_grid dxdy={}".format(dxdy), lambda: bbinterp.interp_grid(grid, coords, data))
+
+    # the mesh cache is cleared in every call, so each repeat builds the grid and plan again
+    tif_file = os.path.join(out, "{}.tif".format(mesh))
+    def dfsuToTif(backend):
+        bbmesh.clear()
+        proc.dfsuToTif(max_dfsu, "Maximum water depth", 0, tif_file, backend=backend)
+    bench("dfsuToTif numpy", lambda: dfsuToTif("numpy"))
+    if n_elements <= max_gdal_elements:
+        bench("dfsuToTif gdal", lambda: dfsuToTif("gdal"))
+
+    direction_dfsu = os.path.join(out, "{}_direction.dfsu".format(mesh))
+    n_timesteps = Dfsu(animated_dfsu).n_timesteps
+    bench("extractDirectionFromDfsu all timesteps",
+          lambda: proc.extractDirectionFromDfsu(animated_dfsu, direction_dfsu, range(n_timesteps)))
+
+    return results
+
+# Returns list of (name, baseline time, time) for benchmarks slower than tolerance times the baseline
+def regressions(results, baseline, tolerance):
+    return [(name, baseline[name], t) for name, t in sorted(results.items())
+            if name in baseline and t > baseline[name]*tolerance]
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark busybeaver hot paths on synthetic meshes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="number of mesh elements (the numpy dfsuToTif plan of a 1000000 element mesh needs over 25 GB)")
+    parser.add_argument("--grid-sizes", type=float, nargs="+", default=[2.0, 5.0],
+                        help="cell sizes for interp_grid in metres (mesh cells are 2 m)")
+    parser.add_argument("--quads", action="store_true", help="use quad meshes instead of triangles")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark, best is kept")
+    parser.add_argument("--max-gdal-elements", type=int, default=100000,
+                        help="largest mesh to run the slow gdal.Grid backend on")
+    parser.add_argument("--data", default=os.path.join(HERE, "data"), help="folder for synthetic files")
+    parser.add_argument("--output", default=os.path.join(HERE, "results.json"))
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="save results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+                        help="flag benchmarks slower than this times the baseline")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for n_elements in args.sizes:
+        results.update(runMesh(args.data, n_elements, not args.quads, args.grid_sizes, args.repeat,
+                               args.max_gdal_elements))
+
+    report = {"machine" : platform.platform(), "python" : platform.python_version(), "results" : results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=1)
+        print("Saved baseline to {}".format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline at {}, run with --save-baseline first.".format(args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+
+    slower = regressions(results, baseline, args.tolerance)
+    for name, before, after in slower:
+        print("REGRESSION {}: {:.4f} s -> {:.4f} s ({:.0%})".format(name, before, after, after/before - 1))
+    if not slower:
+        print("No regressions against {}".format(args.baseline))
+
+    return 1 if slower else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
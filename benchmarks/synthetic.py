@@ -0,0 +1,94 @@
+# This module creates synthetic MIKE meshes and dfsu files for benchmarking
+#
+# Meshes are regular grids of square cells, either as quads or split into two triangles per cell,
+# so any number of elements can be made without MIKE Zero.
+
+import os
+import numpy as np
+import pandas as pd
+from mikeio import Dfsu, Dataset
+from mikeio.eum import ItemInfo, EUMType, EUMUnit
+
+# Lower left corner of synthetic meshes, somewhere in UTM zone 32
+X0 = 594000.0
+Y0 = 6645000.0
+
+# makeMesh
+# Writes a .mesh file with about n_elements elements of cell_size metres
+#
+# Example usage:
+#   makeMesh("bench_1000.mesh", 1000, triangles=True)
+#
+# Returns (node coordinates, element table) as ndarrays
+#
+def makeMesh(mesh_file, n_elements, cell_size=2.0, triangles=True):
+
+    n_cells = n_elements // 2 if triangles else n_elements
+    nx = max(int(np.sqrt(n_cells)), 1)
+    ny = max(n_cells // nx, 1)
+
+    x, y = np.meshgrid(X0 + np.arange(nx + 1)*cell_size, Y0 + np.arange(ny + 1)*cell_size)
+    z = -1.0 - 0.01*(x - X0)
+    nodes = np.column_stack([x.ravel(), y.ravel(), z.ravel()])
+
+    # corner node numbers (1 based) of each cell, counter clockwise from lower left
+    i, j = np.meshgrid(np.arange(nx), np.arange(ny))
+    ll = (j*(nx + 1) + i).ravel() + 1
+    lr, ur, ul = ll + 1, ll + nx + 2, ll + nx + 1
+    if triangles:
+        elements = np.vstack([np.column_stack([ll, lr, ur]), np.column_stack([ll, ur, ul])])
+    else:
+        elements = np.column_stack([ll, lr, ur, ul])
+
+    # boundary code 1 on the outside, 0 inside
+    codes = np.zeros(len(nodes), dtype=int)
+    codes[(x.ravel() == x.min()) | (x.ravel() == x.max()) | (y.ravel() == y.min()) | (y.ravel() == y.max())] = 1
+
+    with open(mesh_file, "w") as f:
+        f.write("100079  1000  {}  UTM-32\n".format(len(nodes)))
+        for n, (node, code) in enumerate(zip(nodes, codes)):
+            f.write("{} {:.3f} {:.3f} {:.3f} {}\n".format(n + 1, node[0], node[1], node[2], code))
+        f.write("{} {} {}\n".format(len(elements), elements.shape[1], 21 if triangles else 25))
+        for n, element in enumerate(elements):
+            f.write("{} {}\n".format(n + 1, " ".join(str(k) for k in element)))
+
+    return nodes, elements
+
+# makeDfsu
+# Writes max depth and animated direction dfsu files on a synthetic mesh, like the test files from MIKE
+#
+# Example usage:
+#   max_dfsu, animated_dfsu = makeDfsu("benchmark_data", 10000, n_timesteps=20)
+#
+def makeDfsu(folder, n_elements, n_timesteps=10, triangles=True):
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    name = "{}_{}".format("tri" if triangles else "quad", n_elements)
+    mesh_file = os.path.join(folder, "{}.mesh".format(name))
+    max_dfsu = os.path.join(folder, "{}_max.dfsu".format(name))
+    animated_dfsu = os.path.join(folder, "{}_animated.dfsu".format(name))
+
+    if os.path.exists(max_dfsu) and os.path.exists(animated_dfsu):
+        return max_dfsu, animated_dfsu
+
+    makeMesh(mesh_file, n_elements, triangles=triangles)
+    dfs = Dfsu(mesh_file)
+    xy = dfs.element_coordinates[:, :2] - [X0, Y0]
+    rng = np.random.default_rng(n_elements)
+
+    depth = 0.5 + 0.4*np.sin(xy[:, 0]/50.0)*np.cos(xy[:, 1]/70.0) + 0.05*rng.random(len(xy))
+    ds = Dataset([depth[np.newaxis, :].astype(np.float32)],
+                 pd.date_range("2020-01-01", periods=1, freq="H"),
+                 [ItemInfo("Maximum water depth", EUMType.Water_Depth, EUMUnit.meter)])
+    dfs.write(max_dfsu, ds)
+
+    phase = np.arange(n_timesteps)[:, np.newaxis]*0.1
+    direction = np.mod(np.arctan2(xy[:, 1], xy[:, 0] + 1.0)[np.newaxis, :] + phase, 2*np.pi)
+    ds = Dataset([direction.astype(np.float32)],
+                 pd.date_range("2020-01-01", periods=n_timesteps, freq="H"),
+                 [ItemInfo("Current direction", EUMType.Current_Direction, EUMUnit.radian)])
+    dfs.write(animated_dfsu, ds)
+
+    return max_dfsu, animated_dfsu
@@ -0,0 +1,168 @@
+# This module includes a reader for ESRI ASCII grids (.asc), as exported by MIKE, that parses the
+# text in blocks of rows straight into numpy without going through GDAL or ArcGIS
+
+import glob
+import itertools
+import logging
+import os
+import numpy as np
+
+# Number of grid rows parsed at a time
+BLOCK_ROWS = 1024
+
+# Reads the header of an ESRI ASCII grid
+#
+# Returns (header dict with lower case keys, number of header lines)
+def read_header(asc_file):
+
+    header = {}
+    n_lines = 0
+    with open(asc_file, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) != 2 or not parts[0][0].isalpha():
+                break
+            header[parts[0].lower()] = float(parts[1])
+            n_lines += 1
+
+    for key in ["ncols", "nrows"]:
+        if key not in header:
+            raise ValueError("{} is missing {} in its header.".format(asc_file, key))
+    header["ncols"] = int(header["ncols"])
+    header["nrows"] = int(header["nrows"])
+
+    return header, n_lines
+
+# Returns the GDAL geotransform of an ESRI ASCII grid from its header
+def header_geotransform(header):
+
+    dx = header.get("dx", header.get("cellsize"))
+    dy = header.get("dy", header.get("cellsize"))
+    if dx is None or dy is None:
+        raise ValueError("Header has no cellsize.")
+
+    # llcenter headers give the centre of the lower left cell instead of its corner
+    x0 = header["xllcorner"] if "xllcorner" in header else header["xllcenter"] - dx/2
+    y0 = header["yllcorner"] if "yllcorner" in header else header["yllcenter"] - dy/2
+
+    return (x0, dx, 0.0, y0 + header["nrows"]*dy, 0.0, -dy)
+
+# Yields (row, block) for an ESRI ASCII grid, where block is a float32 array of up to block_rows
+# rows starting at row, with NaN for NODATA_value. Only one block is held in memory at a time.
+#
+# Example usage:
+#   for row, z in iter_blocks("depth.asc"):
+#       ...
+#
+def iter_blocks(asc_file, block_rows=BLOCK_ROWS):
+
+    header, n_header = read_header(asc_file)
+    nx, ny = header["ncols"], header["nrows"]
+    nodata = header.get("nodata_value")
+
+    with open(asc_file, "r") as f:
+        for _ in range(n_header):
+            f.readline()
+
+        leftover = np.empty(0, dtype=np.float32)
+        for row in range(0, ny, block_rows):
+            needed = min(block_rows, ny - row)*nx
+
+            # grid rows are normally one line each, but some writers wrap them over several lines
+            values = [leftover]
+            count = leftover.size
+            while count < needed:
+                lines = list(itertools.islice(f, max(1, (needed - count)//nx)))
+                if not lines:
+                    raise ValueError("{} ends before row {}.".format(asc_file, row + count//nx))
+                parsed = np.fromstring("".join(lines), dtype=np.float32, sep=" ")
+                values.append(parsed)
+                count += parsed.size
+            values = np.concatenate(values)
+            z, leftover = values[:needed], values[needed:]
+
+            if nodata is not None:
+                z[z == np.float32(nodata)] = np.nan
+            yield row, z.reshape(-1, nx)
+
+# Returns the projection of an ESRI ASCII grid as wkt from its .prj side car file, or "" if it has none
+def read_projection(asc_file):
+
+    prj_file = os.path.splitext(asc_file)[0] + ".prj"
+    if not os.path.exists(prj_file):
+        return ""
+
+    from osgeo import osr
+
+    with open(prj_file, "r") as f:
+        prj = f.read()
+    srs = osr.SpatialReference()
+    if srs.ImportFromESRI([prj]) != 0 and srs.SetFromUserInput(prj) != 0:
+        return ""
+
+    return srs.ExportToWkt()
+
+# Returns path of the binary cache of an ESRI ASCII grid. The file's mtime is part of the name,
+# so editing or replacing the asc file makes its old cache unused.
+def cache_path(asc_file):
+    return "{}.{}.npy".format(asc_file, os.stat(asc_file).st_mtime_ns)
+
+# read_asc
+# Reads an ESRI ASCII grid as a float32 array with NaN for NODATA_value. With cache=True the array
+# is saved next to the asc file as .npy, and later reads of the same unchanged file load that instead
+# of parsing the text.
+#
+# Example usage:
+#   z, geotransform, wkt = read_asc("depth.asc", cache=True)
+#
+# Returns (array, geotransform, projection wkt), like rasters.read_raster
+#
+def read_asc(asc_file, cache=False, block_rows=BLOCK_ROWS):
+
+    header, _ = read_header(asc_file)
+    geotransform = header_geotransform(header)
+    wkt = read_projection(asc_file)
+
+    if cache:
+        cache_file = cache_path(asc_file)
+        if os.path.exists(cache_file):
+            logging.debug("Reading {} from cache {}".format(asc_file, cache_file))
+            return np.load(cache_file), geotransform, wkt
+
+    z = np.empty((header["nrows"], header["ncols"]), dtype=np.float32)
+    for row, block in iter_blocks(asc_file, block_rows):
+        z[row:row + block.shape[0]] = block
+
+    if cache:
+        for old_cache in glob.glob(glob.escape(asc_file) + ".*.npy"):
+            os.remove(old_cache)
+        np.save(cache_file, z)
+
+    return z, geotransform, wkt
+
+# write_asc
+# Writes a 2-D array as an ESRI ASCII grid, block_rows rows at a time. NaN is written as nodata.
+# Non square cells are written with DX and DY, which GDAL reads but ArcGIS doesn't.
+#
+# Example usage:
+#   write_asc("direction.asc", z, geotransform)
+#
+def write_asc(asc_file, z, geotransform, nodata=-9999, block_rows=BLOCK_ROWS):
+
+    ny, nx = z.shape
+    dx, dy = geotransform[1], -geotransform[5]
+    if np.isclose(dx, dy, rtol=1e-9, atol=0):
+        cellsize = "cellsize      {!r}\n".format(float(dx))
+    else:
+        cellsize = "dx            {!r}\ndy            {!r}\n".format(float(dx), float(dy))
+
+    with open(asc_file, "w") as f:
+        f.write("ncols         {}\n".format(nx))
+        f.write("nrows         {}\n".format(ny))
+        f.write("xllcorner     {!r}\n".format(float(geotransform[0])))
+        f.write("yllcorner     {!r}\n".format(float(geotransform[3] - ny*dy)))
+        f.write(cellsize)
+        f.write("NODATA_value  {}\n".format(nodata))
+        for row in range(0, ny, block_rows):
+            block = z[row:row + block_rows]
+            np.savetxt(f, np.where(np.isnan(block), nodata, block), fmt="%.6g")
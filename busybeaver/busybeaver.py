@@ -1,9 +1,54 @@
+import contextlib
+import cProfile
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import busybeaver.processes as proc
-
-logging.basicConfig(filename='bb.log', filemode='w', format='%(asctime)s - %(levelname)s: %(message)s', 
-                    datefmt='%m/%d/%Y %I:%M:%S %p', level=logging.INFO)
+import busybeaver.gdalprocesses as gdalproc
+import busybeaver.meshcache as bbmesh
+import busybeaver.discovery as bbdiscovery
+from busybeaver.instrument import RSSSampler, RunReport, measurement, snapshot
+from busybeaver.manifest import Manifest, fingerprintPath, fingerprintProcess
+
+# Params naming the intermediate rasters in a model's GDB, clipped by processClipResults
+GDB_RASTERS = ["2D_DEPTH_GDB_NAME", "2D_VELOCITY_GDB_NAME", "2D_DIRECTION_GDB_NAME",
+               "RIVER_DEPTH_GDB_NAME", "FULL_DEPTH_GDB_NAME"]
+
+# Log file written by runs, see setupLogging
+LOG_FILE = "bb.log"
+
+# Logs to LOG_FILE, unless logging is already set up (by the caller, or by _initWorker in a pool
+# worker). Called by the entry points (creating a Hut or Model, runAll, Model.run) and not on import,
+# since pool workers started with spawn or forkserver import busybeaver again and would otherwise
+# truncate the log of the run in progress. Workers get models by pickling, which doesn't call these.
+def setupLogging(log_file=LOG_FILE, level=logging.INFO):
+    logging.basicConfig(filename=log_file, filemode='w', format='%(asctime)s - %(levelname)s: %(message)s', 
+                        datefmt='%m/%d/%Y %I:%M:%S %p', level=level)
+
+# Sends log records of pool workers through a queue to the handlers of this process, so only
+# this process writes to the log file and lines don't get mixed up.
+#
+# Example usage:
+#   with workerLogging() as (initializer, initargs):
+#       with ProcessPoolExecutor(max_workers=2, initializer=initializer, initargs=initargs) as pool:
+#           ...
+#
+@contextlib.contextmanager
+def workerLogging():
+
+    manager = multiprocessing.Manager()
+    queue = manager.Queue()
+    listener = logging.handlers.QueueListener(queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+
+    try:
+        yield _initWorker, (queue, logging.getLogger().level)
+    finally:
+        listener.stop()
+        manager.shutdown()
 
 class Hut:
     """
@@ -14,6 +59,7 @@ class Hut:
     """
     def __init__(self):
       
+        setupLogging()
         logging.info("Created new Hut.")
         self.models = []
 
@@ -40,22 +86,126 @@ class Hut:
         for model in self.models:
             model.params[param] = value
 
-    # add a way to find relevant asc files for model
-    # regex example: .*mymodel.*depth.*asc$ .... finds any paths with mymodel and depth in it which ends in .asc
-    # this function also might be better placed in the Model object
+    # Fills params of the models from files found in folders, e.g. DEPTH_2D_ASC and DFSU_RESULTS_MAX.
+    # The folders are scanned once and each file is matched to a model and param key by patterns
+    # (see busybeaver.discovery), instead of searching the folders again for every model.
+    # Model names are matched ignoring case. With add_models=True models are added for names that
+    # aren't in the hut yet. With index_file the folder listings are kept between runs, so only
+    # folders which changed are listed again.
+    #
+    # Example usage:
+    #   hut.findFiles("//server/results", {"DEPTH_2D_ASC" : "**/{model}_depth.asc",
+    #                                      "DFSU_RESULTS_MAX" : r"(?P<model>[^/]+)/max\.dfsu$"})
+    #
+    # Returns dict of model name to dict of param key to path of everything found
+    def findFiles(self, folders, patterns, index_file=None, add_models=False):
+        found = bbdiscovery.findFiles(folders, patterns, index_file)
+        models = {model.name.lower() : model for model in self.models}
+        for name, params in found.items():
+            model = models.get(name.lower())
+            if model is None:
+                if not add_models:
+                    continue
+                model = Model(name)
+                self.models.append(model)
+                models[name.lower()] = model
+            model.params.update(params)
+        return found
 
     # adds same auto process to all models in hut
     def addAutoAll(self, process):
         for model in self.models:
             model.addProcessAuto(process)
     
-    def runAll(self):
+    # Runs the runstack of every model.
+    #
+    # With workers=N each model is sent to a pool of N processes. Every model's runstack still
+    # runs in order inside one worker, and since each worker is its own process it has its own
+    # arcpy.env.workspace. Log records from the workers go through a queue and are written to
+    # bb.log by this process only, so lines don't get mixed up.
+    #
+    # Results of each process are kept in self.results by model name. When running in parallel
+    # a failed model doesn't stop the others, its traceback is kept in self.errors by model name.
+    #
+    # With incremental=True processes whose inputs and outputs haven't changed since their last run
+    # are skipped (see Model.run).
+    #
+    # Wall time, CPU time, peak resident memory and bytes read/written of every process are kept in
+    # self.report (see busybeaver.instrument.RunReport). Processes named in profile are also run
+    # under cProfile, saving <model name>_<process name>.prof in profile_dir.
+    def runAll(self, workers=None, incremental=False, hash_contents=False, profile=(), profile_dir="."):
+        setupLogging()
         logging.info("Starting to run processs for all models.")
+        self.results = {}
+        self.errors = {}
+        self.report = RunReport()
+
         for model in self.models:
-            logging.info("Running processs for {}...".format(model.name))
-            for proc in model.runstack:
-                proc.run()
+            for process in model.runstack:
+                if process.name in profile:
+                    process.profile_file = os.path.abspath(os.path.join(profile_dir, "{}_{}.prof".format(model.name, process.name)))
+
+        try:
+            if workers is None or workers <= 1:
+                for model in self.models:
+                    logging.info("Running processs for {}...".format(model.name))
+                    try:
+                        self.results[model.name] = model.run(incremental=incremental, hash_contents=hash_contents)
+                    finally:
+                        self.report.addModel(model)
+            else:
+                self._runParallel(workers, incremental, hash_contents)
+        finally:
+            # meshes shared between the models are only kept for this run
+            bbmesh.clear()
+
         logging.info("Finished running processes for all models.")
+        return self.results
+
+    def _runParallel(self, workers, incremental=False, hash_contents=False):
+
+        with workerLogging() as (initializer, initargs):
+            with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+                futures = [(model.name, pool.submit(runModel, model, incremental, hash_contents)) for model in self.models]
+                for name, future in futures:
+                    try:
+                        name, results, error, stats = future.result()
+                    except Exception:
+                        # e.g. model couldn't be sent to the worker
+                        results, error, stats = [], traceback.format_exc(), []
+                    self.results[name] = results
+                    for process_name, process_stats in stats:
+                        self.report.add(name, process_name, process_stats)
+                    if error is not None:
+                        self.errors[name] = error
+                        logging.error("Model {} failed:\n{}".format(name, error))
+
+# Sets up logging in a worker process so records are sent to the main process
+def _initWorker(queue, level):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(level)
+
+# Runs every process in a model's runstack in order
+#
+# Returns (model name, list of process results, traceback of failed process or None,
+#          list of (process name, measurements))
+def runModel(model, incremental=False, hash_contents=False):
+    logging.info("Running processs for {}...".format(model.name))
+    error = None
+    try:
+        model.run(incremental=incremental, hash_contents=hash_contents)
+    except Exception:
+        error = traceback.format_exc()
+    stats = [(process.name, process.stats) for process in model.runstack]
+    return model.name, model.results, error, stats
+
+# Runs a process and returns (result, measurements), used to get measurements back from pools
+def runProcess(process):
+    result = process.run()
+    return result, process.stats
 
 # Allows iterating over Hut to get models      
 class HutIterator:
@@ -81,20 +231,24 @@ class Model:
     """
     def __init__(self, model_name):
         
+        setupLogging()
         logging.info("Created model: {}.".format(model_name))
         self.name = model_name
         self.runstack = []
+        self.results = []
         self.params = {
                 "MODEL_GDB_PATH" : None,           # Path to folder with the model's GDB (saves output to .gdb in this folder)
                 "DFSU_REULTS_ANIMATED" : None,     # animated dfsu results from MIKE
                 "DFSU_RESULTS_MAX" : None,         # max dfsu results from MIKE
                 "DFSU_RESULTS_DIRECTION" : None,   # Output location for extractDirectionFromDfsu
+                "DFSU_RESULTS_VECTORS" : None,     # Output location for speed and direction products of processVectorDirection
                 "DEPTH_2D_ASC" : None,             # MIKE 2d max depth in asc format
                 "DEPTH_RIVER_ASC" : None,          # MIKE river max depth in asc format
                 "VELOCITY_2D_ASC" : None,          # MIKE 2d max velocity in asc format
                 "DIRECTION_2D_ASC" : None,         # MIKE 2d direction in asc format
                 "MODEL_BOUNDARY_POLYGON" : None,   # Boundaries to clip model results to
                 "DIRECTION_TIMESTEP" : None,       # Integer timestep to extract direction from dfsu in model
+                "DIRECTION_PRODUCT" : "max_speed_direction", # Direction written to DIRECTION_2D_ASC by processVectorDirection, or "mean_direction"
                 "2D_DEPTH_TIF_NAME" : None,        # Name of 2d depth raster (exclusing river) in tif format
                 "2D_DEPTH_GDB_NAME" : None,        # Name of 2d depth raster (exclusing river) in gdb
                 "2D_VELOCITY_GDB_NAME" : None,     # Name of 2d velocity raster (exclusing river) in gdb ... unclipped
@@ -107,6 +261,11 @@ class Model:
                 "CLIP_FIELD" : None,               # Name of column in attribute table of MODEL_BOUNDARY_POLYGON
                 "CLIP_VALUE" : None,               # Value in CLIP_FIELD to use as clip olygon
                 "CRS" : None,                      # Coordinate system string for all rasters (e.g. 'ETRS 1989 UTM Zone 32N')
+                "GRIDDING_BACKEND" : "gdal",       # Backend for dfsuToTif, "gdal", "numpy" or "mesh"
+                "PLAN_CACHE" : None,               # Folder to keep the weights of the numpy and mesh gridding backends between runs
+                "BACKEND" : "arcpy",               # Backend for gdb processes, "arcpy" or "gdal" (gdb is then a folder of tifs)
+                "ASC_CACHE" : False,               # Keep .npy caches of asc files for processFusedRasters (gdal backend only)
+                "COG_PATH" : None,                 # Folder for Cloud Optimized GeoTIFFs of the final rasters (default <gdb>_cog next to MODEL_GDB_PATH)
         }
 
         # defaults
@@ -120,15 +279,29 @@ class Model:
         self.params["FINAL_DIRECTION_GDB_NAME"] = "{}_Direction".format(self.name)
 
     # Adds a raw python function and arguments to runstack
-    def addProcess(self, name, func, *args):
+    #   inputs and outputs are optional lists of param keys/artefacts the function reads and
+    #   writes (see Process). Without them the process runs after everything before it and
+    #   before everything after it.
+    def addProcess(self, name, func, *args, inputs=None, outputs=None):
         logging.debug("Adding process to runstack of model {}: {}".format(self.name, name))
-        self.runstack.append(Process(name, func, *args))
+        self.runstack.append(Process(name, func, *args, inputs=inputs, outputs=outputs))
         
 
     # Adds a process that automatically fills arguments.
     #   e.g. model.addProcessAuto("extractDirectionFromDfsu")
     def addProcessAuto(self, name):
 
+        # gdb processes from arcpy or from their GDAL versions
+        backend = self.backend()
+
+        # fused process writes tifs, so only works with a gdal raster folder
+        if name == "processFusedRasters" and backend is not gdalproc:
+            raise ValueError("processFusedRasters needs BACKEND set to gdal.")
+
+        # COGs are converted from the tifs of a gdal raster folder
+        if name == "processCOG" and backend is not gdalproc:
+            raise ValueError("processCOG needs BACKEND set to gdal.")
+
         # Map of auto process name to function and arguments
         PROCESSES = {
                         "extractDirectionFromDfsu" : 
@@ -137,13 +310,20 @@ class Model:
                                 self.params["DFSU_RESULTS_DIRECTION"], 
                                 self.params["DIRECTION_TIMESTEP"]],
 
+                        "processVectorDirection" : 
+                            [proc.vectorProductsFromDfsu, 
+                                self.params["DFSU_REULTS_ANIMATED"], 
+                                self.params["DFSU_RESULTS_VECTORS"], 
+                                self.params["DIRECTION_2D_ASC"],
+                                self.params["DIRECTION_PRODUCT"]],
+
                         "createGDB" : 
-                            [proc.createGDB,
+                            [backend.createGDB,
                                 self.params["MODEL_GDB_PATH"],
                                 self.name], 
 
                         "processASC_2DDepth" : 
-                            [proc.ascToGDB, 
+                            [backend.ascToGDB, 
                                 self.params["DEPTH_2D_ASC"], 
                                 self.params["MODEL_GDB_PATH"], 
                                 self.params["2D_DEPTH_GDB_NAME"]],    
@@ -153,47 +333,49 @@ class Model:
                                 self.params["DFSU_RESULTS_MAX"], 
                                 "Maximum water depth", 
                                 0, # what is this zero for?
-                                self.params["2D_DEPTH_TIF_NAME"]],
+                                self.params["2D_DEPTH_TIF_NAME"],
+                                self.params["GRIDDING_BACKEND"],
+                                self.params["PLAN_CACHE"]],
 
                         "processASC_2DVelocity" : 
-                            [proc.ascToGDB, 
+                            [backend.ascToGDB, 
                                 self.params["VELOCITY_2D_ASC"], 
                                 self.params["MODEL_GDB_PATH"], 
                                 self.params["2D_VELOCITY_GDB_NAME"]],   
 
                         "processASC_2DDirection" : 
-                            [proc.ascToGDB, 
+                            [backend.ascToGDB, 
                                 self.params["DIRECTION_2D_ASC"], 
                                 self.params["MODEL_GDB_PATH"], 
                                 self.params["2D_DIRECTION_GDB_NAME"]],   
 
                         "processASC_RiverDepth" : 
-                            [proc.ascToGDB, 
+                            [backend.ascToGDB, 
                                 self.params["DEPTH_RIVER_ASC"], 
                                 self.params["MODEL_GDB_PATH"], 
                                 self.params["RIVER_DEPTH_GDB_NAME"]],  
 
                         "processClipResults" : 
-                            [proc.clipAllRasters, 
+                            [backend.clipAllRasters, 
                                 self.params["MODEL_GDB_PATH"], 
                                 self.params["MODEL_BOUNDARY_POLYGON"],
                                 self.params["CLIP_FIELD"], 
                                 self.params["CLIP_VALUE"]],  
 
                         "processCRS" : 
-                            [proc.setCRS, 
+                            [backend.setCRS, 
                                 self.params["MODEL_GDB_PATH"], 
                                 self.params["CRS"]],  
 
                         "processMergeRiver2DDepth" : 
-                            [proc.mergeRasters, 
+                            [backend.mergeRasters, 
                                 self.params["2D_DEPTH_GDB_NAME"], 
                                 self.params["RIVER_DEPTH_GDB_NAME"], 
                                 self.params["FULL_DEPTH_GDB_NAME"], 
                                 self.params["MODEL_GDB_PATH"]],
 
                         "processcleanRasters" : 
-                            [proc.cleanRasters, 
+                            [backend.cleanRasters, 
                                 self.params["MODEL_GDB_PATH"], 
                                 self.params["FULL_DEPTH_GDB_NAME"],
                                 self.params["2D_VELOCITY_GDB_NAME"],
@@ -202,28 +384,293 @@ class Model:
                                 self.params["FINAL_VELOCITY_GDB_NAME"],
                                 self.params["FINAL_DIRECTION_GDB_NAME"]],
 
+                        "processFusedRasters" : 
+                            [gdalproc.fusedRasters, 
+                                self.params["MODEL_GDB_PATH"],
+                                self.params["DEPTH_2D_ASC"],
+                                self.params["DEPTH_RIVER_ASC"],
+                                self.params["VELOCITY_2D_ASC"],
+                                self.params["DIRECTION_2D_ASC"],
+                                self.params["MODEL_BOUNDARY_POLYGON"],
+                                self.params["CLIP_FIELD"],
+                                self.params["CLIP_VALUE"],
+                                self.params["CRS"],
+                                self.params["FINAL_DEPTH_GDB_NAME"],
+                                self.params["FINAL_VELOCITY_GDB_NAME"],
+                                self.params["FINAL_DIRECTION_GDB_NAME"],
+                                self.params["ASC_CACHE"]],
+
+                        "processCOG" : 
+                            [gdalproc.cogRasters, 
+                                self.params["MODEL_GDB_PATH"],
+                                self.params["COG_PATH"],
+                                self.params["FINAL_DEPTH_GDB_NAME"],
+                                self.params["FINAL_VELOCITY_GDB_NAME"],
+                                self.params["FINAL_DIRECTION_GDB_NAME"]],
+
                         "OP_FOR_TESTING_ONLY" : 
                             [proc.FOR_TESTING_ONLY, 
                                 self.params["DEPTH_2D_ASC"], 
                                 self.params["MODEL_BOUNDARY_POLYGON"]]
                     }
 
+        # Param keys/artefacts each auto process reads and writes, used to work out which processes
+        # can run at the same time. CLIPPED_RASTERS stands for the _CLIPPED copies in the GDB.
+        FINAL_RASTERS = ["FINAL_DEPTH_GDB_NAME", "FINAL_VELOCITY_GDB_NAME", "FINAL_DIRECTION_GDB_NAME"]
+        DEPENDENCIES = {
+                        "extractDirectionFromDfsu" : (["DFSU_REULTS_ANIMATED"], ["DFSU_RESULTS_DIRECTION"]),
+                        "processVectorDirection" : (["DFSU_REULTS_ANIMATED"], ["DFSU_RESULTS_VECTORS", "DIRECTION_2D_ASC"]),
+                        "createGDB" : ([], ["MODEL_GDB_PATH"]),
+                        "processASC_2DDepth" : (["DEPTH_2D_ASC", "MODEL_GDB_PATH"], ["2D_DEPTH_GDB_NAME"]),
+                        "processTIF_2DDepth" : (["DFSU_RESULTS_MAX"], ["2D_DEPTH_TIF_NAME"]),
+                        "processASC_2DVelocity" : (["VELOCITY_2D_ASC", "MODEL_GDB_PATH"], ["2D_VELOCITY_GDB_NAME"]),
+                        "processASC_2DDirection" : (["DIRECTION_2D_ASC", "MODEL_GDB_PATH"], ["2D_DIRECTION_GDB_NAME"]),
+                        "processASC_RiverDepth" : (["DEPTH_RIVER_ASC", "MODEL_GDB_PATH"], ["RIVER_DEPTH_GDB_NAME"]),
+                        "processClipResults" : (["MODEL_GDB_PATH", "MODEL_BOUNDARY_POLYGON"] + GDB_RASTERS, ["CLIPPED_RASTERS"]),
+                        "processCRS" : (["MODEL_GDB_PATH", "CLIPPED_RASTERS"] + GDB_RASTERS, ["CLIPPED_RASTERS"] + GDB_RASTERS),
+                        "processMergeRiver2DDepth" : (["MODEL_GDB_PATH", "2D_DEPTH_GDB_NAME", "RIVER_DEPTH_GDB_NAME"], ["FULL_DEPTH_GDB_NAME"]),
+                        "processcleanRasters" : (["MODEL_GDB_PATH", "CLIPPED_RASTERS"] + GDB_RASTERS, ["CLIPPED_RASTERS"] + GDB_RASTERS + FINAL_RASTERS),
+                        "processFusedRasters" : (["MODEL_GDB_PATH", "DEPTH_2D_ASC", "DEPTH_RIVER_ASC", "VELOCITY_2D_ASC",
+                                                  "DIRECTION_2D_ASC", "MODEL_BOUNDARY_POLYGON"], FINAL_RASTERS),
+                        "processCOG" : (["MODEL_GDB_PATH"] + FINAL_RASTERS, ["COG_PATH"]),
+                        "OP_FOR_TESTING_ONLY" : (["DEPTH_2D_ASC", "MODEL_BOUNDARY_POLYGON"], []),
+                    }
+
         logging.debug("Adding process to runstack of model {}: {}".format(self.name, name))
-        self.runstack.append(Process(name, PROCESSES[name][0], *PROCESSES[name][1:]))  
+        inputs, outputs = DEPENDENCIES[name]
+        self.runstack.append(Process(name, PROCESSES[name][0], *PROCESSES[name][1:], inputs=inputs, outputs=outputs))
+
+    # Returns a set of runstack indexes each process has to wait for
+    #
+    # A process waits for the last process writing any of its inputs, and for the processes reading
+    # or writing its outputs since then, so independent processes can run at the same time while
+    # the runstack order of e.g. merge -> clip -> clean is kept.
+    def dependencies(self):
+
+        deps = []
+        last_writer = {}
+        readers = {}
+        barrier = None
+        since_barrier = []
+
+        for i, process in enumerate(self.runstack):
+            waits = set()
+            if barrier is not None:
+                waits.add(barrier)
+
+            if process.inputs is None or process.outputs is None:
+                # undeclared processes keep their place in the runstack
+                waits.update(since_barrier)
+                barrier = i
+                since_barrier = []
+                last_writer = {}
+                readers = {}
+            else:
+                for artefact in process.inputs:
+                    if artefact in last_writer:
+                        waits.add(last_writer[artefact])
+                for artefact in process.outputs:
+                    if artefact in last_writer:
+                        waits.add(last_writer[artefact])
+                    waits.update(readers.get(artefact, []))
+                for artefact in process.inputs:
+                    readers.setdefault(artefact, []).append(i)
+                for artefact in process.outputs:
+                    last_writer[artefact] = i
+                    readers[artefact] = []
+                since_barrier.append(i)
+
+            waits.discard(i)
+            deps.append(waits)
+
+        return deps
+
+    # Runs the runstack and returns the result of each process in runstack order.
+    #
+    # With workers=N processes which don't depend on each other (see dependencies) run at the same
+    # time on a pool of N workers. pool="process" keeps arcpy's global environment separate for
+    # each process, pool="thread" avoids pickling and suits GDAL/numpy processes. The first error
+    # stops new processes from starting and is raised once running processes finish.
+    #
+    # With incremental=True, a process is skipped (result None) if its args, the files they point
+    # to and its output files are the same as when it last ran, and nothing it depends on ran.
+    # Fingerprints are kept in a manifest next to MODEL_GDB_PATH (see busybeaver.manifest).
+    # hash_contents=True also compares file contents, not just mtime and size.
+    #
+    # Results so far are kept in self.results, so they are available if a process fails.
+    def run(self, workers=None, pool="process", incremental=False, hash_contents=False):
+
+        setupLogging()
+        deps = self.dependencies()
+        manifest = Manifest.forModel(self) if incremental else None
+        for process in self.runstack:
+            process.stats = None
+        self.results = [None]*len(self.runstack)
+        done = set()
+        ran = set()
+
+        stale = self._staleProcesses(deps, manifest, hash_contents) if manifest is not None else None
+
+        # returns True if process i has to run, skipped processes are marked done
+        def needsRun(i):
+            if manifest is None or i in stale or deps[i] & ran:
+                return True
+            logging.info("Skipping {}, up to date.".format(self.runstack[i].name))
+            done.add(i)
+            return False
+
+        def finished(i, result):
+            self.results[i] = result
+            done.add(i)
+            ran.add(i)
+            if manifest is not None:
+                manifest.record(self._manifestKey(i), self._fingerprint(i, hash_contents))
+
+        if workers is None or workers <= 1:
+            for i, process in enumerate(self.runstack):
+                if needsRun(i):
+                    finished(i, process.run())
+            self._recordAll(manifest, hash_contents)
+            return self.results
+
+        running = {}
+        error = None
+
+        with contextlib.ExitStack() as stack:
+            if pool == "process":
+                initializer, initargs = stack.enter_context(workerLogging())
+                executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs))
+            else:
+                executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+            while len(done) < len(self.runstack):
+                if error is None:
+                    for i, process in enumerate(self.runstack):
+                        if i not in done and i not in running.values() and deps[i] <= done and needsRun(i):
+                            running[executor.submit(runProcess, process)] = i
+                    # skipping may have made more processes ready
+                    if not running and len(done) < len(self.runstack):
+                        continue
+                if not running:
+                    break
+                finished_futures, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished_futures:
+                    i = running.pop(future)
+                    try:
+                        result, self.runstack[i].stats = future.result()
+                        finished(i, result)
+                    except Exception as e:
+                        error = error or e
+                        done.add(i)
+
+        if error is not None:
+            raise error
+
+        self._recordAll(manifest, hash_contents)
+        return self.results
+
+    def _manifestKey(self, i):
+        return "{}:{}".format(i, self.runstack[i].name)
+
+    def _fingerprint(self, i, hash_contents=False):
+        process = self.runstack[i]
+        return fingerprintProcess(process, self._outputFingerprints(process, hash_contents), hash_contents)
+
+    # Returns indexes of the processes which have to run on an incremental run: those whose args,
+    # files or outputs changed since the end of their last run, and the processes they depend on
+    # whose outputs are gone, e.g. intermediate rasters deleted by processcleanRasters, so they are
+    # made again first. Processes depending on any of these run as well (see run).
+    def _staleProcesses(self, deps, manifest, hash_contents=False):
+
+        stale = [i for i in range(len(self.runstack))
+                 if not manifest.isUpToDate(self._manifestKey(i), self._fingerprint(i, hash_contents))]
+        todo = list(stale)
+        stale = set(stale)
+        while todo:
+            for j in deps[todo.pop()]:
+                if j not in stale and None in self._outputFingerprints(self.runstack[j]).values():
+                    stale.add(j)
+                    todo.append(j)
+
+        return stale
+
+    # Fingerprints every process once the whole runstack has run, so outputs later processes
+    # delete or change on purpose (e.g. rasters renamed by processcleanRasters) count as up to date
+    def _recordAll(self, manifest, hash_contents=False):
+        if manifest is None:
+            return
+        for i in range(len(self.runstack)):
+            manifest.entries[self._manifestKey(i)] = self._fingerprint(i, hash_contents)
+        manifest.save()
+
+    # Returns dict of location to fingerprint (None if missing) of the outputs of a process. Output
+    # params holding paths are fingerprinted as files, raster names (*_GDB_NAME, and the _CLIPPED
+    # copies for CLIPPED_RASTERS) as rasters in MODEL_GDB_PATH of the model's backend.
+    def _outputFingerprints(self, process, hash_contents=False):
+
+        gdb_path = self.params.get("MODEL_GDB_PATH")
+        outputs = {}
+        for key in process.outputs or []:
+            if key == "CLIPPED_RASTERS":
+                names = ["{}_CLIPPED".format(self.params[k]) for k in GDB_RASTERS if isinstance(self.params.get(k), str)]
+            elif key.endswith("_GDB_NAME"):
+                names = [self.params[key]] if isinstance(self.params.get(key), str) else []
+            else:
+                if isinstance(self.params.get(key), str):
+                    outputs[os.path.abspath(self.params[key])] = fingerprintPath(self.params[key], hash_contents)
+                continue
+            if not isinstance(gdb_path, str):
+                continue
+            for name in names:
+                location = "{}:{}".format(os.path.abspath(gdb_path), name)
+                outputs[location] = self.backend().rasterFingerprint(gdb_path, name, hash_contents)
+
+        return outputs
+
+    # Returns the module with the gdb processes of the model's BACKEND
+    def backend(self):
+        if self.params["BACKEND"] == "gdal":
+            return gdalproc
+        elif self.params["BACKEND"] == "arcpy":
+            return proc
+        raise ValueError("Unknown backend: {}".format(self.params["BACKEND"]))
 
 class Process:
     """
     A class for holding information related to a single function to be run.
 
+    inputs and outputs are lists of param keys or artefact names the function reads and writes,
+    None if unknown.
+
     Usage example:
     my_process = Process("process_name", function, *args)
+    my_process = Process("process_name", function, *args, inputs=["DEPTH_2D_ASC"], outputs=["2D_DEPTH_GDB_NAME"])
+
+    After running, stats holds its wall time, CPU time, peak resident memory and bytes read/written.
+    If profile_file is set the process is run under cProfile and the profile saved there.
     """
 
-    def __init__(self, name, func, *args):
+    def __init__(self, name, func, *args, inputs=None, outputs=None):
         self.name = name
         self.func = func
         self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+        self.stats = None
+        self.profile_file = None
 
     def run(self):
         logging.info("Running {}...".format(self.name))
-        return self.func(*self.args)
+
+        profiler = cProfile.Profile() if self.profile_file else None
+        start = snapshot()
+        sampler = RSSSampler()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return self.func(*self.args)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_file)
+            self.stats = measurement(start, snapshot(), sampler.stop())
+            logging.info("Finished {} in {:.2f} s.".format(self.name, self.stats["wall_time"]))
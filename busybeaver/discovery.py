@@ -0,0 +1,186 @@
+# This module finds the result files of many models in one pass over the folders they are in.
+# Folders are listed with os.scandir and kept in an index, optionally saved as json, so later
+# scans only list folders whose mtime has changed. Files are mapped to models and param keys by
+# patterns, e.g. {"DEPTH_2D_ASC" : "**/{model}_depth.asc"}
+
+import json
+import logging
+import os
+import re
+
+class FileIndex:
+    """
+    Names of the files and sub folders of scanned folders, with the mtime of each folder when it
+    was listed. A folder's mtime changes when files are added, removed or renamed in it, so only
+    those folders are listed again on the next scan; the others cost one stat each.
+
+    Usage example:
+    index = FileIndex("C:/some/path/to/results_index.json")
+    paths = index.scan("//server/share/results")
+    index.save()
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.folders = {}
+        self.changed = False
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.folders = json.load(f)
+            except ValueError:
+                logging.warning("Ignoring unreadable file index {}.".format(filename))
+
+    # Returns sorted paths of all files under folder, listing only folders not in the index or
+    # changed since they were listed
+    def scan(self, folder):
+
+        folder = os.path.abspath(folder)
+        paths = []
+        stack = [folder]
+        n_listed = 0
+        while stack:
+            current = stack.pop()
+            try:
+                mtime = os.stat(current).st_mtime_ns
+            except OSError:
+                self._forget(current)
+                continue
+
+            entry = self.folders.get(current)
+            if entry is None or entry["mtime"] != mtime:
+                entry = self._list(current, mtime)
+                n_listed += 1
+
+            paths.extend(os.path.join(current, name) for name in entry["files"])
+            stack.extend(os.path.join(current, name) for name in entry["dirs"])
+
+        logging.info("Scanned {}, listed {} changed folders.".format(folder, n_listed))
+        return sorted(paths)
+
+    # Lists a folder into the index, dropping sub folders which are gone
+    def _list(self, folder, mtime):
+
+        files, dirs = [], []
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+
+        old = self.folders.get(folder)
+        if old is not None:
+            for name in set(old["dirs"]) - set(dirs):
+                self._forget(os.path.join(folder, name))
+
+        self.folders[folder] = {"mtime" : mtime, "files" : sorted(files), "dirs" : sorted(dirs)}
+        self.changed = True
+        return self.folders[folder]
+
+    # Drops a folder and everything under it from the index
+    def _forget(self, folder):
+        prefix = os.path.join(folder, "")
+        for key in [key for key in self.folders if key == folder or key.startswith(prefix)]:
+            del self.folders[key]
+            self.changed = True
+
+    def save(self):
+        if self.filename is None or not self.changed:
+            return
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.filename, "w") as f:
+            json.dump(self.folders, f)
+        self.changed = False
+
+# compilePattern
+# Compiles a file pattern to a regex with a "model" group. Regexes mark the model name with
+# (?P<model>...) and are searched for in the path. Glob patterns mark it with {model} and match
+# the whole path, with * and ? not crossing folders and **/ matching any number of folders.
+# Paths are relative to the scanned folder with / as separator, and case is ignored.
+#
+# Example usage:
+#   compilePattern("**/{model}/*depth*.asc")
+#   compilePattern(r"(?P<model>[^/]+)_max\.dfsu$")
+#
+def compilePattern(pattern):
+
+    if "(?P<model>" in pattern:
+        return re.compile(pattern, re.IGNORECASE)
+
+    if pattern.count("{model}") != 1:
+        raise ValueError("Pattern needs {{model}} once, or a regex with a (?P<model>...) group: {}".format(pattern))
+
+    regex = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("{model}", i):
+            regex.append("(?P<model>[^/]+?)")
+            i += len("{model}")
+        elif pattern.startswith("**/", i):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+
+    return re.compile("^{}$".format("".join(regex)), re.IGNORECASE)
+
+# matchFiles
+# Maps files to models and param keys. If several files match the same model and param the first
+# (sorted) is kept and the others are logged.
+#
+# Arg: paths, list of (path relative to scanned folder, full path)
+#      patterns, dict of param key to pattern (see compilePattern)
+#
+# Returns dict of model name to dict of param key to full path
+#
+def matchFiles(paths, patterns):
+
+    compiled = [(param, compilePattern(pattern)) for param, pattern in patterns.items()]
+    found = {}
+    for relative, path in paths:
+        relative = relative.replace(os.sep, "/")
+        for param, regex in compiled:
+            match = regex.search(relative)
+            if match is None:
+                continue
+            params = found.setdefault(match.group("model"), {})
+            if param in params:
+                logging.warning("Found more than one {} for model {}, keeping {} and not {}.".format(
+                    param, match.group("model"), params[param], path))
+            else:
+                params[param] = path
+
+    return found
+
+# findFiles
+# Scans folders once and maps the files in them to models and param keys. With index_file the
+# folder listings are kept between runs, so only changed folders are listed again.
+#
+# Example usage:
+#   found = findFiles(["//server/results"], {"DEPTH_2D_ASC" : "**/{model}_depth.asc",
+#                                            "DFSU_RESULTS_MAX" : "**/{model}_max.dfsu"})
+#
+# Returns dict of model name to dict of param key to full path
+#
+def findFiles(folders, patterns, index_file=None):
+
+    if isinstance(folders, str):
+        folders = [folders]
+
+    index = FileIndex(index_file)
+    paths = []
+    for folder in folders:
+        folder = os.path.abspath(folder)
+        paths.extend((os.path.relpath(path, folder), path) for path in index.scan(folder))
+    index.save()
+
+    return matchFiles(paths, patterns)
@@ -0,0 +1,493 @@
+# GDAL/numpy versions of the arcpy processes in busybeaver.processes, so the whole
+# addProcessAuto chain runs without an ArcGIS license (e.g. on linux workers).
+#
+# Functions take the same arguments as their arcpy counterparts. Instead of a file geodatabase,
+# the "gdb" is a folder with one GeoTIFF per raster, <gdb>/<raster name>.tif
+
+import numpy as np
+import gdal
+from osgeo import ogr
+import busybeaver.rasters as bbrasters
+import busybeaver.ascgrid as bbasc
+from busybeaver.manifest import Manifest, fingerprintPath
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import logging
+import functools
+
+# Returns path of a raster in a gdb folder
+def rasterPath(gdb_name, raster_name):
+    return os.path.join(gdb_name, "{}.tif".format(raster_name))
+
+# Returns names of all rasters in a gdb folder
+def listRasters(gdb_name):
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(gdb_name) if f.lower().endswith(".tif"))
+
+# Returns True if raster exists in a gdb folder
+def rasterExists(gdb_name, raster_name):
+    return raster_name is not None and os.path.exists(rasterPath(gdb_name, raster_name))
+
+# Returns a fingerprint of a raster in a gdb folder for incremental runs (see busybeaver.manifest),
+# or None if it doesn't exist
+def rasterFingerprint(gdb_name, raster_name, hash_contents=False):
+    return fingerprintPath(rasterPath(gdb_name, raster_name), hash_contents)
+
+# Deletes a raster and its side car files from a gdb folder
+def deleteRaster(gdb_name, raster_name):
+    gdal.GetDriverByName("GTiff").Delete(rasterPath(gdb_name, raster_name))
+
+# Renames a raster in a gdb folder, replacing any raster already with the new name
+def renameRaster(gdb_name, raster_name, new_name):
+    if rasterExists(gdb_name, new_name):
+        deleteRaster(gdb_name, new_name)
+    gdal.GetDriverByName("GTiff").Rename(rasterPath(gdb_name, new_name), rasterPath(gdb_name, raster_name))
+
+# Size in cells of the square blocks rasters are merged and clipped in. Peak memory of those
+# processes depends on this and not on the size of the rasters.
+BLOCK_SIZE = 1024
+
+# Opens a shapefile and returns (datasource, layer) filtered to features where clip_field equals field_value
+def openClipLayer(clip_shapefile, clip_field, field_value):
+
+    shp = ogr.Open(os.path.abspath(clip_shapefile))
+    if shp is None:
+        raise IOError("Could not open shapefile {}".format(clip_shapefile))
+    layer = shp.GetLayer()
+    layer.SetAttributeFilter("{}='{}'".format(clip_field, field_value))
+
+    return shp, layer
+
+# clipGeometry
+# Returns (wkb, envelope) of the polygon(s) in a shapefile where clip_field equals field_value, with
+# envelope as (xmin, xmax, ymin, ymax). Cached per shapefile, modification time, field and value, so
+# all rasters and all models sharing a boundary file in a process read it once.
+#
+def clipGeometry(clip_shapefile, clip_field, field_value):
+    clip_shapefile = os.path.abspath(clip_shapefile)
+    return cachedClipGeometry(clip_shapefile, os.stat(clip_shapefile).st_mtime_ns, clip_field, field_value)
+
+@functools.lru_cache(maxsize=32)
+def cachedClipGeometry(clip_shapefile, mtime, clip_field, field_value):
+
+    logging.debug("Reading clip polygon {} = {} from {}".format(clip_field, field_value, clip_shapefile))
+    shp, layer = openClipLayer(clip_shapefile, clip_field, field_value)
+    geom = ogr.Geometry(ogr.wkbGeometryCollection)
+    for feature in layer:
+        geom.AddGeometry(feature.GetGeometryRef())
+    layer = None
+    shp = None
+    if geom.GetGeometryCount() == 0:
+        raise ValueError("No polygon with {} = {} in {}".format(clip_field, field_value, clip_shapefile))
+
+    return bytes(geom.ExportToWkb()), geom.GetEnvelope()
+
+# Returns (xmin, xmax, ymin, ymax) of the polygon(s) in a shapefile where clip_field equals field_value
+def clipExtent(clip_shapefile, clip_field, field_value):
+    return clipGeometry(clip_shapefile, clip_field, field_value)[1]
+
+# clipWindow
+# Returns (row, col, nrows, ncols) of the cells of a grid covering a clip extent
+#
+def clipWindow(geotransform, shape, extent):
+
+    xmin, xmax, ymin, ymax = extent
+    c0 = max(0, int(np.floor((xmin - geotransform[0])/geotransform[1])))
+    c1 = min(shape[1], int(np.ceil((xmax - geotransform[0])/geotransform[1])))
+    r0 = max(0, int(np.floor((ymax - geotransform[3])/geotransform[5])))
+    r1 = min(shape[0], int(np.ceil((ymin - geotransform[3])/geotransform[5])))
+    if r0 >= r1 or c0 >= c1:
+        raise ValueError("Clip polygon doesn't overlap raster.")
+
+    return r0, c0, r1 - r0, c1 - c0
+
+# clipMask
+# Rasterizes the polygon(s) in a shapefile where clip_field equals field_value onto a grid, or onto
+# a window (row, col, nrows, ncols) of it. The grid is rasterized once, into a bit packed mask
+# cached per polygon and grid, so every block of a raster and every raster of a model (which share
+# a grid) are clipped with one rasterization.
+#
+# Example usage:
+#   mask = clipMask("some_clip_file.shp", "selection field name", "polygon id", geotransform, (ny, nx))
+#   block_mask = clipMask("some_clip_file.shp", "selection field name", "polygon id", geotransform, (ny, nx), block)
+#
+# Returns boolean ndarray of shape (ny, nx) or (nrows, ncols), True inside the polygon
+#
+def clipMask(clip_shapefile, clip_field, field_value, geotransform, shape, window=None):
+
+    clip_shapefile = os.path.abspath(clip_shapefile)
+    packed = cachedClipMask(clip_shapefile, os.stat(clip_shapefile).st_mtime_ns, clip_field, field_value,
+                            tuple(float(v) for v in geotransform), tuple(int(n) for n in shape))
+
+    row, col, nrows, ncols = window if window is not None else (0, 0, int(shape[0]), int(shape[1]))
+    bits = np.unpackbits(packed[row:row + nrows, col//8:(col + ncols + 7)//8], axis=1)
+
+    return bits[:, col % 8:col % 8 + ncols].astype(bool)
+
+# Returns the clip mask of a whole grid packed 8 cells to a byte along rows (np.packbits), rasterized
+# BLOCK_SIZE cells square at a time. The array is read only.
+@functools.lru_cache(maxsize=8)
+def cachedClipMask(clip_shapefile, mtime, clip_field, field_value, geotransform, shape):
+
+    wkb, _ = cachedClipGeometry(clip_shapefile, mtime, clip_field, field_value)
+    shp = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = shp.CreateLayer("clip", geom_type=ogr.wkbUnknown)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(ogr.CreateGeometryFromWkb(wkb))
+    layer.CreateFeature(feature)
+
+    # BLOCK_SIZE is a multiple of 8, so blocks start on a byte
+    packed = np.zeros((shape[0], (shape[1] + 7)//8), dtype=np.uint8)
+    for block in bbrasters.iter_windows(shape[1], shape[0], BLOCK_SIZE):
+        row, col, nrows, ncols = block
+        mem = gdal.GetDriverByName("MEM").Create("", ncols, nrows, 1, gdal.GDT_Byte)
+        mem.SetGeoTransform(list(bbrasters.window_geotransform(geotransform, block)))
+        gdal.RasterizeLayer(mem, [1], layer, burn_values=[1])
+        packed[row:row + nrows, col//8:(col + ncols + 7)//8] = np.packbits(mem.GetRasterBand(1).ReadAsArray() > 0, axis=1)
+        mem = None
+    packed.setflags(write=False)
+
+    feature = None
+    layer = None
+    shp = None
+
+    return packed
+
+# clipArray
+# Crops an array to the extent of the clip polygon and sets cells outside it to NaN,
+# like arcpy Clip with ClippingGeometry
+#
+# Returns (clipped array, geotransform of clipped array)
+#
+def clipArray(z, geotransform, clip_shapefile, clip_field, field_value):
+
+    window = clipWindow(geotransform, z.shape, clipExtent(clip_shapefile, clip_field, field_value))
+    row, col, nrows, ncols = window
+    clipped_gt = bbrasters.window_geotransform(geotransform, window)
+    mask = clipMask(clip_shapefile, clip_field, field_value, clipped_gt, (nrows, ncols))
+
+    return np.where(mask, z[row:row + nrows, col:col + ncols], np.nan), clipped_gt
+
+# clipRasterFile
+# Same as clipArray for a raster file, read and written block by block
+#
+# Example usage:
+#   clipRasterFile("depth.tif", "depth_CLIPPED.tif", "some_clip_file.shp", "selection field name", "polygon id")
+#
+def clipRasterFile(src_file, dst_file, clip_shapefile, clip_field, field_value, block_size=BLOCK_SIZE):
+
+    src = gdal.Open(src_file)
+    geotransform = src.GetGeoTransform()
+    window = clipWindow(geotransform, (src.RasterYSize, src.RasterXSize),
+                        clipExtent(clip_shapefile, clip_field, field_value))
+    clipped_gt = bbrasters.window_geotransform(geotransform, window)
+
+    out = bbrasters.create_tif(dst_file, window[3], window[2], 1, clipped_gt, crs=src.GetProjection() or None)
+    for block in bbrasters.iter_windows(window[3], window[2], block_size):
+        z = bbrasters.read_window(src, clipped_gt, block)
+        mask = clipMask(clip_shapefile, clip_field, field_value, clipped_gt, window[2:], block)
+        bbrasters.write_band(out, 1, np.where(mask, z, np.nan), row=block[0], col=block[1])
+    out = None
+    src = None
+
+# mergeRasterFiles
+# Merges two aligned raster files with the same cell size block by block onto a grid covering both.
+# Raster 1 values take priority of Raster 2.
+#
+# Example usage:
+#   mergeRasterFiles("depth.tif", "river_depth.tif", "full_depth.tif")
+#
+def mergeRasterFiles(file1, file2, dst_file, block_size=BLOCK_SIZE):
+
+    ds1 = gdal.Open(file1)
+    ds2 = gdal.Open(file2)
+    geotransform, shape = bbrasters.union_grid([ds1.GetGeoTransform(), ds2.GetGeoTransform()],
+                                               [(ds1.RasterYSize, ds1.RasterXSize), (ds2.RasterYSize, ds2.RasterXSize)])
+
+    out = bbrasters.create_tif(dst_file, shape[1], shape[0], 1, geotransform, crs=ds1.GetProjection() or None)
+    for block in bbrasters.iter_windows(shape[1], shape[0], block_size):
+        z = bbrasters.read_window(ds2, geotransform, block)
+        z1 = bbrasters.read_window(ds1, geotransform, block)
+        valid = ~np.isnan(z1)
+        z[valid] = z1[valid]
+        bbrasters.write_band(out, 1, z, row=block[0], col=block[1])
+    out = None
+    ds1 = None
+    ds2 = None
+
+# createGDB
+# Creates a folder for the model's rasters
+#
+# Example usage:
+#   createGDB("C:/some/path/to/mymodel.gdb", "mymodel")
+# 
+def createGDB(gdb_path, gdb_name):
+
+    if not os.path.exists(gdb_path):
+        os.makedirs(gdb_path)
+        logging.info("Raster folder created at:\n{}".format(gdb_path))
+    else:
+        logging.info("Raster folder already exists for {}.".format(gdb_name))
+
+# ascToGDB
+# Converts an asc file to a float32 GeoTIFF in the gdb folder. Overwrites if already exists.        
+#
+# Example usage:
+#   ascToGDB("myascfile.asc", "somegdb.gdb")
+# 
+def ascToGDB(asc_file, gdb_name, raster_name = None, cache = False):
+
+    asc_file = os.path.abspath(asc_file)
+    gdb_name = os.path.abspath(gdb_name)
+
+    # use same raster name as asc file if not specified
+    if raster_name == None:
+        raster_name = os.path.splitext(os.path.basename(asc_file))[0]
+
+    # asc is parsed and written block by block, unless it is read whole from its cache
+    if cache:
+        z, geotransform, crs = bbasc.read_asc(asc_file, cache=True)
+        bbrasters.write_tif(rasterPath(gdb_name, raster_name), z, geotransform, crs=crs or None)
+    else:
+        header, _ = bbasc.read_header(asc_file)
+        ds = bbrasters.create_tif(rasterPath(gdb_name, raster_name), header["ncols"], header["nrows"], 1,
+                                  bbasc.header_geotransform(header), crs=bbasc.read_projection(asc_file) or None)
+        for row, z in bbasc.iter_blocks(asc_file):
+            bbrasters.write_band(ds, 1, z, row=row)
+        ds = None
+
+    logging.info("Created raster: {}".format(raster_name))
+
+    return True
+
+# clipAllRasters
+# Clips all rasters in gdb folder to a polygon found in a shapefile matching field name and id
+#
+# Example usage:
+#   clipAllRasters("mygdb.gdb", "some_clip_file.shp", "selection field name", "polygon id")
+# 
+def clipAllRasters(gdb_name, clip_shapefile, clip_field, field_value, block_size=BLOCK_SIZE):
+
+    gdb_name = os.path.abspath(gdb_name)
+
+    for ras in listRasters(gdb_name):
+        if ras.endswith("_CLIPPED"):
+            continue
+        logging.info("Clipping raster {}...".format(ras))
+        clipRasterFile(rasterPath(gdb_name, ras), rasterPath(gdb_name, "{}_CLIPPED".format(ras)),
+                       clip_shapefile, clip_field, field_value, block_size)
+
+    return True
+
+# clipOneRaster
+# Clips one raster in gdb folder to a polygon found in a shapefile matching field name and id
+#
+# Example usage:
+#   clipOneRaster("mygdb.gdb", "raster name", "some_clip_file.shp", "selection field name", "polygon id")
+# 
+def clipOneRaster(gdb_name, raster_name, clip_shapefile, clip_field, field_value, block_size=BLOCK_SIZE):
+
+    gdb_name = os.path.abspath(gdb_name)
+
+    # Clip raster
+    logging.info("Clipping raster {}...".format(raster_name))
+    clipRasterFile(rasterPath(gdb_name, raster_name), rasterPath(gdb_name, "{}_CLIPPED".format(raster_name)),
+                   clip_shapefile, clip_field, field_value, block_size)
+
+    # Delete unclipped raster and replace with new raster
+    renameRaster(gdb_name, "{}_CLIPPED".format(raster_name), raster_name)
+
+# crsToWkt
+# Returns WKT for a coordinate system given as EPSG code, WKT, proj string or name,
+# e.g. "EPSG:25832" or ESRI style "ETRS 1989 UTM Zone 32N"
+#
+def crsToWkt(crs):
+    return bbrasters.crs_to_wkt(crs)
+
+# setCRS
+# Sets the CRS of all rasters in a gdb folder
+#
+# Example usage:
+#   setCRS("somegdb.gdb", "EPSG:25832")
+# 
+def setCRS(gdb_name, crs):
+
+    gdb_name = os.path.abspath(gdb_name)
+    wkt = crsToWkt(crs)
+
+    # set coordinate system for all rasters
+    for ras in listRasters(gdb_name):
+        logging.info("Defining coordinate system for raster {}...".format(ras))
+        ds = gdal.Open(rasterPath(gdb_name, ras), gdal.GA_Update)
+        ds.SetProjection(wkt)
+        ds = None
+
+    return True
+
+# mergeRasters
+# Merges two aligned rasters with the same cell size. Raster 1 values take priority of Raster 2.
+#
+# Example usage:
+#   mergeRasters("raster1", "raster2", #merged raster", "gdb_with_both_rasters.gdb")
+# 
+def mergeRasters(raster1, raster2, merged_name, gdb_name, block_size=BLOCK_SIZE):
+
+    gdb_name = os.path.abspath(gdb_name)
+
+    logging.info("Merging rasters {} and {}...".format(raster1, raster2))
+    mergeRasterFiles(rasterPath(gdb_name, raster1), rasterPath(gdb_name, raster2),
+                     rasterPath(gdb_name, merged_name), block_size)
+
+    return True
+
+# mergeArrays
+# Merges aligned arrays with the same cell size onto a grid covering all of them.
+# Arrays earlier in the list take priority over later ones where they have values.
+#
+# Example usage:
+#   merged, geotransform = mergeArrays([(z1, geotransform1), (z2, geotransform2)])
+#
+def mergeArrays(arrays):
+
+    geotransform, shape = bbrasters.union_grid([gt for z, gt in arrays], [z.shape for z, gt in arrays])
+    merged = np.full(shape, np.nan, dtype=np.float32)
+    for z, gt in reversed(arrays):
+        row, col = bbrasters.grid_offset(gt, geotransform)
+        window = merged[row:row + z.shape[0], col:col + z.shape[1]]
+        valid = ~np.isnan(z)
+        window[valid] = z[valid]
+
+    return merged, geotransform
+
+# cleanRasters
+# Renames latest rasters to their final name and removes all others rasters from gdb folder
+#
+# Example usage:
+#   cleanRasters("gdb_with_rasters.gdb")
+# 
+def cleanRasters(gdb_name, depth, velocity, direction, depth_final, velocity_final, direction_final):
+
+    gdb_name = os.path.abspath(gdb_name)
+
+    # check if clipped rasters exist, and if so, use that as final raster
+    if rasterExists(gdb_name, "{}_CLIPPED".format(depth)):
+        depth = "{}_CLIPPED".format(depth)
+    if rasterExists(gdb_name, "{}_CLIPPED".format(velocity)):
+        velocity = "{}_CLIPPED".format(velocity)
+    if rasterExists(gdb_name, "{}_CLIPPED".format(direction)):
+        direction = "{}_CLIPPED".format(direction)
+
+    # Rename rasters to their final names
+    logging.info("Renaming final depth, velocity, and direction rasters.")
+    renameRaster(gdb_name, depth, depth_final)
+    renameRaster(gdb_name, velocity, velocity_final)
+    # included temporarily for project that did not have direction rasters yet
+    if rasterExists(gdb_name, direction):
+        renameRaster(gdb_name, direction, direction_final)
+
+    # Delete all other rasters
+    logging.info("Deleting all rasters which are not final.")
+    for ras in listRasters(gdb_name):
+        if ras != depth_final and ras != velocity_final and ras != direction_final:
+            logging.info("Deleting raster {}...".format(ras))
+            deleteRaster(gdb_name, ras)
+
+    return True
+
+
+# Returns default folder for the COGs of a gdb folder, next to it, e.g. mymodel.gdb -> mymodel_cog
+def cogPath(gdb_name):
+    return "{}_cog".format(os.path.splitext(os.path.abspath(gdb_name))[0])
+
+# cogRasters
+# Converts the final rasters of a gdb folder to Cloud Optimized GeoTIFFs (tiled, compressed, with
+# internal overviews) in cog_path, one raster per thread as GDAL does the work outside the GIL.
+# The source and COG of each raster are fingerprinted in a manifest in cog_path, so rasters whose
+# source and COG haven't changed since the last conversion are skipped. Missing rasters (e.g. no
+# direction) are skipped as well. cog_path defaults to a folder next to the gdb (see cogPath).
+#
+# Example usage:
+#   cogRasters("mygdb.gdb", None, "mymodel_Depth", "mymodel_Velocity", "mymodel_Direction")
+#
+# Returns list of COG files written
+#
+def cogRasters(gdb_name, cog_path, depth_final, velocity_final, direction_final, workers=None, compress=bbrasters.COMPRESS):
+
+    gdb_name = os.path.abspath(gdb_name)
+    cog_path = os.path.abspath(cog_path) if cog_path is not None else cogPath(gdb_name)
+    if not os.path.exists(cog_path):
+        os.makedirs(cog_path)
+
+    # one manifest per gdb, so models can share a COG folder
+    manifest = Manifest(os.path.join(cog_path, "{}_cog_manifest.json".format(os.path.splitext(os.path.basename(gdb_name))[0])))
+
+    def fingerprint(name):
+        return {"source" : fingerprintPath(rasterPath(gdb_name, name)),
+                "cog" : fingerprintPath(rasterPath(cog_path, name))}
+
+    todo = []
+    for name in [depth_final, velocity_final, direction_final]:
+        if not rasterExists(gdb_name, name):
+            logging.info("No raster {} to convert to COG.".format(name))
+        elif manifest.isUpToDate(name, fingerprint(name)):
+            logging.info("COG of {} is up to date.".format(name))
+        else:
+            todo.append(name)
+
+    if not todo:
+        return []
+
+    written = []
+    with ThreadPoolExecutor(max_workers=workers or len(todo)) as pool:
+        futures = {pool.submit(bbrasters.to_cog, rasterPath(gdb_name, name), rasterPath(cog_path, name), compress) : name
+                   for name in todo}
+        for future in as_completed(futures):
+            name = futures[future]
+            written.append(future.result())
+            logging.info("Converted {} to COG.".format(name))
+            manifest.record(name, fingerprint(name))
+
+    return sorted(written)
+
+# fusedRasters
+# Does ascToGDB, mergeRasters, clipAllRasters, setCRS and cleanRasters in one pass. Each asc file is
+# read once, depth is merged with river depth, clipped to the boundary polygon and given its CRS in
+# memory, and only the final rasters are written. river_depth_asc, direction_asc, clip_shapefile and
+# crs can be None to skip that step. With cache=True the asc files are read through their .npy
+# caches (see ascgrid.read_asc). Each raster is held in memory whole; for rasters larger than
+# memory use the step by step processes, which work block by block.
+#
+# Example usage:
+#   fusedRasters("mygdb.gdb", "depth.asc", "river_depth.asc", "speed.asc", "direction.asc",
+#                "some_clip_file.shp", "selection field name", "polygon id", "EPSG:25832",
+#                "mymodel_Depth", "mymodel_Velocity", "mymodel_Direction")
+#
+def fusedRasters(gdb_name, depth_asc, river_depth_asc, velocity_asc, direction_asc,
+                 clip_shapefile, clip_field, field_value, crs,
+                 depth_final, velocity_final, direction_final, cache=False):
+
+    gdb_name = os.path.abspath(gdb_name)
+    if not os.path.exists(gdb_name):
+        os.makedirs(gdb_name)
+    wkt = crsToWkt(crs) if crs is not None else None
+
+    def finish(z, geotransform, asc_crs, final_name):
+        if clip_shapefile is not None:
+            z, geotransform = clipArray(z, geotransform, clip_shapefile, clip_field, field_value)
+        bbrasters.write_tif(rasterPath(gdb_name, final_name), z, geotransform, crs=wkt or asc_crs or None)
+        logging.info("Created raster: {}".format(final_name))
+
+    depth, geotransform, asc_crs = bbasc.read_asc(depth_asc, cache)
+    if river_depth_asc is not None:
+        logging.info("Merging {} and {}...".format(depth_asc, river_depth_asc))
+        river_depth, river_gt, _ = bbasc.read_asc(river_depth_asc, cache)
+        depth, geotransform = mergeArrays([(depth, geotransform), (river_depth, river_gt)])
+        river_depth = None
+    finish(depth, geotransform, asc_crs, depth_final)
+    depth = None
+
+    finish(*bbasc.read_asc(velocity_asc, cache), velocity_final)
+
+    if direction_asc is not None:
+        finish(*bbasc.read_asc(direction_asc, cache), direction_final)
+
+    return True
@@ -0,0 +1,150 @@
+# This module includes timing, memory and I/O measurements of processes and the run report built from them
+
+import csv
+import json
+import os
+import threading
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Fields measured for every process
+FIELDS = ["wall_time", "cpu_time", "peak_rss", "read_bytes", "write_bytes"]
+
+# Fields that are a highest value rather than an amount used, so totals take their maximum
+PEAK_FIELDS = ["peak_rss"]
+
+# Seconds between samples of resident memory while a process runs
+SAMPLE_INTERVAL = 0.02
+
+# Returns the resident memory of this process right now in bytes, None if unknown
+def currentRSS():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    return None
+
+class RSSSampler:
+    """
+    Samples the resident memory of this process in a background thread and keeps the highest value,
+    so the peak of one process is measured even after earlier processes grew the memory further.
+    Anything allocated and freed between two samples is missed.
+
+    Usage example:
+    sampler = RSSSampler()
+    ...
+    peak = sampler.stop()
+    """
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = currentRSS()
+        self.done = threading.Event()
+        self.thread = None
+        if self.peak is not None:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, currentRSS())
+
+    # Stops sampling and returns the highest resident memory seen in bytes, None if unknown
+    def stop(self):
+        if self.thread is None:
+            return None
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, currentRSS())
+        return self.peak
+
+# Returns (bytes read, bytes written) by this process so far, (None, None) if unknown
+def ioCounters():
+    if psutil is not None:
+        try:
+            counters = psutil.Process().io_counters()
+            return counters.read_bytes, counters.write_bytes
+        except (AttributeError, NotImplementedError):
+            pass
+    if os.path.exists("/proc/self/io"):
+        with open("/proc/self/io") as f:
+            values = dict(line.split(": ") for line in f.read().splitlines())
+        return int(values["read_bytes"]), int(values["write_bytes"])
+    return None, None
+
+# Returns the current counters of this process, pass two of these to measurement
+def snapshot():
+    read_bytes, write_bytes = ioCounters()
+    return {"wall_time" : time.perf_counter(), "cpu_time" : time.process_time(),
+            "read_bytes" : read_bytes, "write_bytes" : write_bytes}
+
+# Returns what was used between two snapshots, with peak_rss the highest resident memory sampled
+# in between (see RSSSampler).
+# CPU time, memory and I/O are for the whole process, so they include anything else running in
+# other threads at the same time.
+def measurement(start, end, peak_rss=None):
+    stats = {field : (end[field] - start[field] if end[field] is not None and start[field] is not None else None)
+             for field in FIELDS if field not in PEAK_FIELDS}
+    stats["peak_rss"] = peak_rss
+    return stats
+
+class RunReport:
+    """
+    Measurements of every process run by a Hut, with totals per model and per process name.
+
+    Usage example:
+    hut.runAll()
+    hut.report.toJSON("run_report.json")
+    hut.report.toCSV("run_report.csv")
+    """
+    def __init__(self):
+        self.records = []
+
+    # Adds a measurement (or None if the process was skipped or didn't finish)
+    def add(self, model_name, process_name, stats):
+        record = {"model" : model_name, "process" : process_name, "skipped" : stats is None}
+        record.update({field : (stats or {}).get(field) for field in FIELDS})
+        self.records.append(record)
+
+    # Adds the measurements kept on the runstack of a model after it ran
+    def addModel(self, model):
+        for process in model.runstack:
+            self.add(model.name, process.name, process.stats)
+
+    # Returns totals of each field grouped by "model" or "process", plus the number of processes run.
+    # Peak fields are the highest value in the group rather than a sum.
+    def totals(self, by):
+        totals = {}
+        for record in self.records:
+            group = totals.setdefault(record[by], dict({field : 0 for field in FIELDS}, count=0))
+            if record["skipped"]:
+                continue
+            group["count"] += 1
+            for field in FIELDS:
+                if record[field] is None:
+                    continue
+                if field in PEAK_FIELDS:
+                    group[field] = max(group[field], record[field])
+                else:
+                    group[field] += record[field]
+        return totals
+
+    def byModel(self):
+        return self.totals("model")
+
+    def byProcess(self):
+        return self.totals("process")
+
+    def toJSON(self, filename):
+        with open(filename, "w") as f:
+            json.dump({"processes" : self.records, "by_model" : self.byModel(), "by_process" : self.byProcess()}, f, indent=1)
+
+    def toCSV(self, filename):
+        with open(filename, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=["model", "process", "skipped"] + FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
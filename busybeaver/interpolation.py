@@ -1,49 +1,342 @@
 # This module includes implementation for bilinear interpolation
 
+import hashlib
+import json
+import logging
+import os
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+# Points further than this from the interpolation point are never used as interpolants
+MAX_SEARCH_DISTANCE = 1000
+
+# Most (point, element) pairs held in memory at once by the quadrant searches
+MAX_PAIRS = 2**21
+
+# Most elements in a leaf of the tree searched by QuadrantIndex.search_quadrants
+LEAF_SIZE = 16
+
+class QuadrantIndex:
+    """
+    Spatial index over element coordinates for finding the closest element in each
+    quadrant around a point. Build once per mesh and reuse it for every grid point.
+
+    Usage example:
+    index = QuadrantIndex(dfs.element_coordinates)
+    quads = index.query((594238.084, 6645064.994))
+    """
+    def __init__(self, element_coords):
+        self.coords = np.asarray(element_coords, dtype=np.float64)[:, :2]
+        self.tree = cKDTree(self.coords)
+        # built on first use by search_quadrants
+        self.nodes = None
+
+        # y extremes of the elements left and right of any x, for telling if a quadrant has any element
+        order = np.argsort(self.coords[:, 0], kind="stable")
+        self.sorted_x = self.coords[order, 0]
+        y = self.coords[order, 1]
+        self.left_max = np.maximum.accumulate(y)
+        self.left_min = np.minimum.accumulate(y)
+        self.right_max = np.maximum.accumulate(y[::-1])[::-1]
+        self.right_min = np.minimum.accumulate(y[::-1])[::-1]
+
+    # Returns int32 index of closest element in each quadrant [quad0, quad1, quad2, quad3], -1 if none
+    def query(self, interp_pnt):
+        return self.query_many([interp_pnt[:2]])[0]
+
+    # Same as query but for an (N,2) array of points, returns an (N,4) int32 array of indices
+    #
+    # Takes the k nearest elements of every point, which settles most quadrants. Quadrants with
+    # elements but none among those, or with a tie at the k-th element, are searched on their own.
+    def query_many(self, points, k=8):
+
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))[:, :2]
+        result = np.full((len(points), 4), -1, dtype=np.int32)
+        occupied = self.occupied(points)
+        # cKDTree excludes points exactly at the upper bound, brute force search did not
+        upper_bound = np.nextafter(MAX_SEARCH_DISTANCE, np.inf)
+
+        todo = np.flatnonzero(occupied.any(axis=1))
+        k = min(k, len(self.coords))
+        if not len(todo) or k == 0:
+            return result
+
+        pending = np.zeros((len(points), 4), dtype=bool)
+        for batch in np.array_split(todo, -(-len(todo)*k // MAX_PAIRS)):
+            dist, idx = self.tree.query(points[batch], k=k, distance_upper_bound=upper_bound)
+            dist = dist.reshape(len(batch), k)
+            idx = idx.reshape(len(batch), k)
+
+            found, nearest = self._closest_per_quadrant(points[batch], dist, idx)
+            result[batch] = found
+
+            # unless fewer than k elements were in range (every candidate has been seen)
+            exhausted = np.isinf(dist[:, -1:])
+            pending[batch] = (((found < 0) & occupied[batch]) | (nearest == dist[:, -1:])) & ~exhausted
+
+        if k < len(self.coords):
+            rows, quads = np.nonzero(pending)
+            result[rows, quads] = self.search_quadrants(points[rows], quads)
+
+        return result
+
+    # Returns (N,4) bool, True where a quadrant of a point has any element in it at all
+    def occupied(self, points):
+
+        n = len(self.sorted_x)
+        occupied = np.zeros((len(points), 4), dtype=bool)
+        if n == 0:
+            return occupied
+
+        # elements before i are left of the point, from i on right of (or on) it
+        i = np.searchsorted(self.sorted_x, points[:, 0], side="left")
+        left = i > 0
+        right = i < n
+        y = points[:, 1]
+        occupied[:, 0] = right & (self.right_max[np.minimum(i, n - 1)] >= y)
+        occupied[:, 1] = left & (self.left_max[np.maximum(i - 1, 0)] >= y)
+        occupied[:, 2] = left & (self.left_min[np.maximum(i - 1, 0)] < y)
+        occupied[:, 3] = right & (self.right_min[np.minimum(i, n - 1)] < y)
+
+        return occupied
+
+    # Finds the closest element in one quadrant of each point, by a branch and bound search of a
+    # kd tree which skips nodes outside the quadrant or further away than the closest element found
+    # so far. All points are searched together, one tree node per point at a time.
+    #
+    # Arg: points (N,2) ndarray, quads (N,) ndarray of the quadrant (0-3) to search for each point
+    #
+    # Returns (N,) int64 ndarray of element indices, -1 where the quadrant has no element within
+    # MAX_SEARCH_DISTANCE. Ties go to the highest element index.
+    def search_quadrants(self, points, quads):
+
+        if self.nodes is None:
+            self.nodes = kd_nodes(self.coords)
+
+        found = np.full(len(points), -1, dtype=np.int64)
+        chunk = max(1, MAX_PAIRS // (4*LEAF_SIZE))
+        for start in range(0, len(points), chunk):
+            found[start:start + chunk] = self._search_quadrants(points[start:start + chunk], quads[start:start + chunk])
+
+        return found
+
+    def _search_quadrants(self, points, quads):
+
+        order, starts, ends, left, right, box = self.nodes
+        px, py = points[:, 0], points[:, 1]
+        right_side = (quads == 0) | (quads == 3)
+        upper = (quads == 0) | (quads == 1)
+
+        # distance from each point to the part of a node's box inside its quadrant, inf if none is
+        def reach(node, i):
+            lox = np.where(right_side[i], np.maximum(box[node, 0], px[i]), box[node, 0])
+            hix = np.where(right_side[i], box[node, 1], np.minimum(box[node, 1], px[i]))
+            loy = np.where(upper[i], np.maximum(box[node, 2], py[i]), box[node, 2])
+            hiy = np.where(upper[i], box[node, 3], np.minimum(box[node, 3], py[i]))
+            dx = np.maximum(np.maximum(lox - px[i], px[i] - hix), 0)
+            dy = np.maximum(np.maximum(loy - py[i], py[i] - hiy), 0)
+            return np.where((lox > hix) | (loy > hiy), np.inf, np.hypot(dx, dy))
+
+        best = np.full(len(points), float(MAX_SEARCH_DISTANCE))
+        best_idx = np.full(len(points), -1, dtype=np.int64)
+
+        # each point has its own stack of nodes left to search, starting from the root
+        stack = np.zeros((len(points), 2 + int(np.ceil(np.log2(len(starts) + 1)))*2), dtype=np.int64)
+        size = np.ones(len(points), dtype=np.int64)
+        offsets = np.arange(LEAF_SIZE)
+
+        while True:
+            i = np.flatnonzero(size > 0)
+            if not len(i):
+                break
+            size[i] -= 1
+            node = stack[i, size[i]]
+            keep = reach(node, i) <= best[i]
+            i, node = i[keep], node[keep]
+            leaf = left[node] < 0
+
+            # leaves: check every element in them
+            j, leaf_node = i[leaf], node[leaf]
+            if len(j):
+                cols = starts[leaf_node, np.newaxis] + offsets
+                valid = cols < ends[leaf_node, np.newaxis]
+                el = order[np.where(valid, cols, 0)]
+                ex, ey = self.coords[el, 0], self.coords[el, 1]
+                in_quad = valid & np.where(right_side[j, np.newaxis], ex >= px[j, np.newaxis], ex < px[j, np.newaxis]) \
+                                & np.where(upper[j, np.newaxis], ey >= py[j, np.newaxis], ey < py[j, np.newaxis])
+                d = np.where(in_quad, np.hypot(ex - px[j, np.newaxis], ey - py[j, np.newaxis]), np.inf)
+                nearest = d.min(axis=1)
+                cand = np.where(in_quad & (d == nearest[:, np.newaxis]), el, -1).max(axis=1)
+                better = (nearest < best[j]) | ((nearest == best[j]) & (cand > best_idx[j]))
+                best[j[better]] = nearest[better]
+                best_idx[j[better]] = cand[better]
+
+            # branches: push the children in reach, the nearer one last so it is searched first
+            j, branch = i[~leaf], node[~leaf]
+            if len(j):
+                d_left, d_right = reach(left[branch], j), reach(right[branch], j)
+                left_first = d_left <= d_right
+                for child, d in ((np.where(left_first, right[branch], left[branch]), np.where(left_first, d_right, d_left)),
+                                 (np.where(left_first, left[branch], right[branch]), np.where(left_first, d_left, d_right))):
+                    push = d <= best[j]
+                    stack[j[push], size[j[push]]] = child[push]
+                    size[j[push]] += 1
+
+        return best_idx
+
+    # Picks the closest candidate in each quadrant. Ties go to the highest element index
+    # to match the original brute force search.
+    def _closest_per_quadrant(self, points, dist, idx):
+
+        valid = np.isfinite(dist)
+        cand = self.coords[np.where(valid, idx, 0)]
+        right = cand[:, :, 0] >= points[:, 0:1]
+        above = cand[:, :, 1] >= points[:, 1:2]
+        quadrant = np.where(above, np.where(right, 0, 1), np.where(right, 3, 2))
+
+        found = np.full((len(points), 4), -1, dtype=np.int64)
+        nearest = np.full((len(points), 4), np.inf)
+        for q in range(4):
+            in_quad = valid & (quadrant == q)
+            d = np.where(in_quad, dist, np.inf)
+            nearest[:, q] = d.min(axis=1)
+            ties = in_quad & (d == nearest[:, q:q+1])
+            found[:, q] = np.where(ties, idx, -1).max(axis=1)
+
+        return found, nearest
+
+# Builds a kd tree over points for QuadrantIndex.search_quadrants, splitting nodes at the median of
+# their longer side until they hold at most LEAF_SIZE points
+#
+# Returns (order, starts, ends, left, right, box): the points of node i are order[starts[i]:ends[i]],
+# its children left[i] and right[i] (-1 for leaves) and box[i] its bounds (xmin, xmax, ymin, ymax)
+def kd_nodes(coords):
+
+    order = np.arange(len(coords))
+    starts, ends, left, right = [0], [len(coords)], [-1], [-1]
+    i = 0
+    while i < len(starts):
+        start, end = starts[i], ends[i]
+        if end - start > LEAF_SIZE:
+            points = coords[order[start:end]]
+            axis = int(np.ptp(points[:, 1]) > np.ptp(points[:, 0]))
+            middle = (end - start) // 2
+            order[start:end] = order[start:end][np.argpartition(points[:, axis], middle)]
+            left[i], right[i] = len(starts), len(starts) + 1
+            starts += [start, start + middle]
+            ends += [start + middle, end]
+            left += [-1, -1]
+            right += [-1, -1]
+        i += 1
+
+    # bounds of each node from the min and max of its (contiguous) points
+    sorted_coords = np.vstack([coords[order], np.zeros((1, 2))])
+    bounds = np.ravel(np.column_stack([starts, ends]))
+    lower = np.minimum.reduceat(sorted_coords, bounds)[::2]
+    upper = np.maximum.reduceat(sorted_coords, bounds)[::2]
+    box = np.column_stack([lower[:, 0], upper[:, 0], lower[:, 1], upper[:, 1]])
+
+    return order, np.array(starts), np.array(ends), np.array(left), np.array(right), box
+
+class MeshLocator:
+    """
+    Spatial index over the elements of a mesh for finding the element containing a point.
+    Quads are split into two triangles, so a point is located in a triangle with its
+    barycentric weights on the triangle's nodes.
+
+    Usage example:
+    locator = MeshLocator(dfs.node_coordinates, dfs.element_table)
+    nodes, weights, elements = locator.locate([(594238.084, 6645064.994)])
+    """
+    def __init__(self, node_coords, element_table):
+        self.node_coords = np.asarray(node_coords, dtype=np.float64)[:, :2]
+        self.triangles, self.tri_elements = triangulate(element_table)
+        corners = self.node_coords[self.triangles]
+        centroids = corners.mean(axis=1)
+        # a point inside a triangle is never further from its centroid than this
+        self.max_reach = np.sqrt(((corners - centroids[:, np.newaxis])**2).sum(axis=2)).max()
+        self.tree = cKDTree(centroids)
+
+    # Locates an (N,2) array of points
+    #
+    # Returns (nodes, weights, elements): (N,3) int32 node indices of the containing triangle,
+    # (N,3) float64 barycentric weights and (N,) int32 element index. -1 nodes and elements and
+    # NaN weights for points outside the mesh. A point on an edge shared by several triangles
+    # goes to the lowest numbered of those found in the same search.
+    def locate(self, points, k=8):
+
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))[:, :2]
+        found = np.full(len(points), -1, dtype=np.int64)
+        weights = np.full((len(points), 3), np.nan)
+        n_tri = len(self.triangles)
+
+        todo = np.arange(len(points))
+        k = min(k, n_tri)
+        while len(todo):
+            dist, idx = self.tree.query(points[todo], k=k)
+            dist = dist.reshape(len(todo), k)
+            idx = idx.reshape(len(todo), k)
+
+            bary = barycentric_weights(points[todo], self.node_coords[self.triangles[idx]])
+            inside = (bary >= -1e-9).all(axis=2)
+            tri = np.where(inside, idx, n_tri).min(axis=1)
+            hit = tri < n_tri
+            found[todo[hit]] = tri[hit]
+            col = np.argmax(inside & (idx == tri[:, np.newaxis]), axis=1)
+            weights[todo[hit]] = bary[np.arange(len(todo)), col][hit]
+
+            # search wider while an unchecked triangle could still contain the point
+            if k == n_tri:
+                break
+            todo = todo[~hit & (dist[:, -1] <= self.max_reach)]
+            k = min(k * 4, n_tri)
+
+        outside = found < 0
+        nodes = self.triangles[np.where(outside, 0, found)]
+        nodes[outside] = -1
+        elements = np.where(outside, -1, self.tri_elements[np.where(outside, 0, found)])
+
+        return nodes.astype(np.int32), weights, elements.astype(np.int32)
+
 # Returns 4 points to do bilinear interpolation with
 #
 # Arg: interp_pnt, tuple point (x,y), ndarray of points from Dfsu.element_coordinates [[x,y,z], [x,y,z], [x,y,z], ...]
+#      index, optional QuadrantIndex built from element_coords. Without one every element is scanned,
+#      which is quicker for a single point than building an index; pass one when querying many points.
 #
-# Returns index of closest points in each quadrant in form of array [quad0, quad1, quad2, quad3]
-def get_interpolants(interp_pnt, element_coords, ds_data):
-
-    # placeholders for quadrant points
-    quad0 = [1000, None]
-    quad1 = [1000, None]
-    quad2 = [1000, None]
-    quad3 = [1000, None]
-    xi = interp_pnt[0]
-    yi = interp_pnt[1]
-
-    # find the closest point in each quadrant
-    for index, pnt in enumerate(element_coords):
-
-        x = pnt[0]
-        y = pnt[1]
-        dist = distance_between_points(interp_pnt, pnt)
-
-        # quad 0
-        if x >= xi and y >= yi:
-            if quad0[0] >= dist:
-                quad0 = [dist, index]
-        # quad 1
-        elif x < xi and y >= yi:
-            if quad1[0] >= dist:
-                quad1 = [dist, index]
-        # quad 2
-        elif x < xi and y < yi:
-            if quad2[0] >= dist:
-                quad2 = [dist, index]
-        #quad 3
-        else:
-            if quad3[0] >= dist:
-                quad3 = [dist, index]    
-
-    # return list of points
-    return [id_to_xyz(quad0[1], element_coords, ds_data),
-            id_to_xyz(quad1[1], element_coords, ds_data),
-            id_to_xyz(quad2[1], element_coords, ds_data),
-            id_to_xyz(quad3[1], element_coords, ds_data)]
+# Returns closest point in each quadrant as a (4,3) float64 ndarray [quad0, quad1, quad2, quad3] of
+# (x, y, z) rows, NaN row if quadrant is empty
+def get_interpolants(interp_pnt, element_coords, ds_data, index=None):
+
+    if index is None:
+        ids = scan_quadrants(interp_pnt, element_coords)
+    else:
+        ids = index.query(interp_pnt)
+
+    return quadrant_corners(ids[np.newaxis], element_coords, ds_data)[0]
+
+# Finds the closest element in each quadrant around a point by checking every element, O(n) per point
+#
+# Returns int32 index of closest element in each quadrant [quad0, quad1, quad2, quad3], -1 if none.
+# Ties go to the highest element index, as in QuadrantIndex.
+def scan_quadrants(interp_pnt, element_coords):
+
+    coords = np.asarray(element_coords, dtype=np.float64)
+    x, y = coords[:, 0], coords[:, 1]
+    dist = np.hypot(x - interp_pnt[0], y - interp_pnt[1])
+    right = x >= interp_pnt[0]
+    above = y >= interp_pnt[1]
+    quadrant = np.where(above, np.where(right, 0, 1), np.where(right, 3, 2))
+
+    result = np.full(4, -1, dtype=np.int32)
+    for q in range(4):
+        d = np.where((quadrant == q) & (dist <= MAX_SEARCH_DISTANCE), dist, np.inf)
+        nearest = d.min()
+        if np.isfinite(nearest):
+            result[q] = np.flatnonzero(d == nearest)[-1]
+
+    return result
 
 # returns horizontal distance
 def distance_between_points(pnt1, pnt2):
@@ -51,112 +344,471 @@ def distance_between_points(pnt1, pnt2):
     dy = pnt1[1] - pnt2[1]
     return (dx**2 + dy**2)**0.5
 
-# converts a point based on dfs coords and data
+# converts a point based on dfs coords and data to a float64 ndarray (x, y, z)
 def id_to_xyz(id, dfs_coords, dfs_data):
 
     x = dfs_coords[id][0]
     y = dfs_coords[id][1]
     z = dfs_data[id]
 
-    return (x, y, z)
+    return np.array([x, y, z], dtype=np.float64)
 
-# Accepts xyz points as args in each quadrant, and interpolates based on that.
+# Gathers the xyz points of each quadrant for many points at once
+#
+# Arg: ids, (N,4) ndarray from QuadrantIndex.query_many, element coords and data
+#
+# Returns (N,4,3) ndarray of [quad0, quad1, quad2, quad3] points, NaN where a quadrant is empty
+def quadrant_corners(ids, element_coords, dfs_data):
+
+    element_coords = np.asarray(element_coords)
+    dfs_data = np.asarray(dfs_data)
+    missing = ids < 0
+    ids = np.where(missing, 0, ids)
+
+    corners = np.empty(ids.shape + (3,))
+    corners[:, :, 0] = element_coords[ids, 0]
+    corners[:, :, 1] = element_coords[ids, 1]
+    corners[:, :, 2] = dfs_data[ids]
+    corners[missing] = np.nan
+
+    return corners
+
+# Relative tolerance for treating the quadratic term of the inverse bilinear solve as zero
+# (parallelograms, including axis aligned rectangles) and for points on the edge of a quad
+BILINEAR_TOLERANCE = 1e-9
+
+# Computes the bilinear weights of the four quadrant points for many points at once
+#
+# The quad is mapped from the unit square with quad2 at (0,0), quad3 at (1,0), quad0 at (1,1) and
+# quad1 at (0,1):  p = q2 + u*(q3-q2) + v*(q1-q2) + u*v*(q0-q1-q3+q2)
+# Crossing with the direction of u gives a quadratic in v, solved in the numerically stable form
+# so it becomes linear as the quadratic term vanishes; u is then the projection onto that direction.
+# Of the two roots, the one inside (or closest to) the unit square is used.
+#
+# Arg: points, (N,2) ndarray of (x,y), corners, (N,4,2) or (N,4,3) ndarray of quadrant points
+#
+# Returns (N,4) ndarray of weights for [quad0, quad1, quad2, quad3], so weights @ corners gives the
+# point back. A row is NaN where the point can't be interpolated: an empty quadrant (NaN corner),
+# no real root, or a quad collapsed to a line or point.
+def bilinear_weights(points, corners):
+
+    points = np.asarray(points, dtype=np.float64)[:, :2]
+    corners = np.asarray(corners, dtype=np.float64)[:, :, :2]
+    q0, q1, q2, q3 = corners[:, 0], corners[:, 1], corners[:, 2], corners[:, 3]
+
+    e = q3 - q2
+    f = q1 - q2
+    g = q0 - q1 - q3 + q2
+    h = points - q2
+
+    def cross(a, b):
+        return a[:, 0]*b[:, 1] - a[:, 1]*b[:, 0]
+
+    k2 = cross(g, f)
+    k1 = cross(e, f) + cross(h, g)
+    k0 = cross(h, e)
+
+    # scale of the terms, for tolerances independent of the size and position of the quad
+    scale = np.maximum((e**2).sum(axis=1), (f**2).sum(axis=1))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        disc = k1**2 - 4*k2*k0
+        disc = np.where((disc < 0) & (disc > -BILINEAR_TOLERANCE*scale**2), 0, disc)
+        root = np.sqrt(np.where(disc >= 0, disc, np.nan))
+        q = -0.5*(k1 + np.where(k1 < 0, -root, root))
+        linear = np.abs(k2) <= BILINEAR_TOLERANCE*scale
+        v_roots = np.stack([np.where(linear, np.nan, q/k2), k0/q])
+        v_roots[1] = np.where(linear & (k1 != 0), -k0/k1, v_roots[1])
+
+        # u along the direction between the edges at v
+        d = e[np.newaxis] + v_roots[..., np.newaxis]*g[np.newaxis]
+        dd = (d**2).sum(axis=2)
+        u_roots = ((h[np.newaxis] - v_roots[..., np.newaxis]*f[np.newaxis])*d).sum(axis=2)/dd
+        u_roots = np.where(dd > BILINEAR_TOLERANCE**2*scale, u_roots, np.nan)
+
+    # distance of each root outside the unit square, NaN roots never picked
+    outside = (np.maximum(0, -u_roots) + np.maximum(0, u_roots - 1) +
+               np.maximum(0, -v_roots) + np.maximum(0, v_roots - 1))
+    outside = np.where(np.isfinite(outside), outside, np.inf)
+    pick = np.argmin(outside, axis=0)
+    rows = np.arange(len(points))
+    u = u_roots[pick, rows]
+    v = v_roots[pick, rows]
+
+    weights = np.column_stack([u*v, (1-u)*v, (1-u)*(1-v), u*(1-v)])
+    weights[~np.isfinite(weights).all(axis=1)] = np.nan
+
+    return weights
+
+# Interpolates many points at once
+#
+# Arg: points, (N,2) ndarray of (x,y), corners, (N,4,3) ndarray of quadrant points (see quadrant_corners)
+#
+# Returns (N,) ndarray of interpolated z, NaN where the point can't be interpolated
+def interp_points(points, corners):
+
+    corners = np.asarray(corners, dtype=np.float64)
+    weights = bilinear_weights(points, corners)
+
+    return np.einsum('ij,ij->i', weights, corners[:, :, 2])
+
+# Accepts xyz points as args in each quadrant (e.g. rows of get_interpolants), and interpolates based on that.
+# Returns float64 ndarray (xc, yc, zc), zc NaN if the point can't be interpolated (e.g. a quadrant is NaN or None).
 def interp_point(interp_pnt, quad0, quad1, quad2, quad3):
 
     #point to interpolate
     xc = interp_pnt[0]
     yc = interp_pnt[1]
 
-    print(xc)
-    print(yc)
-
-    # quad coords
-    x0 = quad0[0]
-    y0 = quad0[1]
-    z0 = quad0[2]
-
-    x1 = quad1[0]
-    y1 = quad1[1]
-    z1 = quad1[2]
-
-    x2 = quad2[0]
-    y2 = quad2[1]
-    z2 = quad2[2]
-
-    x3 = quad3[0]
-    y3 = quad3[1]
-    z3 = quad3[2]
-
-    print(x0,y0,z0)
-    print(x1,y1,z1)
-    print(x2,y2,z2)
-    print(x3,y3,z3)
-
-    A1=x0
-    A2=y0
-    B1=x1-x0
-    B2=y1-y0
-    C1=x3-x0
-    C2=y3-y0
-    D1=x2-x1+x0-x3
-    D2=y2-y1+y0-y3
-
-    a = D1*B2 - D2*B1
-    b = D2*xc - D1*yc - D2*A1 + D1*A2 + C1*B2 - C2*B1
-    c = C2*xc - C1*yc + C1*A2 - C2*A1
-
-    dx = (-b+(b**2-4*a*c)**0.5)/(2*a)
-    if dx < 0 or dx > 1:
-        dx = (-b-(b**2-4*a*c)**0.5)/(2*a)
-
-    if (C1-D1*dx):
-        dy = (xc-A1-B1*dx)/(C1-D1*dx)
-    else:
-        dy = (xc-A2-B2*dx)/(C2-D2*dx)
+    corners = [quad if quad is not None else (np.nan, np.nan, np.nan) for quad in (quad0, quad1, quad2, quad3)]
+    zc = interp_points([(xc, yc)], [corners])[0]
+
+    return np.array([xc, yc, zc], dtype=np.float64)
+
+# Returns grid points ordered north up (first row is the largest y), as (N,2) ndarray
+#
+# grid.xy runs along x first, starting from the smallest y
+def grid_points(grid):
+    points = np.asarray(grid.xy, dtype=np.float64)
+    return points.reshape(grid.ny, grid.nx, 2)[::-1].reshape(-1, 2)
+
+# Returns a hex digest identifying the horizontal geometry of a mesh (or of any point array)
+def mesh_hash(element_coords):
+    coords = np.ascontiguousarray(np.asarray(element_coords, dtype=np.float64)[:, :2])
+    return hashlib.sha1(coords.tobytes()).hexdigest()
+
+# Returns a hex digest identifying the element table of a mesh (triangles and quads)
+def element_table_hash(element_table):
+    sizes = np.array([len(e) for e in element_table], dtype=np.int64)
+    nodes = np.concatenate([np.asarray(e, dtype=np.int64) for e in element_table])
+    return hashlib.sha1(sizes.tobytes() + nodes.tobytes()).hexdigest()
+
+# Version of the plan building algorithms. It is part of every plan cache key, so bump it when a
+# change gives different weights (e.g. 2: the inverse bilinear solve was fixed) and plans saved
+# before are built again.
+PLAN_VERSION = 2
+
+# Returns the cache key of a plan of some kind (e.g. "bilinear", "idw") with its options (e.g. power
+# and radius), on the geometry identified by hashes (e.g. mesh_hash of the mesh and of the grid points)
+def plan_key(kind, options, *hashes):
+    text = json.dumps({"version" : PLAN_VERSION, "kind" : kind, "options" : options, "geometry" : hashes}, sort_keys=True)
+    return "{}_{}".format(kind, hashlib.sha1(text.encode()).hexdigest())
+
+class ResamplingPlan:
+    """
+    Sparse weights mapping element values of a mesh onto the cells of a grid.
+    Built once per (mesh, grid) pair and applied to any item or timestep on that mesh.
+
+    Usage example:
+    plan = get_resampling_plan(grid, dfs.element_coordinates, cache_dir="plans")
+    z = plan.apply(ds.data[0][0])
+    """
+    def __init__(self, matrix, shape, valid=None, key=None):
+        self.matrix = sparse.csr_matrix(matrix)
+        self.shape = tuple(shape)
+        self.key = key
+        # cells without any weights can't be interpolated and are NaN in the output
+        if valid is None:
+            valid = np.diff(self.matrix.indptr) > 0
+        self.valid = np.asarray(valid, dtype=bool)
+
+    # Builds a plan from per cell element indices and weights, both (ncells, k) ndarrays.
+    # Cells with a negative index or any NaN weight are left empty.
+    @classmethod
+    def from_weights(cls, indices, weights, n_elements, shape, key=None):
+
+        indices = np.asarray(indices)
+        weights = np.asarray(weights, dtype=np.float64)
+        valid = (indices >= 0).all(axis=1) & np.isfinite(weights).all(axis=1)
+
+        rows = np.repeat(np.arange(len(indices)), indices.shape[1]).reshape(indices.shape)
+        matrix = sparse.csr_matrix((weights[valid].ravel(), (rows[valid].ravel(), indices[valid].ravel())),
+                                   shape=(len(indices), n_elements))
+
+        return cls(matrix, shape, valid, key)
+
+    # Applies the plan to element data
+    #
+    # Arg: data, (n_elements,) or (n_timesteps, n_elements) ndarray
+    #
+    # Returns float32 ndarray of shape (ny, nx) or (n_timesteps, ny, nx), NaN where cells are invalid
+    def apply(self, data):
+
+        data = np.asarray(data, dtype=np.float64)
+        z = self.matrix.dot(data.T).T.astype(np.float32)
+        z[..., ~self.valid] = np.nan
+
+        return z.reshape(data.shape[:-1] + self.shape)
+
+    # Same as apply for (n_elements,) data, but yields the grid block_rows rows at a time, top to
+    # bottom, as float32 ndarrays of shape (rows, nx), so the whole grid is never in memory
+    def iter_rows(self, data, block_rows=256):
+
+        data = np.asarray(data, dtype=np.float64)
+        ny, nx = self.shape
+        for row in range(0, ny, block_rows):
+            cells = slice(row*nx, min(row + block_rows, ny)*nx)
+            z = self.matrix[cells].dot(data).astype(np.float32)
+            z[~self.valid[cells]] = np.nan
+            yield z.reshape(-1, nx)
+
+    def save(self, filename):
+        np.savez(filename, data=self.matrix.data, indices=self.matrix.indices, indptr=self.matrix.indptr,
+                 matrix_shape=self.matrix.shape, shape=self.shape, valid=self.valid, key=str(self.key))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as f:
+            matrix = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape=tuple(f["matrix_shape"]))
+            return cls(matrix, tuple(f["shape"]), f["valid"], str(f["key"]))
+
+# Builds a resampling plan doing the same bilinear interpolation as interp_grid
+def build_bilinear_plan(grid, element_coords, key=None):
+
+    points = grid_points(grid)
+    ids = QuadrantIndex(element_coords).query_many(points)
+    corners = quadrant_corners(ids, element_coords, np.zeros(len(element_coords)))
+    weights = bilinear_weights(points, corners)
+
+    return ResamplingPlan.from_weights(ids, weights, len(element_coords), (grid.ny, grid.nx), key)
+
+# Builds a resampling plan for inverse distance to a power using every element within radius
+# of a cell, the same as GDAL's invdistnn algorithm with max_points=0. A cell on top of an
+# element takes that element's value, cells without elements in range are left empty.
+#
+# The weights are found for a block of rows at a time, each with at most about MAX_PAIRS
+# (cell, element) pairs, so memory beyond the plan itself doesn't grow with the grid.
+#
+# Arg: element_coords, cell_points (N,2) ndarray of cell centres row by row, shape (ny, nx) of the grid
+#
+# Example usage:
+#   plan = build_idw_plan(dfs.element_coordinates, cells, (ny, nx), power=2.0, radius=25.0)
+#
+def build_idw_plan(element_coords, cell_points, shape, power=2.0, radius=25.0, smoothing=0.0, key=None):
+
+    coords = np.asarray(element_coords, dtype=np.float64)[:, :2]
+    cell_points = np.asarray(cell_points, dtype=np.float64)
+    tree = cKDTree(coords)
+
+    # rows of cells per block from the number of elements in range of each row
+    nx = shape[1]
+    counts = tree.query_ball_point(cell_points, radius, return_length=True).reshape(-1, nx).sum(axis=1)
+    total = np.cumsum(counts)
+    n_pairs = int(total[-1]) if len(total) else 0
+    ends = np.searchsorted(total, np.arange(MAX_PAIRS, n_pairs, MAX_PAIRS), side="right")
+    ends = np.unique(np.append(ends[ends > 0], len(counts)))
+
+    # the blocks are copied into arrays big enough for every pair, cells on top of an element have fewer
+    data = np.empty(n_pairs)
+    indices = np.empty(n_pairs, dtype=np.int32 if max(n_pairs, len(coords)) < 2**31 else np.int64)
+    indptr = np.zeros(len(cell_points) + 1, dtype=indices.dtype)
+    nnz = 0
+    start = 0
+    for end in ends[ends > 0]:
+        block = idw_weights(tree, cell_points[start*nx:end*nx], power, radius, smoothing)
+        data[nnz:nnz + block.nnz] = block.data
+        indices[nnz:nnz + block.nnz] = block.indices
+        indptr[start*nx + 1:end*nx + 1] = block.indptr[1:] + nnz
+        nnz += block.nnz
+        start = end
+    block = None
+
+    matrix = sparse.csr_matrix((data[:nnz], indices[:nnz], indptr), shape=(len(cell_points), len(coords)))
+
+    return ResamplingPlan(matrix, shape, key=key)
+
+# Returns the sparse (cells, elements) IDW weights of cells from elements in a cKDTree (see build_idw_plan)
+def idw_weights(tree, cell_points, power, radius, smoothing):
+
+    pairs = cKDTree(cell_points).sparse_distance_matrix(tree, radius, output_type="ndarray")
+    rows, cols, dist2 = pairs["i"], pairs["j"], pairs["v"]**2 + smoothing**2
+    pairs = None
+
+    # cells on top of an element use only the lowest numbered such element
+    exact = dist2 < 1e-13
+    first = np.full(len(cell_points), np.iinfo(np.int64).max)
+    np.minimum.at(first, rows[exact], cols[exact])
+    snapped = first[rows] != np.iinfo(np.int64).max
+    keep = ~snapped | (cols == first[rows])
+
+    rows, cols, dist2, snapped = rows[keep], cols[keep], dist2[keep], snapped[keep]
+    with np.errstate(divide='ignore'):
+        weights = np.where(snapped, 1.0, 1.0/dist2**(power/2.0))
+    weights /= np.bincount(rows, weights, minlength=len(cell_points))[rows]
+
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(len(cell_points), tree.n))
+
+# Splits the elements of a mesh into triangles, quads (n0, n1, n2, n3) into (n0, n1, n2) and (n0, n2, n3)
+#
+# Arg: element_table, list of node index arrays from Dfsu.element_table (triangles and quads)
+#
+# Returns ((T,3) int32 ndarray of triangle nodes, (T,) int32 ndarray of the element of each triangle)
+def triangulate(element_table):
+
+    triangles = []
+    elements = []
+    for e, nodes in enumerate(element_table):
+        triangles.append(nodes[:3])
+        elements.append(e)
+        if len(nodes) == 4:
+            triangles.append([nodes[0], nodes[2], nodes[3]])
+            elements.append(e)
 
-    zc = (1-dx)*(1-dy)*z2 + dx*(1-dy)*z3 + (1-dx)*dy*z1 + dx*dy*z0
+    return np.array(triangles, dtype=np.int32), np.array(elements, dtype=np.int32)
 
-    print(dx, dy)
-    print((1-dx)*(1-dy)*z2)
-    print(dx*(1-dy)*z3)
-    print((1-dx)*dy*z1)
-    print(dx*dy*z0)
+# Returns (N,k,3) barycentric weights of (N,2) points in (N,k,3,2) triangle corners, NaN for
+# degenerate triangles
+def barycentric_weights(points, corners):
 
-    return (xc, yc, zc)
+    a, b, c = corners[..., 0, :], corners[..., 1, :], corners[..., 2, :]
+    p = points[:, np.newaxis, :]
+    v0, v1, v2 = b - a, c - a, p - a
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        den = v0[..., 0]*v1[..., 1] - v1[..., 0]*v0[..., 1]
+        w1 = (v2[..., 0]*v1[..., 1] - v1[..., 0]*v2[..., 1])/den
+        w2 = (v0[..., 0]*v2[..., 1] - v2[..., 0]*v0[..., 1])/den
+
+    return np.stack([1 - w1 - w2, w1, w2], axis=-1)
+
+# Returns sparse (n_nodes, n_elements) matrix averaging the values of the elements around each node
+def node_averaging_matrix(element_table, n_nodes):
+
+    nodes = np.concatenate([np.asarray(e) for e in element_table]).astype(np.int64)
+    elements = np.repeat(np.arange(len(element_table)), [len(e) for e in element_table])
+    counts = np.bincount(nodes, minlength=n_nodes)
+
+    return sparse.csr_matrix((1.0/counts[nodes], (nodes, elements)), shape=(n_nodes, len(element_table)))
+
+# Builds a resampling plan interpolating within the mesh: element values are averaged to the nodes,
+# and each cell takes the barycentric interpolation of the node values of the triangle (half quad)
+# containing it. Cells outside the mesh are left empty. The two steps are composed into one matrix.
+#
+# Arg: node_coords, element_table from Dfsu.node_coordinates and Dfsu.element_table,
+#      cell_points (N,2) ndarray of cell centres, shape (ny, nx) of the grid
+#
+# Example usage:
+#   plan = build_mesh_plan(dfs.node_coordinates, dfs.element_table, grid_points(grid), (grid.ny, grid.nx))
+#
+def build_mesh_plan(node_coords, element_table, cell_points, shape, key=None):
+
+    nodes, weights, _ = MeshLocator(node_coords, element_table).locate(cell_points)
+    valid = nodes[:, 0] >= 0
+
+    rows = np.repeat(np.arange(len(nodes)), 3).reshape(nodes.shape)
+    to_nodes = sparse.csr_matrix((weights[valid].ravel(), (rows[valid].ravel(), nodes[valid].ravel())),
+                                 shape=(len(nodes), len(node_coords)))
+    matrix = to_nodes.dot(node_averaging_matrix(element_table, len(node_coords)))
+
+    return ResamplingPlan(matrix, shape, valid, key)
+
+# Returns a plan with the given key (see plan_key) from cache_dir, or builds it with build() and saves
+# it there. A file whose stored key differs, e.g. from a name clash, is built again.
+def cached_plan(key, build, cache_dir=None):
+
+    if cache_dir is None:
+        return build()
+
+    filename = os.path.join(cache_dir, "{}.npz".format(key))
+    if os.path.exists(filename):
+        plan = ResamplingPlan.load(filename)
+        if plan.key == key:
+            logging.info("Loaded resampling plan from {}".format(filename))
+            return plan
+        logging.warning("Rebuilding resampling plan {}, the cached one is for {}".format(key, plan.key))
+
+    plan = build()
+    plan.key = key
+    os.makedirs(cache_dir, exist_ok=True)
+    plan.save(filename)
+    logging.info("Saved resampling plan to {}".format(filename))
+
+    return plan
+
+# Returns a mesh resampling plan (see build_mesh_plan) for a grid, loading it from cache_dir if one
+# was saved before for the same mesh and grid
+#
+# Example usage:
+#   plan = get_mesh_plan(grid, dfs.node_coordinates, dfs.element_table, "C:/some/cache/folder")
+#
+def get_mesh_plan(grid, node_coords, element_table, cache_dir=None):
+
+    points = grid_points(grid)
+    key = plan_key("mesh", {}, mesh_hash(node_coords), element_table_hash(element_table), mesh_hash(points))
+
+    return cached_plan(key, lambda: build_mesh_plan(node_coords, element_table, points, (grid.ny, grid.nx), key),
+                       cache_dir)
+
+# Returns a bilinear resampling plan, loading it from cache_dir if one was saved before for the
+# same mesh and grid. The cache file name is the plan_key of the plan version, search distance and
+# hashes of the mesh and grid geometry.
+#
+# Example usage:
+#   plan = get_resampling_plan(grid, dfs.element_coordinates, "C:/some/cache/folder")
+#
+def get_resampling_plan(grid, element_coords, cache_dir=None):
+
+    key = plan_key("bilinear", {"max_search_distance" : MAX_SEARCH_DISTANCE}, mesh_hash(element_coords),
+                   mesh_hash(grid_points(grid)))
+
+    return cached_plan(key, lambda: build_bilinear_plan(grid, element_coords, key), cache_dir)
 
 # interpolate the entire grid
 #
 # Takes as arguments
 # mikeio Grid, and mikeio Dfsu.element_coords
-def interp_grid(grid, element_coords, dfs_data):
-
-    z = []
+# optional ResamplingPlan for the same mesh and grid, so the setup isn't repeated per item/timestep
+#
+# Returns float32 ndarray of shape (grid.ny, grid.nx), north up (first row is the largest y),
+# NaN where the grid point can't be interpolated. With return_mask=True returns (array, mask),
+# mask a boolean ndarray of the same shape, True where the grid point has a value.
+def interp_grid(grid, element_coords, dfs_data, plan=None, return_mask=False):
 
-    # interpolate each z in grid
-    for pnt in grid.xy:
+    if plan is None:
+        plan = build_bilinear_plan(grid, element_coords)
 
-        # get nearest 4 points
-        interpolants = get_interpolants(pnt, element_coords, dfs_data)
-        # interpolate grid point based on 4 nearest points
-        z_int = interp_point(pnt, interpolants[0], interpolants[1], interpolants[2], interpolants[3])
-        z.append(z_int)
+    z = plan.apply(dfs_data)
+    if return_mask:
+        return z, ~np.isnan(z)
 
     return z
 
-def write_to_shp(filename, grid, z):
+# Returns the GDAL geotransform of the raster interp_grid makes from a grid, whose points are cell centres
+def grid_geotransform(grid):
+    return (grid.x0 - grid.dx/2, grid.dx, 0.0, grid.y1 + grid.dy/2, 0.0, -grid.dy)
 
-    new_dataset = rasterio.open(
-        filename,
-        'w',
-        driver='GTiff',
-        height= grid.ny,
-        width= grid.nx,
-        count=1,
-        dtype=z.dtype,
-        crs=rasterio.crs.CRS.from_string("ETRS_1989_UTM_Zone_32N")
-    )
+# Writes an interp_grid array, or chunks of its rows from top to bottom (e.g. ResamplingPlan.iter_rows),
+# to a tiled and compressed ("DEFLATE" or "LZW") float32 GeoTIFF on the grid's origin and cell size.
+# NaN, and cells where mask is False, are written as nodata. Chunks are written as they come, so
+# huge grids don't have to be in memory. With cog=True a cloud optimized GeoTIFF is written.
+#
+# Example usage:
+#   z, mask = interp_grid(grid, dfs.element_coordinates, ds.data[0][0], return_mask=True)
+#   write_to_shp("bilinear.tif", grid, z, mask, crs="EPSG:25832")
+#   write_to_shp("bilinear.tif", grid, plan.iter_rows(ds.data[0][0]), cog=True)
+#
+def write_to_shp(filename, grid, z, mask=None, crs=None, nodata=-9999, compress="DEFLATE", cog=False, block_rows=256):
 
-    new_dataset.write(z, 1)
-    new_dataset.close()
+    import busybeaver.rasters as bbrasters
 
-    return None
+    if isinstance(z, np.ndarray):
+        z = z.reshape(grid.ny, grid.nx)
+        rows = (z[row:row + block_rows] for row in range(0, grid.ny, block_rows))
+    else:
+        rows = z
+    if mask is not None:
+        mask = np.asarray(mask).reshape(grid.ny, grid.nx)
+        rows = masked_rows(rows, mask)
+
+    bbrasters.write_tif_rows(filename, rows, grid.nx, grid.ny, grid_geotransform(grid),
+                             nodata=nodata, crs=crs, compress=compress, cog=cog)
+
+    return filename
+
+# Yields chunks of rows with cells where mask is False set to NaN
+def masked_rows(rows, mask):
+    row = 0
+    for z in rows:
+        yield np.where(mask[row:row + len(z)], z, np.nan)
+        row += len(z)
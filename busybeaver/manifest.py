@@ -0,0 +1,88 @@
+# This module keeps track of what each process in a model last ran with, so processes whose
+# inputs and outputs haven't changed can be skipped on the next run
+
+import hashlib
+import json
+import logging
+import os
+
+# fingerprintPath
+# Returns a fingerprint of a file (mtime, size and optionally a hash of its contents),
+# or of whether a folder (e.g. a gdb) exists. Returns None if path isn't a path on disk.
+#
+def fingerprintPath(path, hash_contents=False):
+
+    if not isinstance(path, str) or not os.path.exists(path):
+        return None
+
+    if os.path.isdir(path):
+        return {"dir" : True}
+
+    stat = os.stat(path)
+    fingerprint = {"mtime" : stat.st_mtime_ns, "size" : stat.st_size}
+    if hash_contents:
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        fingerprint["sha1"] = sha1.hexdigest()
+
+    return fingerprint
+
+# fingerprintProcess
+# Returns a fingerprint of a process from its args and the files they point to, plus fingerprints
+# of its outputs (dict of location to fingerprint, None for outputs which don't exist)
+#
+def fingerprintProcess(process, outputs=None, hash_contents=False):
+
+    files = {}
+    for path in process.args:
+        fingerprint = fingerprintPath(path, hash_contents)
+        if fingerprint is not None:
+            files[os.path.abspath(path)] = fingerprint
+    for location, fingerprint in (outputs or {}).items():
+        if fingerprint is not None:
+            files[location] = fingerprint
+
+    return {"args" : [repr(arg) for arg in process.args], "files" : files}
+
+class Manifest:
+    """
+    Fingerprints of the processes in a model from their last run, saved as json.
+
+    Usage example:
+    manifest = Manifest("C:/some/path/to/mymodel_manifest.json")
+    if not manifest.isUpToDate("0:createGDB", fingerprint):
+        ...
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logging.warning("Ignoring unreadable manifest {}.".format(filename))
+
+    # Returns manifest for a model, kept next to its MODEL_GDB_PATH, or None if that isn't set
+    @classmethod
+    def forModel(cls, model):
+        gdb_path = model.params.get("MODEL_GDB_PATH")
+        if gdb_path is None:
+            return None
+        return cls("{}_manifest.json".format(os.path.splitext(os.path.abspath(gdb_path))[0]))
+
+    def isUpToDate(self, key, fingerprint):
+        return self.entries.get(key) == fingerprint
+
+    def record(self, key, fingerprint):
+        self.entries[key] = fingerprint
+        self.save()
+
+    def save(self):
+        folder = os.path.dirname(self.filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(self.filename, "w") as f:
+            json.dump(self.entries, f, indent=1)
@@ -0,0 +1,296 @@
+# This module includes a cache of mesh geometry shared by the models of a Hut. Models whose dfsu
+# files have the same mesh (same mesh_hash of the element coordinates) share the coordinates,
+# element table and overset grid, and the resampling plans built on them (e.g. the IDW plan),
+# instead of each rebuilding them. Plans are only built when first asked for. The arrays are put
+# in shared memory, so parallel workers attach to them without copying.
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import util
+import numpy as np
+from scipy import sparse
+import busybeaver.interpolation as bbinterp
+
+# Seconds to wait for another process to finish writing a mesh before building it again
+ATTACH_TIMEOUT = 60
+
+# Bytes before the json header of a segment: its length, then the pid of the process writing it
+PREFIX_SIZE = 16
+
+# Byte alignment of arrays in a shared memory segment
+ALIGNMENT = 64
+
+# Outer bounds and size of the overset grid of a mesh, same attributes as a mikeio grid
+GridDefinition = namedtuple("GridDefinition", ["x0", "y0", "x1", "y1", "nx", "ny"])
+
+# Meshes already built or attached by this process, by mesh hash
+MESHES = {}
+
+# (pid, segment) of shared memory segments created, each unlinked by clear() in the process that
+# created it. Forked workers inherit the list, hence the pid.
+CREATED = []
+
+# Held while attaching to a segment without registering it (see open_segment)
+TRACKER_LOCK = threading.Lock()
+
+class Mesh:
+    """
+    Geometry of a dfsu mesh and the resampling plans built on it for gridding. Arrays are views
+    into shared memory when available, so treat them as read only.
+
+    Usage example:
+    mesh = get_mesh(dfs.element_coordinates, dfs.element_table, build)
+    plan = mesh.plan("idw", lambda: build_idw_plan(mesh.coords, cells, (mesh.grid.ny, mesh.grid.nx)))
+    z = plan.apply(ds.data[0])
+    """
+    def __init__(self, key, arrays, segment=None):
+        self.key = key
+        self.coords = arrays["coords"]
+        self.element_table = arrays["element_table"]
+        self.grid = GridDefinition(*arrays["grid"][:4], int(arrays["grid"][4]), int(arrays["grid"][5]))
+        self.geotransform = tuple(arrays["geotransform"])
+        # segments have to stay open while the arrays are in use
+        self.segment = segment
+        self.plans = {}
+        self.plan_segments = {}
+
+    # Returns the ResamplingPlan called name for this mesh, from this process, from shared memory,
+    # from cache_dir if given (see interpolation.cached_plan) or, if none has it, by calling build().
+    # Names are short (a few letters) as they are part of the shared memory segment's name. options
+    # (e.g. power and radius) are the settings build() uses, part of the plan's key in cache_dir.
+    def plan(self, name, build, cache_dir=None, options=None):
+        if name not in self.plans:
+            key = bbinterp.plan_key(name, dict(options or {}, grid=[float(v) for v in self.grid]), self.key)
+            segment, arrays = share(segment_name(self.key, name),
+                                    lambda: plan_arrays(bbinterp.cached_plan(key, build, cache_dir)))
+            matrix = sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]),
+                                       shape=tuple(int(n) for n in arrays["matrix_shape"]))
+            shape = tuple(int(n) for n in arrays["shape"])
+            self.plans[name] = bbinterp.ResamplingPlan(matrix, shape, arrays["valid"], key)
+            self.plan_segments[name] = segment
+        return self.plans[name]
+
+# Returns dict of the arrays making up a mesh
+def mesh_arrays(element_coords, element_table, grid, geotransform):
+
+    # element tables are ragged (triangles and quads), pad them with -1
+    table = np.full((len(element_table), max(len(e) for e in element_table)), -1, dtype=np.int32)
+    for i, nodes in enumerate(element_table):
+        table[i, :len(nodes)] = nodes
+
+    return {"coords" : np.ascontiguousarray(element_coords, dtype=np.float64),
+            "element_table" : table,
+            "grid" : np.array([grid.x0, grid.y0, grid.x1, grid.y1, grid.nx, grid.ny], dtype=np.float64),
+            "geotransform" : np.array(geotransform, dtype=np.float64)}
+
+# Returns dict of the arrays making up a ResamplingPlan
+def plan_arrays(plan):
+    return {"data" : plan.matrix.data,
+            "indices" : plan.matrix.indices,
+            "indptr" : plan.matrix.indptr,
+            "matrix_shape" : np.array(plan.matrix.shape, dtype=np.int64),
+            "shape" : np.array(plan.shape, dtype=np.int64),
+            "valid" : plan.valid}
+
+# Returns name of the shared memory segment of a mesh, or of one of its plans (kept short for macOS)
+def segment_name(key, name=""):
+    return "bb{}_{}".format(name, key[:24 - len(name)])
+
+# Copies arrays into a new shared memory segment. The pid of this process is written first, the
+# header (its length, then a json map of array name to dtype, shape and offset) last, so a non zero
+# length means it is complete.
+#
+# Returns (segment, dict of arrays in the segment), or (None, None) if the segment already exists
+def create_segment(name, arrays):
+
+    from multiprocessing import shared_memory
+
+    layout = {}
+    offset = 0
+    for key, arr in arrays.items():
+        layout[key] = [arr.dtype.str, list(arr.shape), offset]
+        offset += -(-arr.nbytes // ALIGNMENT)*ALIGNMENT
+    header = json.dumps(layout).encode()
+    start = -(-(PREFIX_SIZE + len(header)) // ALIGNMENT)*ALIGNMENT
+
+    try:
+        segment = shared_memory.SharedMemory(name=name, create=True, size=start + max(offset, 1))
+    except FileExistsError:
+        return None, None
+    segment.buf[8:PREFIX_SIZE] = np.uint64(os.getpid()).tobytes()
+
+    views = {}
+    for key, (dtype, shape, arr_offset) in layout.items():
+        views[key] = np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=start + arr_offset)
+        views[key][...] = arrays[key]
+    segment.buf[PREFIX_SIZE:PREFIX_SIZE + len(header)] = header
+    segment.buf[:8] = np.uint64(len(header)).tobytes()
+
+    return segment, views
+
+# Attaches to a shared memory segment written by create_segment, waiting up to timeout seconds for
+# it to be complete. A segment left incomplete by a process that died (e.g. a crashed run) is
+# unlinked, so the caller can create it again.
+#
+# Returns (segment, dict of arrays in the segment), or (None, None) if there is no complete segment
+def attach_segment(name, timeout=ATTACH_TIMEOUT):
+
+    try:
+        segment = open_segment(name)
+    except FileNotFoundError:
+        return None, None
+
+    waited = 0.0
+    while int(np.frombuffer(segment.buf[:8], dtype=np.uint64)[0]) == 0:
+        creator = int(np.frombuffer(segment.buf[8:PREFIX_SIZE], dtype=np.uint64)[0])
+        if creator != 0 and not pid_alive(creator):
+            logging.warning("Removing shared memory {} left incomplete by process {}".format(name, creator))
+            unlink_segment(segment)
+            return None, None
+        if waited >= timeout:
+            segment.close()
+            return None, None
+        time.sleep(0.05)
+        waited += 0.05
+
+    length = int(np.frombuffer(segment.buf[:8], dtype=np.uint64)[0])
+    layout = json.loads(bytes(segment.buf[PREFIX_SIZE:PREFIX_SIZE + length]).decode())
+    start = -(-(PREFIX_SIZE + length) // ALIGNMENT)*ALIGNMENT
+    views = {}
+    for key, (dtype, shape, arr_offset) in layout.items():
+        views[key] = np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=start + arr_offset)
+        views[key].flags.writeable = False
+
+    return segment, views
+
+# Opens an existing shared memory segment without registering it with this process' resource
+# tracker. Before python 3.13 attaching registers it, and a worker's tracker then unlinks a segment
+# its creator still owns when the worker exits. Unregistering after attaching isn't enough, as a
+# tracker shared with the creator (forked after it started) would lose the creator's registration.
+def open_segment(name):
+
+    from multiprocessing import shared_memory
+
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    from multiprocessing import resource_tracker
+
+    with TRACKER_LOCK:
+        register = resource_tracker.register
+        resource_tracker.register = lambda res, rtype: None if rtype == "shared_memory" else register(res, rtype)
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+# Closes and unlinks a segment opened by open_segment, without unregistering it from this process'
+# resource tracker that never registered it
+def unlink_segment(segment):
+
+    from multiprocessing import resource_tracker
+
+    segment.close()
+    with TRACKER_LOCK:
+        unregister = resource_tracker.unregister
+        if sys.version_info < (3, 13):
+            resource_tracker.unregister = lambda res, rtype: None if rtype == "shared_memory" else unregister(res, rtype)
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            # unlinked by another process that found it first
+            pass
+        finally:
+            resource_tracker.unregister = unregister
+
+# Returns False if no process has this pid. On Windows shared memory is freed with its last handle,
+# so a segment can't outlive the process writing it and this always returns True. A reused pid
+# only means waiting for the timeout as before.
+def pid_alive(pid):
+
+    if os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but owned by another user
+        pass
+    return True
+
+# Returns (segment, arrays) for a shared memory segment, attaching to it if another process or
+# model already made it, or else calling build() for the arrays and copying them into a new one.
+# segment is None if shared memory isn't available (python < 3.8), the arrays are then this
+# process' own.
+def share(name, build):
+
+    try:
+        segment, arrays = attach_segment(name)
+    except ImportError:
+        return None, build()
+    if arrays is not None:
+        logging.debug("Attached to shared memory {}".format(name))
+        return segment, arrays
+
+    logging.debug("Building {}".format(name))
+    arrays = build()
+    created, views = create_segment(name, arrays)
+    if views is not None:
+        # unlink at exit, which for pool workers is when the Hut's pool shuts down
+        if not any(pid == os.getpid() for pid, _ in CREATED):
+            util.Finalize(None, clear, exitpriority=0)
+        CREATED.append((os.getpid(), created))
+        return created, views
+
+    # another process created it first
+    attached, views = attach_segment(name)
+    if views is not None:
+        return attached, views
+    return None, arrays
+
+# get_mesh
+# Returns the Mesh for some element coordinates. Looks in this process, then in shared memory
+# for a mesh put there by another model or worker, and only calls build() if neither has it.
+#
+# Arg: build, function returning (grid, geotransform) for the mesh
+#
+# Example usage:
+#   mesh = get_mesh(coords, dfs.element_table, lambda: (grid, geotransform))
+#
+def get_mesh(element_coords, element_table, build):
+
+    key = bbinterp.mesh_hash(element_coords)
+    if key not in MESHES:
+        segment, arrays = share(segment_name(key), lambda: mesh_arrays(element_coords, element_table, *build()))
+        MESHES[key] = Mesh(key, arrays, segment)
+
+    return MESHES[key]
+
+# Drops all meshes of this process and unlinks the shared memory it created
+def clear():
+
+    for mesh in MESHES.values():
+        mesh.plans.clear()
+        mesh.plan_segments.clear()
+        mesh.segment = None
+    MESHES.clear()
+    for pid, segment in CREATED:
+        if pid != os.getpid():
+            continue
+        try:
+            segment.close()
+        except BufferError:
+            # arrays still in use elsewhere, the memory is freed when they are
+            pass
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            # already unlinked, e.g. by a resource tracker
+            pass
+    del CREATED[:]
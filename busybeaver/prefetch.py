@@ -0,0 +1,72 @@
+# This module includes a prefetching reader, which reads the next chunk of a file (e.g. the next
+# timesteps of a dfsu) on a background thread while the current chunk is being processed
+
+import queue
+import threading
+
+# Number of chunks read ahead and waiting for the consumer
+PREFETCH_DEPTH = 1
+
+class Prefetcher:
+    """
+    Calls read(chunk) for each chunk in order on a background thread, starting as soon as it is
+    created, and iterates over (chunk, read(chunk)). At most depth chunks wait in the queue, so no
+    more than depth + 2 chunks (waiting, being read, being processed) are in memory. Errors from
+    read are raised in the consumer. depth=0 reads in the consumer's thread instead.
+
+    read is called from another thread, so give it its own file handle, not one also used for writing.
+
+    Usage example:
+    reader = Dfsu("mydfsu.dfsu")
+    with Prefetcher(lambda chunk: reader.read(items=["Current direction"], time_steps=chunk), chunks) as reads:
+        for time_steps, ds in reads:
+            ...
+    """
+    def __init__(self, read, chunks, depth=PREFETCH_DEPTH):
+        self.read = read
+        self.chunks = list(chunks)
+        self.depth = depth
+        self.results = queue.Queue(maxsize=max(depth, 1))
+        self.stop = threading.Event()
+        self.thread = None
+        if depth >= 1:
+            self.thread = threading.Thread(target=self._worker, name="busybeaver-prefetch", daemon=True)
+            self.thread.start()
+
+    def _worker(self):
+        for chunk in self.chunks:
+            try:
+                result = (chunk, self.read(chunk), None)
+            except Exception as e:
+                result = (chunk, None, e)
+            # wait for room in the queue, unless the consumer has stopped
+            while not self.stop.is_set():
+                try:
+                    self.results.put(result, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if self.stop.is_set() or result[2] is not None:
+                return
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            if self.thread is None:
+                yield chunk, self.read(chunk)
+                continue
+            chunk, data, error = self.results.get()
+            if error is not None:
+                raise error
+            yield chunk, data
+
+    # Stops the background thread, waiting for a read in progress to finish
+    def close(self):
+        self.stop.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
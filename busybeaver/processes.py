@@ -4,7 +4,16 @@ from mikeio.eum import ItemInfo, EUMType, EUMUnit
 from mikeio import Dataset
 import gdal
 from osgeo import ogr
+import busybeaver.interpolation as bbinterp
+import busybeaver.rasters as bbrasters
+import busybeaver.meshcache as bbmesh
+import busybeaver.prefetch as bbprefetch
+import busybeaver.vectors as bbvectors
+import busybeaver.ascgrid as bbasc
+import io
+import numbers
 import os
+import uuid
 import logging
 
 def TEMPORARY(*args):
@@ -15,31 +24,164 @@ def FOR_TESTING_ONLY(*args):
     return [*args]
 
 # extractDirectionFromDfsu
-# Saves direction from specified timestep to a new dfsu
+# Saves direction from specified timestep(s) to a new dfsu
 # Useful for dealing with large dfsu files
 #
+# Timesteps are read, converted and appended to the new dfsu chunk_size at a time, so memory
+# use stays the same however many timesteps or elements there are. The next chunk is read while
+# the current one is converted. Bytes read and written are logged for every chunk: bytes read is
+# the size of the direction values read, bytes written is how much the output file grew, so a
+# chunk the writer buffered is counted with a later one (the rest is added to the last chunk once
+# the file is closed).
+#
 # Example usage:
 #   extractDirectionFromDfsu("mydfsu.dfsu", "mydfsu_direction", 30)  
+#   extractDirectionFromDfsu("mydfsu.dfsu", "mydfsu_direction", range(0, 200), chunk_size=20)  
 # 
 # Assumes
 #   -input dfsu has item Current direction in radians
+#   -timesteps in a range or list are equally spaced (the new dfsu gets a fixed time step)
+#
+# Returns list with bytes read and written for each chunk
 #  
-def extractDirectionFromDfsu(input_dfsu, output_dfsu, timestep):
+def extractDirectionFromDfsu(input_dfsu, output_dfsu, timestep, chunk_size=10):
 
-    # Make sure timestep is an integer and not string
-    timestep = int(timestep)
+    # Make sure timesteps are integers and not strings
+    if isinstance(timestep, (numbers.Integral, str)):
+        timestep = [timestep]
+    time_steps = [int(t) for t in timestep]
 
-    # Open dfsu and read specified timestep, then convert rads to degs
     dfs = Dfsu(input_dfsu)
-    ds = dfs.read(time_steps=timestep)
-    direction = np.rad2deg(ds["Current direction"])
-
-    # Create new dataset for the specified timestep
     items = [ItemInfo("Current direction", EUMType.Current_Direction, EUMUnit.degree)]
-    newds = Dataset([direction], ds.time, items)
+    dt = dfs.timestep * (time_steps[1] - time_steps[0]) if len(time_steps) > 1 else dfs.timestep
+
+    # Next chunk is read on a background thread while the current one is converted and written
+    reader = Dfsu(input_dfsu)
+    chunks = [time_steps[start:start + chunk_size] for start in range(0, len(time_steps), chunk_size)]
+    stats = []
+    with bbprefetch.Prefetcher(lambda chunk: reader.read(items=["Current direction"], time_steps=chunk), chunks) as reads:
+        for n, (chunk, ds) in enumerate(reads):
+            start = n*chunk_size
+
+            # Convert rads to degs in place
+            direction = ds["Current direction"]
+            bytes_read = direction.nbytes
+            np.rad2deg(direction, out=direction)
+
+            # Write first chunk to new dfsu, then append the rest
+            newds = Dataset([direction], ds.time, items)
+            if start == 0:
+                dfs.write(output_dfsu, newds, start_time=ds.time[0], dt=dt, keep_open=True)
+            else:
+                dfs.append(newds)
+            bytes_written = fileSize(output_dfsu) - sum(stat["bytes_written"] for stat in stats)
+
+            logging.info("Extracted direction for timesteps {} to {}: {} bytes read, {} bytes written.".format(
+                chunk[0], chunk[-1], bytes_read, bytes_written))
+            stats.append({"time_steps" : chunk, "bytes_read" : bytes_read, "bytes_written" : bytes_written})
+            ds = None
+            newds = None
+            direction = None
+
+    dfs.close()
+    if stats:
+        stats[-1]["bytes_written"] += fileSize(output_dfsu) - sum(stat["bytes_written"] for stat in stats)
+
+    return stats
+
+# Returns the size of a file in bytes, 0 if it doesn't exist (yet)
+def fileSize(filename):
+    return os.stat(filename).st_size if os.path.exists(filename) else 0
+
+# vectorProductsFromDfsu
+# Computes current speed and direction products from the U and V velocity items of a dfsu over
+# many timesteps, for when the dfsu has no Current direction item or a single timestep isn't enough:
+#   "Maximum current speed"      - highest speed of each element
+#   "Maximum speed direction"    - direction at the timestep where speed peaks, per element
+#   "Mean current direction"     - circular mean of the direction
+# Directions are in degrees clockwise from north, like MIKE's Current direction.
+#
+# Timesteps are read chunk_size at a time (the next chunk while the current one is summarised).
+# The products are written as one timestep to output_dfsu, and/or one direction product
+# ("max_speed_direction" or "mean_direction") is gridded to asc_file, e.g. to DIRECTION_2D_ASC to
+# go through the usual processASC_2DDirection. Direction is gridded by its unit vector components,
+# so it doesn't average across north (e.g. 350 and 10 give 0 and not 180).
+#
+# Example usage:
+#   vectorProductsFromDfsu("mydfsu.dfsu", "mydfsu_vectors.dfsu", "direction.asc")
+#   vectorProductsFromDfsu("mydfsu.dfsu", None, "direction.asc", product="mean_direction", time_steps=range(30, 100))
+#
+# Returns the VectorSummary
+#
+def vectorProductsFromDfsu(input_dfsu, output_dfsu=None, asc_file=None, product="max_speed_direction",
+                           time_steps=None, u_item="U velocity", v_item="V velocity", chunk_size=10):
+
+    if product not in ("max_speed_direction", "mean_direction"):
+        raise ValueError("Unknown direction product: {}".format(product))
+
+    dfs = Dfsu(input_dfsu)
+    if time_steps is None:
+        time_steps = range(dfs.n_timesteps)
+    elif isinstance(time_steps, (int, str)):
+        time_steps = [time_steps]
+    time_steps = [int(t) for t in time_steps]
+
+    summary = bbvectors.VectorSummary(dfs.n_elements)
+    reader = Dfsu(input_dfsu)
+    chunks = [time_steps[start:start + chunk_size] for start in range(0, len(time_steps), chunk_size)]
+    start_time = None
+    with bbprefetch.Prefetcher(lambda chunk: reader.read(items=[u_item, v_item], time_steps=chunk), chunks) as reads:
+        for chunk, ds in reads:
+            logging.info("Summarising velocity for timesteps {} to {} of {}...".format(chunk[0], chunk[-1], input_dfsu))
+            summary.update(ds.data[0], ds.data[1])
+            if start_time is None:
+                start_time = ds.time[0]
+            ds = None
+
+    if output_dfsu is not None:
+        items = [ItemInfo("Maximum current speed", EUMType.Current_Speed, EUMUnit.meter_per_sec),
+                 ItemInfo("Maximum speed direction", EUMType.Current_Direction, EUMUnit.degree),
+                 ItemInfo("Mean current direction", EUMType.Current_Direction, EUMUnit.degree)]
+        data = [summary.max_speed, summary.max_speed_direction, summary.mean_direction]
+        newds = Dataset([d[np.newaxis, :].astype(np.float32) for d in data], [start_time], items)
+        dfs.write(output_dfsu, newds, start_time=start_time, dt=dfs.timestep)
+        logging.info("Created dfsu: {}".format(output_dfsu))
+
+    if asc_file is not None:
+        if product == "max_speed_direction":
+            u, v = summary.max_u, summary.max_v
+        else:
+            u, v = summary.sum_u, summary.sum_v
+        # unit vectors, elements without flow are nodata
+        with np.errstate(invalid="ignore", divide="ignore"):
+            length = np.hypot(u, v)
+            u, v = np.where(length > 0, u/length, np.nan), np.where(length > 0, v/length, np.nan)
+
+        plan, geotransform = squareIdwPlan(dfsuMesh(dfs))
+        grid_u, grid_v = plan.apply(np.stack([u, v]))
+        bbasc.write_asc(asc_file, bbvectors.vector_direction(grid_u, grid_v), geotransform)
+        logging.info("Created asc: {}".format(asc_file))
+
+    return summary
+
+# rasterFingerprint
+# Returns a fingerprint of a raster in a GDB for incremental runs (see busybeaver.manifest), or None
+# if it doesn't exist. File GDBs don't expose when a raster was written, so its extent and size in
+# cells stand in for mtime and size.
+#
+# Example usage:
+#   rasterFingerprint("C:/some/path/to/mymodel.gdb", "mymodel_Depth")
+#
+def rasterFingerprint(gdb_name, raster_name, hash_contents=False):
+
+    import arcpy
+
+    path = os.path.join(os.path.abspath(gdb_name), raster_name)
+    if not arcpy.Exists(path):
+        return None
+    desc = arcpy.Describe(path)
 
-    # Write direction to new dfsu
-    dfs.write(output_dfsu, newds)
+    return {"extent" : str(desc.extent), "width" : desc.width, "height" : desc.height}
 
 # createGDB
 # Creates a geodatabase for model
@@ -84,6 +226,34 @@ def ascToGDB(asc_file, gdb_name, raster_name = None):
 
     return True
 
+# Clip geometries already read, by (shapefile, modification time, field, value)
+CLIP_GEOMETRIES = {}
+
+# getClipGeometry
+# Returns the arcpy geometry of the polygon in a shapefile where clip_field equals field_value.
+# Geometries are cached, so clipping several rasters, or several models sharing a boundary file,
+# reads the shapefile once per process.
+#
+# Example usage:
+#   geom = getClipGeometry("some_clip_file.shp", "selection field name", "polygon id")
+#
+def getClipGeometry(clip_shapefile, clip_field, field_value):
+
+    import arcpy
+
+    clip_shapefile = os.path.abspath(clip_shapefile)
+    key = (clip_shapefile, os.stat(clip_shapefile).st_mtime_ns, clip_field, field_value)
+    if key not in CLIP_GEOMETRIES:
+        f = arcpy.FeatureSet(clip_shapefile)
+        cursor = arcpy.da.SearchCursor(f, ("{}".format(clip_field), "SHAPE@"),"""{}='{}'""".format(clip_field, field_value))
+        cursor.reset()
+        geom = None
+        for row in cursor:
+            geom = row[1]
+        CLIP_GEOMETRIES[key] = geom
+
+    return CLIP_GEOMETRIES[key]
+
 # clipAllRasters
 # Clips all rasters in gdb to a polygon found in a shapefile matching field name and id
 #
@@ -100,12 +270,7 @@ def clipAllRasters(gdb_name, clip_shapefile, clip_field, field_value):
     arcpy.env.workspace = gdb_name
 
     # Get clip geometry for specific model shapefile with several polygons
-    f = arcpy.FeatureSet(clip_shapefile)
-    cursor = arcpy.da.SearchCursor(f, ("{}".format(clip_field), "SHAPE@"),"""{}='{}'""".format(clip_field, field_value))
-    cursor.reset()
-    geom = None
-    for row in cursor:
-        geom = row[1]       
+    geom = getClipGeometry(clip_shapefile, clip_field, field_value)
 
     # Clip rasters
     for ras in arcpy.ListRasters("*", "All"):
@@ -134,12 +299,7 @@ def clipOneRaster(gdb_name, raster_name, clip_shapefile, clip_field, field_value
     arcpy.env.workspace = gdb_name
 
     # Get clip geometry for specific model shapefile with several polygons
-    f = arcpy.FeatureSet(clip_shapefile)
-    cursor = arcpy.da.SearchCursor(f, ("{}".format(clip_field), "SHAPE@"),"""{}='{}'""".format(clip_field, field_value))
-    cursor.reset()
-    geom = None
-    for row in cursor:
-        geom = row[1]       
+    geom = getClipGeometry(clip_shapefile, clip_field, field_value)
 
     # Clip raster
     logging.info("Clipping raster {}...".format(raster_name))
@@ -237,51 +397,209 @@ def cleanRasters(gdb_name, depth, velocity, direction, depth_final, velocity_fin
 
     return True
 
+# pointsToMemoryLayer
+# Puts xyz points in an in memory point layer with the z value in field "Elevation".
+# The points are written in bulk as csv to /vsimem/ and read through an OGR VRT, rather than
+# one OGR feature at a time. Without GDAL's CSV and VRT drivers the features are created one by
+# one in an OGR Memory layer instead. Close with closeMemoryLayer when done.
+#
+# Example usage:
+#   ds = pointsToMemoryLayer(np.array([[x, y, z], [x, y, z], ...]))
+#
+def pointsToMemoryLayer(points):
+
+    points = np.asarray(points, dtype=np.float64)[:, :3]
+    if gdal.GetDriverByName("CSV") is not None and gdal.GetDriverByName("OGR_VRT") is not None:
+        ds = pointsToCsvLayer(points)
+        if ds is not None:
+            return ds
+
+    return pointsToFeatureLayer(points)
+
+# Writes points to a /vsimem/ csv and returns them opened through a VRT, None if GDAL can't open it
+def pointsToCsvLayer(points):
+
+    # unique name so several runs can grid at the same time
+    name = "bb_points_{}".format(uuid.uuid4().hex)
+    csv_path = "/vsimem/{}.csv".format(name)
+    vrt_path = "/vsimem/{}.vrt".format(name)
+
+    csv = io.BytesIO()
+    np.savetxt(csv, points, fmt="%.17g", delimiter=",", header="X,Y,Elevation", comments="")
+    gdal.FileFromMemBuffer(csv_path, csv.getvalue())
+    csv = None
+    gdal.FileFromMemBuffer(vrt_path, (
+        '<OGRVRTDataSource><OGRVRTLayer name="points">'
+        '<SrcDataSource>{}</SrcDataSource><SrcLayer>{}</SrcLayer><GeometryType>wkbPoint</GeometryType>'
+        '<GeometryField encoding="PointFromColumns" x="X" y="Y"/><Field name="Elevation" type="Real"/>'
+        '</OGRVRTLayer></OGRVRTDataSource>').format(csv_path, name))
+
+    ds = gdal.OpenEx(vrt_path, gdal.OF_VECTOR)
+    if ds is None:
+        gdal.Unlink(vrt_path)
+        gdal.Unlink(csv_path)
+
+    return ds
+
+# Returns points in an OGR Memory layer, created one feature at a time in one transaction
+def pointsToFeatureLayer(points):
+
+    ds = gdal.GetDriverByName("Memory").Create("", 0, 0, 0, gdal.GDT_Unknown)
+    layer = ds.CreateLayer("points", geom_type=ogr.wkbPoint)
+    layer.CreateField(ogr.FieldDefn("Elevation", ogr.OFTReal))
+    defn = layer.GetLayerDefn()
+
+    layer.StartTransaction()
+    for x, y, z in points.tolist():
+        point = ogr.Geometry(ogr.wkbPoint)
+        point.AddPoint_2D(x, y)
+        feature = ogr.Feature(defn)
+        feature.SetField(0, z)
+        feature.SetGeometryDirectly(point)
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+
+    return ds
+
+# closeMemoryLayer
+# Closes a layer from pointsToMemoryLayer and frees its memory
+#
+def closeMemoryLayer(ds):
+
+    path = ds.GetDescription()
+    if not path.startswith("/vsimem/"):
+        ds.DeleteLayer(0)
+        return
+
+    ds = None
+    gdal.Unlink(path)
+    gdal.Unlink(os.path.splitext(path)[0] + ".csv")
+
+# dfsuGrid
+# Returns the mikeio overset grid used for rasters of a dfsu, with nx ny based on what MIKE Zero gives
+#
+def dfsuGrid(dfs):
+
+    coords = dfs.element_coordinates[:,:2]
+    x0 = np.min(coords, axis = 0)[0]
+    y0 = np.min(coords, axis = 0)[1]
+    x1 = np.max(coords, axis = 0)[0]
+    y1 = np.max(coords, axis = 0)[1]
+    nx = round((x1-x0)/19*20)
+    ny = round((y1-y0)/19*20)
+
+    return dfs.get_overset_grid(shape=(nx, ny))
+
+# Options of the IDW plans, the same as the invdistnn algorithm gdal.Grid uses in dfsuToTif
+IDW_OPTIONS = {"power" : 2.0, "radius" : 25.0}
+
+# idwPlan
+# Returns a ResamplingPlan doing the same interpolation as gdal.Grid in dfsuToTif, and the
+# geotransform of the raster it produces
+#
+def idwPlan(coords, grid):
+
+    geotransform = gridGeotransform(grid)
+    cells = bbrasters.cell_centres(geotransform, grid.nx, grid.ny)
+    plan = bbinterp.build_idw_plan(coords, cells, (grid.ny, grid.nx), **IDW_OPTIONS)
+
+    return plan, geotransform
+
+# Returns the geotransform of the raster gdal.Grid makes on a grid in dfsuToTif
+def gridGeotransform(grid):
+    return bbrasters.bounds_to_geotransform(grid.x0, grid.y0, grid.x1, grid.y1, grid.nx, grid.ny)
+
+# dfsuMesh
+# Returns the mesh of an open dfsu with its overset grid from the mesh cache, so models with the
+# same mesh build them once per Hut run. Plans on the mesh are built when first needed, see meshIdwPlan.
+#
+def dfsuMesh(dfs):
+
+    coords = dfs.element_coordinates[:,:2]
+
+    def build():
+        grid = dfsuGrid(dfs)
+        return grid, gridGeotransform(grid)
+
+    return bbmesh.get_mesh(coords, dfs.element_table, build)
+
+# Returns the IDW ResamplingPlan of a mesh onto its grid (see idwPlan), built the first time any
+# model with the same mesh asks for it, or loaded from cache_dir if a run before saved it there
+def meshIdwPlan(mesh, cache_dir=None):
+    return mesh.plan("idw", lambda: idwPlan(mesh.coords, mesh.grid)[0], cache_dir, IDW_OPTIONS)
+
+# squareIdwPlan
+# Returns an IDW ResamplingPlan (as idwPlan) onto a grid with square cells over the same area as
+# the mesh's grid, and its geotransform. ESRI ASCII grids for ArcGIS need square cells.
+#
+def squareIdwPlan(mesh):
+
+    grid = mesh.grid
+    cell = (grid.x1 - grid.x0)/grid.nx
+    nx, ny = grid.nx, int(np.ceil((grid.y1 - grid.y0)/cell))
+    geotransform = (grid.x0, cell, 0.0, grid.y0 + ny*cell, 0.0, -cell)
+
+    def build():
+        cells = bbrasters.cell_centres(geotransform, nx, ny)
+        return bbinterp.build_idw_plan(mesh.coords, cells, (ny, nx), **IDW_OPTIONS)
+
+    return mesh.plan("sqidw", build, options=IDW_OPTIONS), geotransform
+
 # dfsuToTif
 # Converts an dfsu file to a tif raster. Overwrites if already exists.        
 #
+# Points are interpolated with inverse distance to a power (power 2, radius 25, nodata -9999)
+# by one of two backends:
+#   "gdal"  - gdal.Grid invdistnn on an in memory point layer
+#   "numpy" - same weights computed with a KD-tree and applied as a sparse matrix, much faster on large meshes
+# or, with backend "mesh", interpolated within the mesh elements on the same grid: element values are
+# averaged to the nodes and interpolated linearly inside each triangle (half quad). Cells outside
+# the mesh are nodata.
+#
+# The "numpy" and "mesh" weights are shared by models with the same mesh in a Hut run, and with
+# plan_cache saved to and loaded from that folder, so later runs don't build them again.
+#
 # Example usage:
 #   dfsuToTiff("mydfs.dfsu" ,"Total water depth", 30, "mytif.tif")
+#   dfsuToTiff("mydfs.dfsu" ,"Total water depth", 30, "mytif.tif", backend="numpy", plan_cache="C:/some/cache/folder")
 # 
-def dfsuToTif(dfsu_file, item, time_step, tif_file):
+def dfsuToTif(dfsu_file, item, time_step, tif_file, backend="gdal", plan_cache=None):
+
+    if backend not in ("gdal", "numpy", "mesh"):
+        raise ValueError("Unknown dfsuToTif backend: {}".format(backend))
 
     # get absolute paths to files
     dfsu_file = os.path.abspath(dfsu_file)
     tif_file = os.path.abspath(tif_file)
 
-    # open dfsu, get points, then close to save memory
-    dfs = Dfsu(dfsu_file)
-    coords = dfs.element_coordinates[:,:2]
+    # open dfsu, get points, then close to save memory. The timestep is read on a background
+    # thread while the mesh is built.
+    reader = Dfsu(dfsu_file)
+    with bbprefetch.Prefetcher(lambda chunk: reader.read(item, chunk), [time_step]) as reads:
+        dfs = Dfsu(dfsu_file)
+        mesh = dfsuMesh(dfs)
+        grid = mesh.grid
+        _, ds = next(iter(reads))
+    reader = None
 
-    # get custom nx ny based on what MIKE Zero gives
-    x0 = np.min(coords, axis = 0)[0]
-    y0 = np.min(coords, axis = 0)[1]
-    x1 = np.max(coords, axis = 0)[0]
-    y1 = np.max(coords, axis = 0)[1]
-    nx = round((x1-x0)/19*20)
-    ny = round((y1-y0)/19*20)
-    grid = dfs.get_overset_grid(shape=(nx, ny))
-    
-    ds = dfs.read(item, time_step)
     data = ds.data[0].transpose()
-    points = np.append(coords, data, axis=1)
+    points = np.append(mesh.coords, data, axis=1)
+    if backend == "numpy":
+        plan = meshIdwPlan(mesh, plan_cache)
+    elif backend == "mesh":
+        cells = bbrasters.cell_centres(mesh.geotransform, grid.nx, grid.ny)
+        plan = mesh.plan("mesh", lambda: bbinterp.build_mesh_plan(dfs.node_coordinates, dfs.element_table, cells,
+                                                                  (grid.ny, grid.nx)), plan_cache)
     dfs = None
     ds = None
 
-    # write points to temporary shapefile
-    driver = ogr.GetDriverByName("ESRI Shapefile")
-    ds = driver.CreateDataSource('temp_points.shp')
-    layer = ds.CreateLayer("points", srs=None, geom_type=ogr.wkbPoint)
-    layer.CreateField(ogr.FieldDefn("Elevation", ogr.OFTReal))
-    for point in points:
-        feature = ogr.Feature(layer.GetLayerDefn())
-        feature.SetField("Elevation", point[2])
-        pnt = ogr.Geometry(ogr.wkbPoint)
-        pnt.AddPoint(point[0], point[1])
-        feature.SetGeometry(pnt)
-        layer.CreateFeature(feature)
-        feature = None
-    ds = None
+    if backend in ("numpy", "mesh"):
+        bbrasters.write_tif(tif_file, plan.apply(points[:, 2]), mesh.geotransform, nodata=-9999)
+        logging.info("Created raster: {}".format(tif_file))
+        return True
+
+    # put points in an in memory point layer for gridding
+    points_ds = pointsToMemoryLayer(points)
 
     # delete any old tif files
     try:
@@ -301,12 +619,73 @@ def dfsuToTif(dfsu_file, item, time_step, tif_file):
         #algorithm='average:radius1=1:radius2=1',
         zfield='Elevation',
         noData=-9999)
-    out = gdal.Grid(tif_file, 'temp_points.shp', options=option) 
-    out = None
-
-    # clean up temporary shapefile
-    #driver.DeleteDataSource('temp_points.shp')
+    try:
+        out = gdal.Grid(tif_file, points_ds, options=option)
+        out = None
+    finally:
+        closeMemoryLayer(points_ds)
 
     logging.info("Created raster: {}".format(tif_file))
 
-    return True
\ No newline at end of file
+    return True
+
+# dfsuToTifStack
+# Converts many timesteps of an item in a dfsu to rasters, either one multiband tif (one band
+# per timestep) or a numbered series of tifs (mytif_0000.tif, mytif_0001.tif, ...).
+#
+# The dfsu is opened once, and the grid and interpolation weights (same as dfsuToTif with the
+# numpy backend) come from the mesh cache, or plan_cache, and are reused for every timestep. Timesteps
+# are read chunk_size at a time, so memory depends on the chunk size and not on the number of timesteps.
+#
+# Example usage:
+#   dfsuToTifStack("mydfs.dfsu", "Total water depth", "mytif.tif")
+#   dfsuToTifStack("mydfs.dfsu", "Total water depth", "mytif.tif", range(0, 100, 5), multiband=False)
+#
+# Returns list of tif files written
+#
+def dfsuToTifStack(dfsu_file, item, tif_file, time_steps=None, chunk_size=10, multiband=True, plan_cache=None):
+
+    # get absolute paths to files
+    dfsu_file = os.path.abspath(dfsu_file)
+    tif_file = os.path.abspath(tif_file)
+
+    dfs = Dfsu(dfsu_file)
+    if time_steps is None:
+        time_steps = range(dfs.n_timesteps)
+    elif isinstance(time_steps, int):
+        time_steps = [time_steps]
+    time_steps = [int(t) for t in time_steps]
+
+    # same grid and weights for every frame
+    mesh = dfsuMesh(dfs)
+    grid, plan, geotransform = mesh.grid, meshIdwPlan(mesh, plan_cache), mesh.geotransform
+
+    if multiband:
+        out = bbrasters.create_tif(tif_file, grid.nx, grid.ny, len(time_steps), geotransform, nodata=-9999)
+        tif_files = [tif_file]
+    else:
+        stem, ext = os.path.splitext(tif_file)
+        tif_files = ["{}_{:04d}{}".format(stem, t, ext) for t in time_steps]
+
+    # next chunk is read on a background thread while the current one is gridded and written
+    reader = Dfsu(dfsu_file)
+    chunks = [time_steps[start:start + chunk_size] for start in range(0, len(time_steps), chunk_size)]
+    with bbprefetch.Prefetcher(lambda chunk: reader.read(items=[item], time_steps=chunk), chunks) as reads:
+        for n, (chunk, ds) in enumerate(reads):
+            start = n*chunk_size
+            logging.info("Gridding timesteps {} to {} of {}...".format(chunk[0], chunk[-1], dfsu_file))
+
+            frames = plan.apply(ds.data[0])
+            ds = None
+
+            for i, frame in enumerate(frames):
+                if multiband:
+                    bbrasters.write_band(out, start + i + 1, frame, nodata=-9999)
+                else:
+                    bbrasters.write_tif(tif_files[start + i], frame, geotransform, nodata=-9999)
+            frames = None
+
+    out = None
+    logging.info("Created rasters: {}".format(", ".join(tif_files)))
+
+    return tif_files
\ No newline at end of file
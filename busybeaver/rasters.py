@@ -0,0 +1,231 @@
+# This module includes helpers for reading and writing rasters with GDAL
+
+import os
+import numpy as np
+import gdal
+
+# Creation options used for every GeoTIFF written by busybeaver
+GTIFF_OPTIONS = ["TILED=YES", "BIGTIFF=IF_SAFER"]
+
+# Default GeoTIFF compression, "DEFLATE" or "LZW"
+COMPRESS = "DEFLATE"
+
+# Overviews of cloud optimized GeoTIFFs are made down to this size
+COG_MIN_OVERVIEW = 256
+
+# Returns the GDAL geotransform for a north up grid from its outer bounds and size
+def bounds_to_geotransform(x0, y0, x1, y1, nx, ny):
+    return (x0, (x1 - x0)/nx, 0.0, y1, 0.0, (y0 - y1)/ny)
+
+# Returns (N,2) ndarray of cell centres of a north up grid, row by row from the top left cell
+def cell_centres(geotransform, nx, ny):
+    x = geotransform[0] + (np.arange(nx) + 0.5)*geotransform[1]
+    y = geotransform[3] + (np.arange(ny) + 0.5)*geotransform[5]
+    xx, yy = np.meshgrid(x, y)
+    return np.column_stack([xx.ravel(), yy.ravel()])
+
+# Reads band 1 of a raster as a float32 array with NaN for nodata
+#
+# Returns (array, geotransform, projection wkt)
+def read_raster(filename):
+
+    ds = gdal.Open(filename)
+    if ds is None:
+        raise IOError("Could not open raster {}".format(filename))
+    band = ds.GetRasterBand(1)
+    z = band.ReadAsArray().astype(np.float32)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        z[z == nodata] = np.nan
+    result = (z, ds.GetGeoTransform(), ds.GetProjection())
+    band = None
+    ds = None
+
+    return result
+
+# Returns the geotransform and (ny, nx) shape of a grid covering all of several aligned rasters
+# with the same cell size
+def union_grid(geotransforms, shapes):
+
+    dx, dy = geotransforms[0][1], geotransforms[0][5]
+    for gt in geotransforms:
+        if not (np.isclose(gt[1], dx) and np.isclose(gt[5], dy)):
+            raise ValueError("Rasters have different cell sizes.")
+
+    x0 = min(gt[0] for gt in geotransforms)
+    y0 = max(gt[3] for gt in geotransforms)
+    x1 = max(gt[0] + gt[1]*shape[1] for gt, shape in zip(geotransforms, shapes))
+    y1 = min(gt[3] + gt[5]*shape[0] for gt, shape in zip(geotransforms, shapes))
+
+    return (x0, dx, 0.0, y0, 0.0, dy), (int(round((y1 - y0)/dy)), int(round((x1 - x0)/dx)))
+
+# Returns (row, col) of the top left cell of a raster within a grid it is aligned with
+def grid_offset(geotransform, grid_geotransform):
+
+    col = (geotransform[0] - grid_geotransform[0])/grid_geotransform[1]
+    row = (geotransform[3] - grid_geotransform[3])/grid_geotransform[5]
+    if not (np.isclose(col, round(col), atol=1e-3) and np.isclose(row, round(row), atol=1e-3)):
+        raise ValueError("Rasters are not aligned to the same grid.")
+
+    return int(round(row)), int(round(col))
+
+# Yields (row, col, nrows, ncols) windows covering a raster in blocks of block_size x block_size cells
+def iter_windows(nx, ny, block_size=1024):
+    for row in range(0, ny, block_size):
+        for col in range(0, nx, block_size):
+            yield row, col, min(block_size, ny - row), min(block_size, nx - col)
+
+# Returns the geotransform of a window of a grid
+def window_geotransform(geotransform, window):
+    row, col = window[0], window[1]
+    return (geotransform[0] + col*geotransform[1], geotransform[1], 0.0,
+            geotransform[3] + row*geotransform[5], 0.0, geotransform[5])
+
+# Reads a window of a grid from band 1 of an open raster aligned with that grid, as a float32 array
+# with NaN for nodata and for cells outside the raster. Only the overlapping cells are read from disk.
+#
+# Example usage:
+#   z = read_window(ds, grid_geotransform, (row, col, nrows, ncols))
+#
+def read_window(ds, geotransform, window):
+
+    row, col, nrows, ncols = window
+    z = np.full((nrows, ncols), np.nan, dtype=np.float32)
+
+    # window in the raster's own cells
+    r_off, c_off = grid_offset(ds.GetGeoTransform(), geotransform)
+    r0, r1 = max(row, r_off), min(row + nrows, r_off + ds.RasterYSize)
+    c0, c1 = max(col, c_off), min(col + ncols, c_off + ds.RasterXSize)
+    if r0 >= r1 or c0 >= c1:
+        return z
+
+    band = ds.GetRasterBand(1)
+    values = band.ReadAsArray(c0 - c_off, r0 - r_off, c1 - c0, r1 - r0).astype(np.float32)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        values[values == nodata] = np.nan
+    z[r0 - row:r1 - row, c0 - col:c1 - col] = values
+
+    return z
+
+# Creates an empty float32 GeoTIFF to write bands into. Overwrites if already exists.
+#
+# Example usage:
+#   ds = create_tif("mytif.tif", nx, ny, 10, geotransform)
+#
+def create_tif(tif_file, nx, ny, bands, geotransform, nodata=-9999, crs=None, compress=COMPRESS):
+
+    if os.path.exists(tif_file):
+        gdal.GetDriverByName("GTiff").Delete(tif_file)
+
+    options = GTIFF_OPTIONS + ["COMPRESS={}".format(compress)] + (["INTERLEAVE=BAND"] if bands > 1 else [])
+    ds = gdal.GetDriverByName("GTiff").Create(tif_file, nx, ny, bands, gdal.GDT_Float32, options=options)
+    ds.SetGeoTransform([float(v) for v in geotransform])
+    if crs is not None:
+        ds.SetProjection(crs)
+    for i in range(bands):
+        ds.GetRasterBand(i + 1).SetNoDataValue(nodata)
+
+    return ds
+
+# Writes a 2-D array to band number band (starting at 1) of an open dataset, with its top left
+# cell at (row, col). NaN is written as nodata.
+def write_band(ds, band, z, nodata=-9999, row=0, col=0):
+    ds.GetRasterBand(band).WriteArray(np.where(np.isnan(z), nodata, z).astype(np.float32), col, row)
+
+# Writes a 2-D array to a single band float32 GeoTIFF. NaN is written as nodata.
+# Overwrites if already exists.
+#
+# Example usage:
+#   write_tif("mytif.tif", z, bounds_to_geotransform(x0, y0, x1, y1, nx, ny), nodata=-9999)
+#
+def write_tif(tif_file, z, geotransform, nodata=-9999, crs=None):
+
+    ds = create_tif(tif_file, z.shape[1], z.shape[0], 1, geotransform, nodata, crs)
+    write_band(ds, 1, z, nodata)
+    ds = None
+
+    return tif_file
+
+# write_tif_rows
+# Writes chunks of rows, top to bottom, to a single band float32 GeoTIFF as they come, so the whole
+# raster never has to be in memory. NaN is written as nodata. Overwrites if already exists.
+# With cog=True the raster is written to a temporary file first and then made a cloud optimized GeoTIFF.
+#
+# Example usage:
+#   write_tif_rows("mytif.tif", (z[r:r + 256] for r in range(0, ny, 256)), nx, ny, geotransform, crs="EPSG:25832")
+#
+def write_tif_rows(tif_file, rows, nx, ny, geotransform, nodata=-9999, crs=None, compress=COMPRESS, cog=False):
+
+    wkt = crs_to_wkt(crs) if crs is not None else None
+    target = "{}.tmp.tif".format(os.path.splitext(tif_file)[0]) if cog else tif_file
+
+    ds = create_tif(target, nx, ny, 1, geotransform, nodata, wkt, compress)
+    row = 0
+    for z in rows:
+        if row + z.shape[0] > ny or z.shape[1] != nx:
+            ds = None
+            raise ValueError("Row chunk of shape {} doesn't fit raster of {} x {} at row {}.".format(z.shape, ny, nx, row))
+        write_band(ds, 1, z, nodata, row=row)
+        row += z.shape[0]
+    ds = None
+    if row != ny:
+        raise ValueError("Only {} of {} rows were written to {}.".format(row, ny, tif_file))
+
+    if cog:
+        to_cog(target, tif_file, compress)
+        gdal.GetDriverByName("GTiff").Delete(target)
+
+    return tif_file
+
+# to_cog
+# Copies a raster to a cloud optimized GeoTIFF (tiled, compressed, with overviews before the data).
+# Uses GDAL's COG driver, or on GDAL < 3.1 builds the overviews in a temporary copy of src_file and
+# copies them, leaving src_file unchanged.
+#
+# Example usage:
+#   to_cog("mytif.tif", "mytif_cog.tif")
+#
+def to_cog(src_file, cog_file, compress=COMPRESS):
+
+    if os.path.exists(cog_file):
+        gdal.GetDriverByName("GTiff").Delete(cog_file)
+
+    driver = gdal.GetDriverByName("COG")
+    if driver is not None:
+        src = gdal.Open(src_file)
+        out = driver.CreateCopy(cog_file, src, options=["COMPRESS={}".format(compress), "BIGTIFF=IF_SAFER"])
+        out = None
+        src = None
+    else:
+        gtiff = gdal.GetDriverByName("GTiff")
+        tmp_file = "{}.ovr.tmp.tif".format(os.path.splitext(cog_file)[0])
+        src = gtiff.CreateCopy(tmp_file, gdal.Open(src_file), options=GTIFF_OPTIONS)
+        factors = []
+        while max(src.RasterXSize, src.RasterYSize) // (2**(len(factors) + 1)) >= COG_MIN_OVERVIEW:
+            factors.append(2**(len(factors) + 1))
+        if factors:
+            src.BuildOverviews("AVERAGE", factors)
+        out = gtiff.CreateCopy(cog_file, src,
+            options=GTIFF_OPTIONS + ["COMPRESS={}".format(compress), "COPY_SRC_OVERVIEWS=YES"])
+        out = None
+        src = None
+        gtiff.Delete(tmp_file)
+
+    return cog_file
+
+# Returns WKT for a coordinate system given as EPSG code, WKT, proj string or name,
+# e.g. "EPSG:25832" or ESRI style "ETRS 1989 UTM Zone 32N"
+def crs_to_wkt(crs):
+
+    from osgeo import osr
+
+    sr = osr.SpatialReference()
+    for name in (crs, str(crs).replace(" ", "_")):
+        try:
+            if sr.SetFromUserInput(name) == 0:
+                return sr.ExportToWkt()
+        except RuntimeError:
+            pass
+
+    raise ValueError("Unknown coordinate system: {}".format(crs))
@@ -0,0 +1,75 @@
+# This module includes vectorized current speed and direction products from U/V velocity components
+
+import numpy as np
+
+# Returns (speed, direction) from u and v arrays of any shape. Direction is in degrees clockwise
+# from north towards where the current flows, the same convention as MIKE's Current direction.
+def speed_direction(u, v):
+    speed = np.hypot(u, v)
+    direction = np.degrees(np.arctan2(u, v)) % 360
+    return speed, direction
+
+# Returns direction in degrees (as speed_direction) of vectors given by their components, NaN where
+# both are zero or NaN
+def vector_direction(u, v):
+    direction = np.degrees(np.arctan2(u, v)) % 360
+    direction[~((u != 0) | (v != 0))] = np.nan
+    return direction
+
+class VectorSummary:
+    """
+    Running per element summary of U/V velocity over many timesteps, updated a chunk of
+    timesteps at a time so memory depends on the chunk size and not on the number of timesteps.
+    NaN (dry or deleted) values are ignored.
+
+    max_speed            - highest speed of each element
+    max_speed_direction  - direction at the timestep where the element's speed peaks
+    mean_direction       - circular mean of the direction over timesteps with flow
+
+    Usage example:
+    summary = VectorSummary(dfs.n_elements)
+    for ds in chunks:
+        summary.update(ds["U velocity"], ds["V velocity"])
+    direction = summary.max_speed_direction
+    """
+    def __init__(self, n_elements):
+        self.max_speed = np.full(n_elements, np.nan)
+        self.max_u = np.zeros(n_elements)
+        self.max_v = np.zeros(n_elements)
+        # sums of the unit vectors of the direction
+        self.sum_u = np.zeros(n_elements)
+        self.sum_v = np.zeros(n_elements)
+        self.n_timesteps = 0
+
+    # Adds timesteps to the summary
+    #
+    # Arg: u, v, (n_elements,) or (n_timesteps, n_elements) ndarray
+    def update(self, u, v):
+
+        u = np.atleast_2d(np.asarray(u, dtype=np.float64))
+        v = np.atleast_2d(np.asarray(v, dtype=np.float64))
+        speed = np.hypot(u, v)
+
+        # timestep of peak speed in this chunk, per element
+        peak = np.argmax(np.where(np.isnan(speed), -np.inf, speed), axis=0)
+        cols = np.arange(speed.shape[1])
+        chunk_max = speed[peak, cols]
+        better = ~np.isnan(chunk_max) & ~(chunk_max <= self.max_speed)
+        self.max_speed[better] = chunk_max[better]
+        self.max_u[better] = u[peak, cols][better]
+        self.max_v[better] = v[peak, cols][better]
+
+        # timesteps without flow have no direction
+        flowing = speed > 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.sum_u += np.where(flowing, u/speed, 0).sum(axis=0)
+            self.sum_v += np.where(flowing, v/speed, 0).sum(axis=0)
+        self.n_timesteps += len(u)
+
+    @property
+    def max_speed_direction(self):
+        return vector_direction(self.max_u, self.max_v)
+
+    @property
+    def mean_direction(self):
+        return vector_direction(self.sum_u, self.sum_v)
@@ -20,7 +20,8 @@ setuptools.setup(
     ],
     python_requires='>=3.6',
     install_requires=[
-        'mikeio'
+        'mikeio',
+        'scipy'
     ],
     keywords="MIKE post-processing water modelling",
 )
\ No newline at end of file
@@ -1,7 +1,17 @@
 import busybeaver as bb
 import busybeaver.processes as proc
+import busybeaver.gdalprocesses as gdalproc
+import busybeaver.prefetch as bbprefetch
+import busybeaver.vectors as bbvectors
+import busybeaver.instrument as bbinstrument
+import busybeaver.meshcache as bbmesh
 import configparser
 import os
+import subprocess
+import sys
+import time
+import pytest
+import numpy as np
 
 # ---------------------------------------------------------------------------------------------------------------
 # Hut class tests
@@ -52,6 +62,40 @@ def test_Hut_model_iteration2():
 
     assert not errors, "{}".format("\n".join(errors))
 
+# Tests finding model files
+# -----
+
+def makeResultFiles(folder):
+    for path in ["newModel1/newModel1_depth.asc", "newModel1/results/newModel1_max.dfsu",
+                 "NEWMODEL2/newModel2_depth.asc", "other/notes.txt"]:
+        path = os.path.join(str(folder), *path.split("/"))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+
+def test_Hut_find_files1(tmp_path):
+    # files are matched to models by glob and regex patterns
+    makeResultFiles(tmp_path)
+    testhut = makeHutWithModels()
+    testhut.findFiles(str(tmp_path), {"DEPTH_2D_ASC" : "**/{model}_depth.asc",
+                                      "DFSU_RESULTS_MAX" : r"(?P<model>[^/]+)/results/[^/]+_max\.dfsu$"})
+    assert testhut["newModel1"].params["DEPTH_2D_ASC"] == os.path.join(str(tmp_path), "newModel1", "newModel1_depth.asc")
+    assert testhut["newModel1"].params["DFSU_RESULTS_MAX"] == os.path.join(str(tmp_path), "newModel1", "results", "newModel1_max.dfsu")
+    assert testhut["newModel2"].params["DEPTH_2D_ASC"] == os.path.join(str(tmp_path), "NEWMODEL2", "newModel2_depth.asc")
+    assert testhut["newModel2"].params["DFSU_RESULTS_MAX"] is None
+
+def test_Hut_find_files2(tmp_path):
+    # indexed folders are listed again only when they change, and new models can be added
+    makeResultFiles(tmp_path / "results")
+    index_file = str(tmp_path / "index.json")
+    testhut = makeHutWithModels()
+    testhut.findFiles(str(tmp_path / "results"), {"DEPTH_2D_ASC" : "*/{model}_depth.asc"}, index_file)
+    os.makedirs(str(tmp_path / "results" / "newModel3"))
+    open(str(tmp_path / "results" / "newModel3" / "newModel3_depth.asc"), "w").close()
+    found = testhut.findFiles(str(tmp_path / "results"), {"DEPTH_2D_ASC" : "*/{model}_depth.asc"}, index_file, add_models=True)
+    assert sorted(found) == ["newModel1", "newModel2", "newModel3"]
+    assert len(testhut) == 3 and testhut["newModel3"].params["DEPTH_2D_ASC"] is not None
+
 # Tests for adding a process automatically to the model run stack
 # -----
 def test_Model_add_process_to_run_stack1():
@@ -96,6 +140,22 @@ def test_Model_add_process_to_run_stack6():
     model = testhut["newModel1"]
     assert model.runstack[0].args[1] == "Path to gdb"
 
+def test_Model_add_process_to_run_stack7():
+
+    testhut = makeHutWithModels()
+    testhut["newModel1"].params["GRIDDING_BACKEND"] = "numpy"
+    testhut["newModel1"].addProcessAuto("processTIF_2DDepth")
+    model = testhut["newModel1"]
+    assert model.runstack[0].args[4] == "numpy"
+
+def test_Model_add_process_to_run_stack8():
+
+    testhut = makeHutWithModels()
+    testhut["newModel1"].params["PLAN_CACHE"] = "Path to plans"
+    testhut["newModel1"].addProcessAuto("processTIF_2DDepth")
+    model = testhut["newModel1"]
+    assert model.runstack[0].args[5] == "Path to plans"
+
 def test_Model_add_custom_process1():
 
     testhut = makeHutWithModels()
@@ -136,4 +196,291 @@ def test_process_add_function4():
 
 def test_process_add_function5():  
     myProcess = bb.Process(name, adding, 20, 15)
-    assert myProcess.run() == 35
\ No newline at end of file
+    assert myProcess.run() == 35
+# ---------------------------------------------------------------------------------------------------------------
+# Running models
+# ---------------------------------------------------------------------------------------------------------------
+
+def failing():
+    raise RuntimeError("Process failed.")
+
+def test_Hut_run_all1():
+    testhut = makeHutWithModels()
+    for model in testhut:
+        model.addProcess(name, adding, *args)
+    assert testhut.runAll() == {"newModel1": [4], "newModel2": [4]}
+
+def test_Hut_run_all_parallel1():
+    testhut = makeHutWithModels()
+    for model in testhut:
+        model.addProcess(name, adding, *args)
+    assert testhut.runAll(workers=2) == {"newModel1": [4], "newModel2": [4]}
+
+def test_Hut_run_all_parallel2():
+    # failed model doesn't stop the others
+    testhut = makeHutWithModels()
+    testhut["newModel1"].addProcess("fails", failing)
+    testhut["newModel2"].addProcess(name, adding, *args)
+    results = testhut.runAll(workers=2)
+    assert results["newModel2"] == [4] and "newModel1" in testhut.errors
+
+def test_Model_dependencies1():
+    # asc conversions only wait for the gdb, merge waits for both depths
+    testhut = makeHutWithModels()
+    model = testhut["newModel1"]
+    for process in ["createGDB", "processASC_2DDepth", "processASC_2DVelocity", "processASC_RiverDepth",
+                    "processMergeRiver2DDepth", "processClipResults", "processcleanRasters"]:
+        model.addProcessAuto(process)
+    deps = model.dependencies()
+    assert deps[1] == {0} and deps[2] == {0} and deps[3] == {0} and deps[4] == {0, 1, 3}
+
+def test_Model_dependencies2():
+    # clip waits for merge and clean waits for clip
+    testhut = makeHutWithModels()
+    model = testhut["newModel1"]
+    for process in ["createGDB", "processASC_2DDepth", "processASC_RiverDepth",
+                    "processMergeRiver2DDepth", "processClipResults", "processcleanRasters"]:
+        model.addProcessAuto(process)
+    deps = model.dependencies()
+    assert 3 in deps[4] and 4 in deps[5]
+
+def test_Model_dependencies3():
+    # processes without inputs and outputs keep their place in the runstack
+    testhut = makeHutWithModels()
+    model = testhut["newModel1"]
+    model.addProcess(name, adding, *args, inputs=[], outputs=["a"])
+    model.addProcess(name, adding, *args)
+    model.addProcess(name, adding, *args, inputs=[], outputs=["b"])
+    assert model.dependencies() == [set(), {0}, {1}]
+
+def test_Model_run_parallel1():
+    testhut = makeHutWithModels()
+    model = testhut["newModel1"]
+    model.addProcess(name, adding, 1, 1, inputs=[], outputs=["a"])
+    model.addProcess(name, adding, 2, 2, inputs=[], outputs=["b"])
+    model.addProcess(name, adding, 3, 3, inputs=["a", "b"], outputs=[])
+    assert model.run(workers=2, pool="thread") == [2, 4, 6]
+
+# ---------------------------------------------------------------------------------------------------------------
+# Incremental runs
+# ---------------------------------------------------------------------------------------------------------------
+
+def copyFile(src, dst):
+    with open(src) as f_src, open(dst, "w") as f_dst:
+        f_dst.write(f_src.read())
+    return True
+
+def makeCopyModel(folder):
+    model = bb.Model("copyModel")
+    model.params["MODEL_GDB_PATH"] = os.path.join(folder, "copyModel.gdb")
+    model.params["COPY1"] = os.path.join(folder, "copy1.txt")
+    model.params["COPY2"] = os.path.join(folder, "copy2.txt")
+    model.addProcess("copy1", copyFile, os.path.join(folder, "source.txt"), model.params["COPY1"], inputs=[], outputs=["COPY1"])
+    model.addProcess("copy2", copyFile, model.params["COPY1"], model.params["COPY2"], inputs=["COPY1"], outputs=["COPY2"])
+    return model
+
+def writeSource(folder, text):
+    with open(os.path.join(folder, "source.txt"), "w") as f:
+        f.write(text)
+
+def test_Model_run_incremental1(tmp_path):
+    # nothing runs the second time
+    writeSource(str(tmp_path), "source")
+    makeCopyModel(str(tmp_path)).run(incremental=True)
+    assert makeCopyModel(str(tmp_path)).run(incremental=True) == [None, None]
+
+def test_Model_run_incremental2(tmp_path):
+    # changed input reruns the process and everything depending on it
+    writeSource(str(tmp_path), "source")
+    makeCopyModel(str(tmp_path)).run(incremental=True)
+    writeSource(str(tmp_path), "changed source")
+    assert makeCopyModel(str(tmp_path)).run(incremental=True) == [True, True]
+
+def test_Model_run_incremental3(tmp_path):
+    # deleted output is made again
+    writeSource(str(tmp_path), "source")
+    makeCopyModel(str(tmp_path)).run(incremental=True)
+    os.remove(os.path.join(str(tmp_path), "copy2.txt"))
+    assert makeCopyModel(str(tmp_path)).run(incremental=True) == [None, True]
+
+def writeRaster(gdb, name, text):
+    if not os.path.exists(gdb):
+        os.makedirs(gdb)
+    with open(gdalproc.rasterPath(gdb, name), "w") as f:
+        f.write(text)
+    return True
+
+def renameRaster(gdb, name, new_name):
+    os.replace(gdalproc.rasterPath(gdb, name), gdalproc.rasterPath(gdb, new_name))
+    return True
+
+def makeRasterModel(folder):
+    model = bb.Model("rasterModel")
+    model.params["BACKEND"] = "gdal"
+    model.params["MODEL_GDB_PATH"] = os.path.join(folder, "rasterModel_gdal")
+    gdb = model.params["MODEL_GDB_PATH"]
+    model.addProcess("write", writeRaster, gdb, model.params["FULL_DEPTH_GDB_NAME"], "depth",
+                     inputs=[], outputs=["FULL_DEPTH_GDB_NAME"])
+    model.addProcess("clean", renameRaster, gdb, model.params["FULL_DEPTH_GDB_NAME"], model.params["FINAL_DEPTH_GDB_NAME"],
+                     inputs=["FULL_DEPTH_GDB_NAME"], outputs=["FULL_DEPTH_GDB_NAME", "FINAL_DEPTH_GDB_NAME"])
+    return model
+
+def test_Model_run_incremental4(tmp_path):
+    # rasters named by output params are fingerprinted, a deleted final raster is made again
+    # along with the intermediate raster renamed into it
+    makeRasterModel(str(tmp_path)).run(incremental=True)
+    assert makeRasterModel(str(tmp_path)).run(incremental=True) == [None, None]
+    model = makeRasterModel(str(tmp_path))
+    os.remove(gdalproc.rasterPath(model.params["MODEL_GDB_PATH"], model.params["FINAL_DEPTH_GDB_NAME"]))
+    assert model.run(incremental=True) == [True, True]
+
+def test_Model_run_incremental5(tmp_path):
+    # a changed final raster is made again
+    makeRasterModel(str(tmp_path)).run(incremental=True)
+    model = makeRasterModel(str(tmp_path))
+    writeRaster(model.params["MODEL_GDB_PATH"], model.params["FINAL_DEPTH_GDB_NAME"], "edited depth")
+    assert model.run(incremental=True) == [True, True]
+
+# ---------------------------------------------------------------------------------------------------------------
+# Run report
+# ---------------------------------------------------------------------------------------------------------------
+
+def test_Process_stats1():
+    myProcess = bb.Process(name, adding, *args)
+    myProcess.run()
+    assert myProcess.stats["wall_time"] >= 0 and myProcess.stats["cpu_time"] >= 0
+
+def allocating(size):
+    big = np.ones(size)
+    return float(big.sum())
+
+def test_Process_stats2():
+    # peak memory is of each process, not the highest of the whole run so far
+    big = bb.Process("big", allocating, 20000000)
+    big.run()
+    small = bb.Process("small", allocating, 1000)
+    small.run()
+    if big.stats["peak_rss"] is None:
+        pytest.skip("resident memory can't be read on this platform")
+    assert small.stats["peak_rss"] < big.stats["peak_rss"] - 100000000
+
+def test_RunReport_totals1():
+    # peaks are the highest in a group, other fields are summed
+    report = bbinstrument.RunReport()
+    report.add("model", "process", {"wall_time" : 1.0, "peak_rss" : 100})
+    report.add("model", "process", {"wall_time" : 2.0, "peak_rss" : 300})
+    totals = report.byModel()["model"]
+    assert totals["wall_time"] == 3.0 and totals["peak_rss"] == 300 and totals["count"] == 2
+
+def test_Hut_run_report1():
+    testhut = makeHutWithModels()
+    for model in testhut:
+        model.addProcess(name, adding, *args)
+        model.addProcess("other function", adding, *args)
+    testhut.runAll()
+    assert testhut.report.byProcess()[name]["count"] == 2 and len(testhut.report.byModel()) == 2
+
+def test_Hut_run_report2():
+    # measurements come back from worker processes
+    testhut = makeHutWithModels()
+    for model in testhut:
+        model.addProcess(name, adding, *args)
+    testhut.runAll(workers=2)
+    assert len(testhut.report.records) == 2 and not testhut.report.records[0]["skipped"]
+
+def test_Hut_run_report3(tmp_path):
+    testhut = makeHutWithModels()
+    testhut["newModel1"].addProcess(name, adding, *args)
+    testhut.runAll(profile=[name], profile_dir=str(tmp_path))
+    testhut.report.toJSON(os.path.join(str(tmp_path), "report.json"))
+    testhut.report.toCSV(os.path.join(str(tmp_path), "report.csv"))
+    assert sorted(os.listdir(str(tmp_path))) == ["newModel1_my function.prof", "report.csv", "report.json"]
+
+def test_Model_add_process_gdal_backend1():
+    testhut = makeHutWithModels()
+    testhut["newModel1"].params["BACKEND"] = "gdal"
+    testhut["newModel1"].addProcessAuto("processASC_2DDepth")
+    assert testhut["newModel1"].runstack[0].func == gdalproc.ascToGDB
+
+def test_Model_add_process_fused1():
+    # fused process only works with the gdal backend
+    testhut = makeHutWithModels()
+    with pytest.raises(ValueError):
+        testhut["newModel1"].addProcessAuto("processFusedRasters")
+
+def test_Model_add_process_cog1():
+    # COGs are made after the final rasters, and only with the gdal backend
+    testhut = makeHutWithModels()
+    model = testhut["newModel1"]
+    with pytest.raises(ValueError):
+        model.addProcessAuto("processCOG")
+    model.params["BACKEND"] = "gdal"
+    model.addProcessAuto("processcleanRasters")
+    model.addProcessAuto("processCOG")
+    assert model.runstack[1].func == gdalproc.cogRasters
+    assert model.dependencies()[1] == {0}
+
+def test_Model_add_process_vectors1():
+    # vector products write the direction asc read by processASC_2DDirection
+    testhut = makeHutWithModels()
+    model = testhut["newModel1"]
+    model.params["BACKEND"] = "gdal"
+    model.addProcessAuto("processVectorDirection")
+    model.addProcessAuto("processASC_2DDirection")
+    assert model.runstack[0].func == proc.vectorProductsFromDfsu
+    assert model.dependencies()[1] == {0}
+
+# Tests vector products
+# -----
+
+def test_vector_summary1():
+    # peak speed direction and circular mean over chunks, NaN ignored
+    u = np.array([[1.0, 0.0, np.nan], [0.0, -2.0, 0.0], [-3.0, 0.0, 0.0]])
+    v = np.array([[0.0, 1.0, np.nan], [2.0, 0.0, 0.0], [0.0, -1.0, 0.0]])
+    summary = bbvectors.VectorSummary(3)
+    summary.update(u[:2], v[:2])
+    summary.update(u[2:], v[2:])
+    assert np.allclose(summary.max_speed, [3.0, 2.0, 0.0])
+    assert np.allclose(summary.max_speed_direction[:2], [270.0, 270.0]) and np.isnan(summary.max_speed_direction[2])
+    assert np.isclose(summary.mean_direction[0], 0.0) and np.isclose(summary.mean_direction[1], 270.0)
+
+# Tests prefetching reader
+# -----
+
+def test_prefetch1():
+    # chunks come back in order, read ahead on another thread
+    with bbprefetch.Prefetcher(lambda chunk: [t*2 for t in chunk], [[0, 1], [2, 3], [4]]) as reads:
+        assert list(reads) == [([0, 1], [0, 2]), ([2, 3], [4, 6]), ([4], [8])]
+
+def test_prefetch2():
+    # errors from the reader are raised in the consumer
+    def read(chunk):
+        if chunk == 2:
+            raise KeyError(chunk)
+        return chunk
+    with pytest.raises(KeyError):
+        with bbprefetch.Prefetcher(read, range(5)) as reads:
+            list(reads)
+
+# ---------------------------------------------------------------------------------------------------------------
+# Shared memory
+# ---------------------------------------------------------------------------------------------------------------
+
+def test_meshcache_share1():
+    # an incomplete segment left by a process that died is removed and built again without waiting
+    shared_memory = pytest.importorskip("multiprocessing.shared_memory")
+    name = "bbtest_stale_{}".format(os.getpid())
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    stale = shared_memory.SharedMemory(name=name, create=True, size=1024)
+    stale.buf[8:bbmesh.PREFIX_SIZE] = np.uint64(dead.pid).tobytes()
+    stale.close()
+
+    start = time.perf_counter()
+    try:
+        segment, arrays = bbmesh.share(name, lambda: {"values" : np.arange(5.0)})
+        assert time.perf_counter() - start < 5
+        assert segment is not None and np.array_equal(arrays["values"], np.arange(5.0))
+    finally:
+        arrays = None
+        bbmesh.clear()
@@ -4,6 +4,10 @@ import shutil
 import pytest
 import filecmp
 import busybeaver.processes as proc
+import busybeaver.gdalprocesses as gdalproc
+import busybeaver.rasters as bbrasters
+import busybeaver.ascgrid as bbasc
+import busybeaver.meshcache as bbmesh
 from mikeio import Dfsu
 import numpy as np
 import gdal
@@ -65,7 +69,7 @@ def test_dfsuToTif_1():
 
 @pytest.mark.gdal
 def test_dfsuToTif_2():
-    # test if temp shapefile is deleted
+    # test that no temp shapefile is written
     hut = testHut()
     model = hut["testmodel"] 
 
@@ -133,4 +137,357 @@ def test_dfsuToTif_depth_comp_asc_6():
     arr_tif = np.array(ds_tif.ReadAsArray())
     ds_tif = None
 
-    assert np.allclose(arr_asc, arr_tif,tolerance,equal_nan=True)
\ No newline at end of file
+    assert np.allclose(arr_asc, arr_tif,tolerance,equal_nan=True)
+
+@pytest.mark.gdal
+def test_dfsuToTif_numpy_backend_7():
+    # numpy backend reproduces the gdal backend
+    hut = testHut()
+    model = hut["testmodel"]
+    gdal_tif = r"tests\data\test_output\max_depth_gdal.tif"
+    numpy_tif = r"tests\data\test_output\max_depth_numpy.tif"
+
+    proc.dfsuToTif(model.params["DFSU_RESULTS_MAX"], "Maximum water depth", 0, gdal_tif)
+    proc.dfsuToTif(model.params["DFSU_RESULTS_MAX"], "Maximum water depth", 0, numpy_tif, backend="numpy")
+
+    ds_gdal = gdal.Open(gdal_tif)
+    arr_gdal = np.array(ds_gdal.ReadAsArray())
+    ds_gdal = None
+
+    ds_numpy = gdal.Open(numpy_tif)
+    arr_numpy = np.array(ds_numpy.ReadAsArray())
+    ds_numpy = None
+
+    assert np.allclose(arr_gdal, arr_numpy, atol=tolerance)
+
+@pytest.mark.gdal
+def test_dfsuMesh_1():
+    # mesh is built once, its IDW plan only when asked for, with the same grid and weights as building them directly
+    hut = testHut()
+    model = hut["testmodel"]
+    bbmesh.clear()
+
+    mesh1 = proc.dfsuMesh(Dfsu(model.params["DFSU_RESULTS_MAX"]))
+    mesh2 = proc.dfsuMesh(Dfsu(model.params["DFSU_RESULTS_MAX"]))
+    no_plans = not mesh1.plans
+    mesh_plan = proc.meshIdwPlan(mesh2)
+
+    dfs = Dfsu(model.params["DFSU_RESULTS_MAX"])
+    plan, geotransform = proc.idwPlan(dfs.element_coordinates[:,:2], proc.dfsuGrid(dfs))
+    bbmesh.clear()
+
+    assert mesh1 is mesh2 and no_plans
+    assert np.allclose(mesh1.geotransform, geotransform)
+    assert (mesh_plan.matrix != plan.matrix).nnz == 0
+
+@pytest.mark.gdal
+def test_dfsuMesh_2(monkeypatch):
+    # with a plan cache the IDW plan is loaded in later runs instead of built again
+    hut = testHut()
+    model = hut["testmodel"]
+    cache_dir = r"tests\data\test_output\mesh_plans"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    bbmesh.clear()
+
+    plan1 = proc.meshIdwPlan(proc.dfsuMesh(Dfsu(model.params["DFSU_RESULTS_MAX"])), cache_dir)
+    bbmesh.clear()
+    def build(*args):
+        raise AssertionError("plan was built again")
+    monkeypatch.setattr(proc, "idwPlan", build)
+    plan2 = proc.meshIdwPlan(proc.dfsuMesh(Dfsu(model.params["DFSU_RESULTS_MAX"])), cache_dir)
+    bbmesh.clear()
+
+    assert len(os.listdir(cache_dir)) == 1
+    assert plan1.key == plan2.key
+    assert (plan1.matrix != plan2.matrix).nnz == 0
+
+@pytest.mark.gdal
+def test_dfsuToTifStack_1():
+    # one band per timestep in multiband tif
+    hut = testHut()
+    model = hut["testmodel"]
+    tif_file = r"tests\data\test_output\direction_stack.tif"
+
+    proc.dfsuToTifStack(model.params["DFSU_REULTS_ANIMATED"], "Current direction", tif_file, [30, 31, 32], chunk_size=2)
+
+    ds = gdal.Open(tif_file)
+    bands = ds.RasterCount
+    ds = None
+
+    assert bands == 3
+
+@pytest.mark.gdal
+def test_dfsuToTifStack_2():
+    # frames match single timestep rasters
+    hut = testHut()
+    model = hut["testmodel"]
+    tif_file = r"tests\data\test_output\direction_series.tif"
+    single_tif = r"tests\data\test_output\direction_32.tif"
+
+    tif_files = proc.dfsuToTifStack(model.params["DFSU_REULTS_ANIMATED"], "Current direction", tif_file, [31, 32], multiband=False)
+    proc.dfsuToTif(model.params["DFSU_REULTS_ANIMATED"], "Current direction", 32, single_tif, backend="numpy")
+
+    ds_frame = gdal.Open(tif_files[1])
+    arr_frame = np.array(ds_frame.ReadAsArray())
+    ds_frame = None
+
+    ds_single = gdal.Open(single_tif)
+    arr_single = np.array(ds_single.ReadAsArray())
+    ds_single = None
+
+    assert np.allclose(arr_frame, arr_single)
+
+@pytest.mark.gdal
+def test_extractDirectionFromDfsu_1():
+    # timesteps are converted to degrees chunk by chunk
+    hut = testHut()
+    model = hut["testmodel"]
+
+    stats = proc.extractDirectionFromDfsu(model.params["DFSU_REULTS_ANIMATED"],
+        model.params["DFSU_RESULTS_DIRECTION"], range(30, 33), chunk_size=2)
+
+    ds_in = Dfsu(model.params["DFSU_REULTS_ANIMATED"]).read(items=["Current direction"], time_steps=[30, 31, 32])
+    ds_out = Dfsu(model.params["DFSU_RESULTS_DIRECTION"]).read()
+
+    assert len(stats) == 2
+    assert sum(stat["bytes_written"] for stat in stats) == os.stat(model.params["DFSU_RESULTS_DIRECTION"]).st_size
+    assert np.allclose(np.rad2deg(ds_in.data[0]), ds_out.data[0], atol=1e-4)
+
+@pytest.mark.gdal
+def test_extractDirectionFromDfsu_2():
+    # a single numpy integer timestep is allowed
+    hut = testHut()
+    model = hut["testmodel"]
+
+    stats = proc.extractDirectionFromDfsu(model.params["DFSU_REULTS_ANIMATED"],
+        model.params["DFSU_RESULTS_DIRECTION"], np.int64(30))
+
+    assert len(stats) == 1 and stats[0]["time_steps"] == [30]
+
+# ---------------------------------------------------------------------------------------------------------------
+# GDAL backend for gdb processes
+# ---------------------------------------------------------------------------------------------------------------
+
+def gdalHut():
+    hut = testHut()
+    model = hut["testmodel"]
+    model.params["BACKEND"] = "gdal"
+    model.params["MODEL_GDB_PATH"] = r"tests\data\test_output\testmodel_gdal"
+    model.params["CRS"] = "EPSG:25832"
+    shutil.rmtree(model.params["MODEL_GDB_PATH"], ignore_errors=True)
+    return hut
+
+@pytest.mark.gdal
+def test_gdal_backend_ascToGDB_1():
+    # asc is converted to a tif with the same values
+    hut = gdalHut()
+    model = hut["testmodel"]
+    gdalproc.createGDB(model.params["MODEL_GDB_PATH"], model.name)
+    gdalproc.ascToGDB(model.params["DEPTH_2D_ASC"], model.params["MODEL_GDB_PATH"], "depth")
+
+    arr_asc, _, _ = bbrasters.read_raster(model.params["DEPTH_2D_ASC"])
+    arr_tif, _, _ = bbrasters.read_raster(gdalproc.rasterPath(model.params["MODEL_GDB_PATH"], "depth"))
+
+    assert np.allclose(arr_asc, arr_tif, equal_nan=True)
+
+@pytest.mark.gdal
+def test_gdal_backend_read_asc_1():
+    # native asc reader and its cache give the same array and geotransform as GDAL
+    hut = gdalHut()
+    model = hut["testmodel"]
+    asc_file = r"tests\data\test_output\depth_cached.asc"
+    shutil.copy(model.params["DEPTH_2D_ASC"], asc_file)
+
+    arr_gdal, gt_gdal, _ = bbrasters.read_raster(asc_file)
+    arr_parsed, gt_parsed, _ = bbasc.read_asc(asc_file, cache=True, block_rows=5)
+    arr_cached, gt_cached, _ = bbasc.read_asc(asc_file, cache=True)
+
+    assert np.array_equal(arr_gdal, arr_parsed, equal_nan=True)
+    assert np.array_equal(arr_gdal, arr_cached, equal_nan=True)
+    assert np.allclose(gt_gdal, gt_parsed) and np.allclose(gt_gdal, gt_cached)
+
+@pytest.mark.gdal
+def test_gdal_backend_merge_1():
+    # raster 1 wins where it has values
+    hut = gdalHut()
+    model = hut["testmodel"]
+    gdb = model.params["MODEL_GDB_PATH"]
+    gdalproc.createGDB(gdb, model.name)
+    gdalproc.ascToGDB(model.params["DEPTH_2D_ASC"], gdb, "depth")
+    gdalproc.ascToGDB(model.params["VELOCITY_2D_ASC"], gdb, "speed")
+    gdalproc.mergeRasters("depth", "speed", "merged", gdb)
+
+    arr_depth, _, _ = bbrasters.read_raster(gdalproc.rasterPath(gdb, "depth"))
+    arr_merged, _, _ = bbrasters.read_raster(gdalproc.rasterPath(gdb, "merged"))
+    valid = ~np.isnan(arr_depth)
+
+    assert np.allclose(arr_depth[valid], arr_merged[valid])
+
+@pytest.mark.gdal
+def test_gdal_backend_blocks_1():
+    # merging and clipping in small blocks gives the same rasters as in one block
+    hut = gdalHut()
+    model = hut["testmodel"]
+    gdb = model.params["MODEL_GDB_PATH"]
+    gdalproc.createGDB(gdb, model.name)
+    gdalproc.ascToGDB(model.params["DEPTH_2D_ASC"], gdb, "depth")
+    gdalproc.ascToGDB(model.params["DEPTH_RIVER_ASC"], gdb, "river")
+    gdalproc.mergeRasters("depth", "river", "merged_small", gdb, block_size=7)
+    gdalproc.mergeRasters("depth", "river", "merged_whole", gdb, block_size=100000)
+    gdalproc.clipRasterFile(gdalproc.rasterPath(gdb, "merged_whole"), gdalproc.rasterPath(gdb, "clipped_small"),
+        model.params["MODEL_BOUNDARY_POLYGON"], model.params["CLIP_FIELD"], model.params["CLIP_VALUE"], block_size=7)
+    gdalproc.clipRasterFile(gdalproc.rasterPath(gdb, "merged_whole"), gdalproc.rasterPath(gdb, "clipped_whole"),
+        model.params["MODEL_BOUNDARY_POLYGON"], model.params["CLIP_FIELD"], model.params["CLIP_VALUE"], block_size=100000)
+
+    errors = []
+    for small, whole in [("merged_small", "merged_whole"), ("clipped_small", "clipped_whole")]:
+        arr_small, gt_small, _ = bbrasters.read_raster(gdalproc.rasterPath(gdb, small))
+        arr_whole, gt_whole, _ = bbrasters.read_raster(gdalproc.rasterPath(gdb, whole))
+        if gt_small != gt_whole or not np.array_equal(arr_small, arr_whole, equal_nan=True):
+            errors.append("{} differs.".format(small))
+
+    assert not errors, "{}".format("\n".join(errors))
+
+@pytest.mark.gdal
+def test_gdal_backend_clipMask_1():
+    # the clip polygon is rasterized once per grid
+    hut = gdalHut()
+    model = hut["testmodel"]
+    _, geotransform, _ = bbrasters.read_raster(model.params["DEPTH_2D_ASC"])
+    args = (model.params["MODEL_BOUNDARY_POLYGON"], model.params["CLIP_FIELD"], model.params["CLIP_VALUE"])
+
+    gdalproc.cachedClipMask.cache_clear()
+    mask1 = gdalproc.clipMask(*args, geotransform, (38, 54))
+    mask2 = gdalproc.clipMask(*args, list(geotransform), [38, 54])
+
+    np.testing.assert_array_equal(mask1, mask2)
+    assert gdalproc.cachedClipMask.cache_info().misses == 1
+    assert mask1.any() and not mask1.all()
+
+    # windows are sliced from the grid's mask, including ones not starting on a byte
+    for block in bbrasters.iter_windows(54, 38, 7):
+        row, col, nrows, ncols = block
+        np.testing.assert_array_equal(gdalproc.clipMask(*args, geotransform, (38, 54), block),
+                                      mask1[row:row + nrows, col:col + ncols])
+    assert gdalproc.cachedClipMask.cache_info().misses == 1
+
+@pytest.mark.gdal
+def test_gdal_backend_runAll_1():
+    # full chain runs without arcpy and leaves only final rasters
+    hut = gdalHut()
+    model = hut["testmodel"]
+    for process in ["createGDB", "processASC_2DDepth", "processASC_2DVelocity", "processASC_2DDirection",
+                    "processASC_RiverDepth", "processMergeRiver2DDepth", "processClipResults",
+                    "processCRS", "processcleanRasters"]:
+        model.addProcessAuto(process)
+    hut.runAll()
+
+    assert gdalproc.listRasters(model.params["MODEL_GDB_PATH"]) == sorted(
+        [model.params["FINAL_DEPTH_GDB_NAME"], model.params["FINAL_VELOCITY_GDB_NAME"], model.params["FINAL_DIRECTION_GDB_NAME"]])
+
+@pytest.mark.gdal
+def test_gdal_backend_fused_1():
+    # fused process gives the same final rasters as the step by step chain
+    hut = gdalHut()
+    model = hut["testmodel"]
+    for process in ["createGDB", "processASC_2DDepth", "processASC_2DVelocity", "processASC_2DDirection",
+                    "processASC_RiverDepth", "processMergeRiver2DDepth", "processClipResults",
+                    "processCRS", "processcleanRasters"]:
+        model.addProcessAuto(process)
+    hut.runAll()
+
+    fused = gdalHut()["testmodel"]
+    fused.params["MODEL_GDB_PATH"] = r"tests\data\test_output\testmodel_fused"
+    shutil.rmtree(fused.params["MODEL_GDB_PATH"], ignore_errors=True)
+    fused.addProcessAuto("processFusedRasters")
+    fused.run()
+
+    errors = []
+    for final in ["FINAL_DEPTH_GDB_NAME", "FINAL_VELOCITY_GDB_NAME", "FINAL_DIRECTION_GDB_NAME"]:
+        arr_chain, gt_chain, _ = bbrasters.read_raster(gdalproc.rasterPath(model.params["MODEL_GDB_PATH"], model.params[final]))
+        arr_fused, gt_fused, _ = bbrasters.read_raster(gdalproc.rasterPath(fused.params["MODEL_GDB_PATH"], fused.params[final]))
+        if gt_chain != gt_fused or not np.allclose(arr_chain, arr_fused, equal_nan=True):
+            errors.append("{} differs.".format(final))
+
+    assert not errors, "{}".format("\n".join(errors))
+
+@pytest.mark.gdal
+def test_gdal_backend_cog_1():
+    # final rasters are converted to COGs with the same values, and unchanged ones are skipped
+    hut = gdalHut()
+    model = hut["testmodel"]
+    model.params["COG_PATH"] = r"tests\data\test_output\testmodel_cog"
+    shutil.rmtree(model.params["COG_PATH"], ignore_errors=True)
+    model.addProcessAuto("processFusedRasters")
+    model.addProcessAuto("processCOG")
+    hut.runAll()
+
+    skipped = gdalproc.cogRasters(model.params["MODEL_GDB_PATH"], model.params["COG_PATH"], model.params["FINAL_DEPTH_GDB_NAME"],
+        model.params["FINAL_VELOCITY_GDB_NAME"], model.params["FINAL_DIRECTION_GDB_NAME"])
+
+    errors = []
+    for final in ["FINAL_DEPTH_GDB_NAME", "FINAL_VELOCITY_GDB_NAME", "FINAL_DIRECTION_GDB_NAME"]:
+        arr_final, gt_final, _ = bbrasters.read_raster(gdalproc.rasterPath(model.params["MODEL_GDB_PATH"], model.params[final]))
+        arr_cog, gt_cog, _ = bbrasters.read_raster(gdalproc.rasterPath(model.params["COG_PATH"], model.params[final]))
+        if gt_final != gt_cog or not np.array_equal(arr_final, arr_cog, equal_nan=True):
+            errors.append("{} differs.".format(final))
+
+    assert not errors, "{}".format("\n".join(errors))
+    assert skipped == []
+
+@pytest.mark.gdal
+def test_gdal_backend_cog_2(monkeypatch):
+    # without the COG driver the overviews are built in a copy and the source raster is left as it was
+    folder = r"tests\data\test_output\cog_fallback"
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    src_file = os.path.join(folder, "src.tif")
+    cog_file = os.path.join(folder, "cog.tif")
+    z = np.arange(600*600, dtype=np.float32).reshape(600, 600)
+    bbrasters.write_tif_rows(src_file, [z], 600, 600, (0.0, 1.0, 0.0, 600.0, 0.0, -1.0))
+    with open(src_file, "rb") as f:
+        before = f.read()
+
+    get_driver = gdal.GetDriverByName
+    monkeypatch.setattr(gdal, "GetDriverByName", lambda name: None if name == "COG" else get_driver(name))
+    bbrasters.to_cog(src_file, cog_file)
+
+    with open(src_file, "rb") as f:
+        assert f.read() == before
+    assert sorted(os.listdir(folder)) == ["cog.tif", "src.tif"]
+    assert gdal.Open(cog_file).GetRasterBand(1).GetOverviewCount() == 1
+    arr_cog, _, _ = bbrasters.read_raster(cog_file)
+    np.testing.assert_array_equal(arr_cog, z)
+
+@pytest.mark.gdal
+def test_pointsToMemoryLayer_1():
+    # every point becomes a feature with its z in Elevation, written in bulk as csv
+    points = np.array([[0.5, 1.5, 2.25], [10.0, -3.0, -1.0], [594238.084, 6645064.994, 0.1]])
+    ds = proc.pointsToMemoryLayer(points)
+    layer = ds.GetLayer(0)
+    path = ds.GetDescription()
+
+    assert path.startswith("/vsimem/")
+    assert layer.GetFeatureCount() == 3
+    xyz = [[f.GetGeometryRef().GetX(), f.GetGeometryRef().GetY(), f.GetField("Elevation")] for f in layer]
+    np.testing.assert_array_equal(np.array(xyz), points)
+
+    layer = None
+    proc.closeMemoryLayer(ds)
+    ds = None
+    assert gdal.VSIStatL(path) is None and gdal.VSIStatL(os.path.splitext(path)[0] + ".csv") is None
+
+@pytest.mark.gdal
+def test_pointsToMemoryLayer_2(monkeypatch):
+    # without the CSV driver the features are created one by one in a Memory layer
+    points = np.array([[0.5, 1.5, 2.25], [10.0, -3.0, -1.0], [7.0, 8.0, 0.0]])
+    get_driver = gdal.GetDriverByName
+    monkeypatch.setattr(gdal, "GetDriverByName", lambda name: None if name == "CSV" else get_driver(name))
+    ds = proc.pointsToMemoryLayer(points)
+    layer = ds.GetLayer(0)
+
+    xyz = [[f.GetGeometryRef().GetX(), f.GetGeometryRef().GetY(), f.GetField("Elevation")] for f in layer]
+    np.testing.assert_array_equal(np.array(xyz), points)
+
+    proc.closeMemoryLayer(ds)
+    assert ds.GetLayerCount() == 0
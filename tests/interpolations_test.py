@@ -1,5 +1,9 @@
 import busybeaver.interpolation as bbinterp
+import busybeaver.rasters as bbrasters
+import os
+import shutil
 import pytest
+import numpy as np
 from mikeio import Dfsu
 
 # Tests getting the interpolants
@@ -119,6 +123,103 @@ def test_get_interpolants_4():
 
     assert x3 >= xi and y3 < yi
 
+# Closest element in each quadrant by the original brute force search, as reference
+def brute_force_quadrants(interp_pnt, element_coords):
+    quads = [[1000, -1], [1000, -1], [1000, -1], [1000, -1]]
+    xi, yi = interp_pnt[0], interp_pnt[1]
+    for index, pnt in enumerate(element_coords):
+        x, y = pnt[0], pnt[1]
+        dist = bbinterp.distance_between_points(interp_pnt, pnt)
+        if x >= xi and y >= yi:
+            q = 0
+        elif x < xi and y >= yi:
+            q = 1
+        elif x < xi and y < yi:
+            q = 2
+        else:
+            q = 3
+        if quads[q][0] >= dist:
+            quads[q] = [dist, index]
+    return [index for _, index in quads]
+
+@pytest.mark.interp
+def test_quadrant_index_1():
+    # index and scan give the same interpolants as the brute force search
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    ds = dfs.read("Maximum water depth")
+    index = bbinterp.QuadrantIndex(dfs.element_coordinates)
+    interp_point = (594238.084,6645064.994)
+
+    expected = bbinterp.quadrant_corners(np.array([brute_force_quadrants(interp_point, dfs.element_coordinates)]),
+                                         dfs.element_coordinates, ds.data[0][0])[0]
+    scanned = bbinterp.get_interpolants(interp_point, dfs.element_coordinates, ds.data[0][0])
+    interpolants = bbinterp.get_interpolants(interp_point, dfs.element_coordinates, ds.data[0][0], index)
+
+    np.testing.assert_array_equal(scanned, expected)
+    np.testing.assert_array_equal(interpolants, expected)
+
+@pytest.mark.interp
+def test_quadrant_index_3():
+    # same corners as the brute force search on random points, with ties from duplicate elements
+    rng = np.random.default_rng(0)
+    scattered = rng.uniform(0, 2000, (300, 2))
+    regular = np.stack(np.meshgrid(np.arange(0, 2000, 100.0), np.arange(0, 2000, 100.0)), axis=-1).reshape(-1, 2)
+
+    errors = []
+    for coords in [np.vstack([scattered, scattered[:50]]), regular]:
+        index = bbinterp.QuadrantIndex(coords)
+        points = np.vstack([rng.uniform(-100, 2100, (200, 2)), coords[:20], coords[:20] + 50])
+        found = index.query_many(points)
+        for point, ids in zip(points, found):
+            expected = brute_force_quadrants(point, coords)
+            if list(ids) != expected or list(bbinterp.scan_quadrants(point, coords)) != expected:
+                errors.append("Different corners for point ({}, {}).".format(*point))
+
+    assert not errors, "{}".format("\n".join(errors[:10]))
+
+@pytest.mark.interp
+def test_quadrant_index_4():
+    # same corners as the brute force search for grid points on and beyond the edge of an L shaped mesh,
+    # and with few nearest neighbours held at once so the quadrant search does most of the work
+    x, y = np.meshgrid(np.arange(0, 60, 2.0), np.arange(0, 60, 2.0))
+    regular = np.stack([x.ravel(), y.ravel()], axis=1)
+    coords = regular[(regular[:, 0] < 20) | (regular[:, 1] < 20)]
+    x, y = np.meshgrid(np.arange(-10, 70, 3.0), np.arange(-10, 70, 3.0))
+    points = np.vstack([np.stack([x.ravel(), y.ravel()], axis=1), coords[::7]])
+
+    errors = []
+    for max_pairs in [bbinterp.MAX_PAIRS, 100]:
+        bbinterp.MAX_PAIRS, saved = max_pairs, bbinterp.MAX_PAIRS
+        try:
+            found = bbinterp.QuadrantIndex(coords).query_many(points)
+        finally:
+            bbinterp.MAX_PAIRS = saved
+        for point, ids in zip(points, found):
+            if list(ids) != brute_force_quadrants(point, coords):
+                errors.append("Different corners for point ({}, {}).".format(*point))
+
+    assert not errors, "{}".format("\n".join(errors[:10]))
+
+@pytest.mark.interp
+def test_quadrant_index_2():
+    # every interpolant found by the index lies in its own quadrant
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    coords = dfs.element_coordinates
+    index = bbinterp.QuadrantIndex(coords)
+    g = dfs.get_overset_grid(dxdy=1)
+
+    errors = []
+    for xi, yi in g.xy:
+        for q, i in enumerate(index.query((xi, yi))):
+            # points on the edge of the mesh may have an empty quadrant
+            if i < 0:
+                continue
+            x, y = coords[i][0], coords[i][1]
+            if not [x >= xi and y >= yi, x < xi and y >= yi, x < xi and y < yi, x >= xi and y < yi][q]:
+                errors.append("Wrong quadrant for point ({}, {}).".format(xi, yi))
+
+    assert not errors, "{}".format("\n".join(errors))
+
 
 # Tests distance between points
 # -----
@@ -151,7 +252,232 @@ def test_interp_point_1():
 
     z = bbinterp.interp_point(interp_point, quad0, quad1, quad2, quad3)
 
-    assert round(z[2],6) == 0.055493
+    assert round(z[2],6) == 0.056461
+
+@pytest.mark.interp
+def test_interp_points_1():
+    # batch interpolation gives the same result as interpolating the point alone
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    ds = dfs.read("Maximum water depth")
+    index = bbinterp.QuadrantIndex(dfs.element_coordinates)
+    points = np.array([(594238.084,6645064.994), (594237.5,6645065.5)])
+
+    corners = bbinterp.quadrant_corners(index.query_many(points), dfs.element_coordinates, ds.data[0][0])
+    z = bbinterp.interp_points(points, corners)
+
+    assert round(z[0],6) == 0.056461
+
+@pytest.mark.interp
+def test_interp_points_2():
+    # missing quadrants and degenerate quads give NaN instead of raising
+    points = np.array([(0.5, 0.5), (0.5, 0.5)])
+    corners = np.array([[(1, 1, 1), (0, 1, 1), (0, 0, 1), (1, 0, 1)],
+                        [(1, 1, 1), (np.nan, np.nan, np.nan), (0, 0, 1), (1, 0, 1)]])
+
+    z = bbinterp.interp_points(points, corners)
+
+    assert np.isnan(z[1])
+
+# Random quads around points: convex quads with a corner in each quadrant, rotated rectangles,
+# parallelograms and triangles (two corners the same), at real world coordinates
+def random_quads(n, seed=0):
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(-1000, 1000, (n, 2)) + (594000, 6645000)
+    corners = np.empty((n, 4, 2))
+    for i, p in enumerate(points):
+        kind = i % 4
+        if kind == 0:
+            angles = rng.uniform(0, np.pi/2, 4) + np.arange(4)*np.pi/2
+            corners[i] = p + rng.uniform(0.5, 5, 4)[:, np.newaxis]*np.column_stack([np.cos(angles), np.sin(angles)])
+        elif kind == 1:
+            theta = rng.uniform(0, 2*np.pi)
+            rotation = np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+            size = rng.uniform(0.5, 3, 2)
+            square = np.array([(0.5, 0.5), (-0.5, 0.5), (-0.5, -0.5), (0.5, -0.5)]) - rng.uniform(-0.49, 0.49, 2)
+            corners[i] = p + (square*size) @ rotation.T
+        elif kind == 2:
+            e, f = rng.normal(size=(2, 2))*3
+            s, t = rng.uniform(0.01, 0.99, 2)
+            q2 = p - s*e - t*f
+            corners[i] = [q2 + e + f, q2 + f, q2, q2 + e]
+        else:
+            a, b, c = rng.normal(size=(3, 2))*3
+            weights = rng.dirichlet([1, 1, 1])
+            corners[i] = np.array([c, c, a, b]) + p - weights @ np.array([a, b, c])
+    return points, corners
+
+@pytest.mark.interp
+def test_bilinear_weights_1():
+    # weights give back the point they were computed for
+    points, corners = random_quads(2000)
+
+    weights = bbinterp.bilinear_weights(points, corners)
+
+    assert np.isfinite(weights).all()
+    assert np.allclose(np.einsum('ij,ijk->ik', weights, corners), points, rtol=0, atol=1e-6)
+
+@pytest.mark.interp
+def test_bilinear_weights_2():
+    # planar fields are interpolated exactly, on the unit square and on rotated and degenerate quads
+    square = np.array([[(1, 1, 11), (0, 1, 10), (0, 0, 0), (1, 0, 1)]], dtype=np.float64)
+    assert np.isclose(bbinterp.interp_points(np.array([(0.25, 0.75)]), square)[0], 7.75)
+
+    points, corners = random_quads(2000, seed=1)
+    z = 0.3*(corners[:, :, 0] - points[:, 0:1]) - 1.7*(corners[:, :, 1] - points[:, 1:2]) + 2.0
+
+    assert np.allclose(bbinterp.interp_points(points, np.dstack([corners, z])), 2.0, rtol=0, atol=1e-6)
+
+@pytest.mark.interp
+def test_interp_grid_1():
+    # grid is returned as a raster shaped array
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    ds = dfs.read("Maximum water depth")
+    g = dfs.get_overset_grid(dxdy=1)
+
+    z = bbinterp.interp_grid(g, dfs.element_coordinates, ds.data[0][0])
+
+    assert z.shape == (g.ny, g.nx) and z.dtype == np.float32
+
+@pytest.mark.interp
+def test_interp_grid_2():
+    # mask marks the grid points with a value
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    ds = dfs.read("Maximum water depth")
+    g = dfs.get_overset_grid(dxdy=1)
+
+    z, mask = bbinterp.interp_grid(g, dfs.element_coordinates, ds.data[0][0], return_mask=True)
+
+    assert mask.shape == z.shape and mask.dtype == bool
+    assert np.array_equal(mask, ~np.isnan(z))
+
+# Tests resampling plans
+# -----
+@pytest.mark.interp
+def test_resampling_plan_1():
+    # plan reproduces a planar field exactly, and only has weights where the brute force search finds
+    # an element in every quadrant
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    coords = dfs.element_coordinates
+    g = dfs.get_overset_grid(dxdy=1)
+    points = bbinterp.grid_points(g)
+
+    def plane(xy):
+        return 0.3*(xy[:, 0] - 594200) - 1.7*(xy[:, 1] - 6645000) + 2.0
+
+    plan = bbinterp.build_bilinear_plan(g, coords)
+    z = plan.apply(plane(coords)).ravel()
+    complete = np.array([min(brute_force_quadrants(point, coords)) >= 0 for point in points])
+
+    assert plan.valid.any()
+    assert not (plan.valid & ~complete).any()
+    np.testing.assert_allclose(z[plan.valid], plane(points)[plan.valid], rtol=0, atol=1e-3)
+    assert np.isnan(z[~plan.valid]).all()
+
+@pytest.mark.interp
+def test_resampling_plan_2():
+    # plan saved to cache is loaded back on the next call
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    ds = dfs.read("Maximum water depth")
+    g = dfs.get_overset_grid(dxdy=1)
+    cache_dir = r"tests\data\test_output\plans"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+
+    plan1 = bbinterp.get_resampling_plan(g, dfs.element_coordinates, cache_dir)
+    plan2 = bbinterp.get_resampling_plan(g, dfs.element_coordinates, cache_dir)
+
+    assert len(os.listdir(cache_dir)) == 1
+    assert np.allclose(plan1.apply(ds.data[0][0]), plan2.apply(ds.data[0][0]), equal_nan=True)
+
+@pytest.mark.interp
+def test_resampling_plan_3():
+    # a cached plan is loaded instead of built again, unless it was saved for another key
+    cache_dir = r"tests\data\test_output\plans_cached"
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    built = []
+    def build():
+        built.append(1)
+        return bbinterp.ResamplingPlan(np.eye(4)*len(built), (2, 2))
+
+    key = bbinterp.plan_key("test", {"radius" : 25.0}, "mesh", "grid")
+    plan1 = bbinterp.cached_plan(key, build, cache_dir)
+    plan2 = bbinterp.cached_plan(key, build, cache_dir)
+
+    assert len(built) == 1 and plan2.key == key
+    assert np.array_equal(plan1.apply(np.ones(4)), plan2.apply(np.ones(4)))
+
+    # same file name but saved for another key, e.g. by another version
+    shutil.copy(os.path.join(cache_dir, "{}.npz".format(key)), os.path.join(cache_dir, "other.npz"))
+    plan3 = bbinterp.cached_plan("other", build, cache_dir)
+
+    assert len(built) == 2 and plan3.key == "other"
+
+@pytest.mark.interp
+def test_plan_key_1():
+    # keys differ by plan version, kind, options and geometry
+    key = bbinterp.plan_key("idw", {"power" : 2.0, "radius" : 25.0}, "mesh", "grid")
+    others = [bbinterp.plan_key("bilinear", {"power" : 2.0, "radius" : 25.0}, "mesh", "grid"),
+              bbinterp.plan_key("idw", {"power" : 2.0, "radius" : 30.0}, "mesh", "grid"),
+              bbinterp.plan_key("idw", {"power" : 2.0, "radius" : 25.0}, "mesh", "grid2")]
+
+    version, bbinterp.PLAN_VERSION = bbinterp.PLAN_VERSION, bbinterp.PLAN_VERSION + 1
+    try:
+        others.append(bbinterp.plan_key("idw", {"power" : 2.0, "radius" : 25.0}, "mesh", "grid"))
+    finally:
+        bbinterp.PLAN_VERSION = version
+
+    assert key == bbinterp.plan_key("idw", {"radius" : 25.0, "power" : 2.0}, "mesh", "grid")
+    assert key not in others and len(set(others)) == len(others)
+
+@pytest.mark.interp
+def test_idw_plan_1():
+    # plan built a few rows at a time gives inverse distance weighting of the elements in range,
+    # and a cell on top of an element takes its value
+    rng = np.random.default_rng(0)
+    coords = np.vstack([rng.uniform(0, 40, (300, 2)), [[10.5, 29.5]]])
+    values = rng.uniform(0, 5, len(coords))
+    x, y = np.meshgrid(np.arange(0.5, 40), np.arange(39.5, 0, -1))
+    cells = np.stack([x.ravel(), y.ravel()], axis=1)
+
+    expected = np.full(len(cells), np.nan)
+    for n, cell in enumerate(cells):
+        dist = np.hypot(*(coords - cell).T)
+        near = dist <= 4.0
+        if (dist == 0).any():
+            expected[n] = values[dist == 0][0]
+        elif near.any():
+            expected[n] = (values[near]/dist[near]**2).sum()/(1/dist[near]**2).sum()
+
+    bbinterp.MAX_PAIRS, saved = 500, bbinterp.MAX_PAIRS
+    try:
+        plan = bbinterp.build_idw_plan(coords, cells, (40, 40), power=2.0, radius=4.0)
+    finally:
+        bbinterp.MAX_PAIRS = saved
+
+    np.testing.assert_allclose(plan.apply(values).ravel(), expected, rtol=1e-6)
+
+@pytest.mark.interp
+def test_mesh_locator_1():
+    # element centres are located in their own element
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    locator = bbinterp.MeshLocator(dfs.node_coordinates, dfs.element_table)
+
+    _, weights, elements = locator.locate(dfs.element_coordinates)
+
+    assert np.array_equal(elements, np.arange(dfs.n_elements))
+    assert np.allclose(weights.sum(axis=1), 1)
+
+@pytest.mark.interp
+def test_mesh_plan_1():
+    # constant element values give the same constant inside the mesh, nothing outside it
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    g = dfs.get_overset_grid(dxdy=1)
+
+    plan = bbinterp.get_mesh_plan(g, dfs.node_coordinates, dfs.element_table)
+    z = plan.apply(np.full(dfs.n_elements, 2.5))
+
+    assert plan.valid.any()
+    assert np.allclose(z[~np.isnan(z)], 2.5)
+    assert np.isnan(z).sum() == (~plan.valid).sum()
 
 # Test writing to shapefile interp grid
 # -----
@@ -163,8 +489,26 @@ def test_write_shp_1():
 
     g = dfs.get_overset_grid(dxdy=1)
 
-    z = bbinterp.interp_grid(g, dfs.element_coordinates, ds.data[0][0])
+    z, mask = bbinterp.interp_grid(g, dfs.element_coordinates, ds.data[0][0], return_mask=True)
 
-    bbinterp.write_to_shp(r"tests\data\test_output\bilinear.tif", grid, z)
+    bbinterp.write_to_shp(r"tests\data\test_output\bilinear.tif", g, z, mask)
     
-    assert True
\ No newline at end of file
+    assert os.path.exists(r"tests\data\test_output\bilinear.tif")
+@pytest.mark.interp
+def test_write_shp_2():
+    # rows streamed from a plan give the same raster as the whole array, on the grid's cells
+    dfs = Dfsu(r"tests\data\MIKE\test_max_results.dfsu")
+    ds = dfs.read("Maximum water depth")
+    g = dfs.get_overset_grid(dxdy=1)
+    tif_file = r"tests\data\test_output\bilinear_streamed.tif"
+
+    plan = bbinterp.get_resampling_plan(g, dfs.element_coordinates)
+    z = bbinterp.interp_grid(g, dfs.element_coordinates, ds.data[0][0], plan)
+    bbinterp.write_to_shp(tif_file, g, plan.iter_rows(ds.data[0][0], block_rows=5),
+                          crs="EPSG:25832", compress="LZW", cog=True)
+
+    arr, geotransform, wkt = bbrasters.read_raster(tif_file)
+
+    assert np.allclose(arr, z, equal_nan=True)
+    assert np.allclose(geotransform, bbinterp.grid_geotransform(g))
+    assert "25832" in wkt